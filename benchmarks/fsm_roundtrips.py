@@ -0,0 +1,90 @@
+"""
+Сколько обращений к хранилищу FSM стоит один шаг заявки: обычный FSMContext
+против BufferedFSMContext (bot/middlewares/fsm.py) на Redis-хранилище бота.
+
+Шаг повторяет app_enter_last_name: update_data, get_data, update_data,
+edit_or_send_message (get_data + update_data) и set_state.
+
+Запуск: python -m benchmarks.fsm_roundtrips --steps 500
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+from bot.middlewares.fsm import BufferedFSMContext
+from bot.storage import create_fsm_storage
+from config import settings
+from services.redis_pool import redis_latency, redis_manager
+from states.manager_states import ManagerFSM
+
+
+class CountingStorage:
+    """Прокси хранилища: считает обращения (каждое - один round trip до Redis)."""
+    def __init__(self, storage):
+        self._storage = storage
+        self.calls = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if name in ("get_state", "set_state", "get_data", "set_data", "set_state_and_data"):
+            async def counted(*args, **kwargs):
+                self.calls += 1
+                return await attr(*args, **kwargs)
+            return counted
+        return attr
+
+
+async def application_step(state: FSMContext, step: int):
+    await state.update_data(last_name=f"Иванов {step}")
+    data = await state.get_data()
+    if data.get("editing_mode"):
+        await state.update_data(editing_mode=False)
+    await state.update_data(last_prompt="Шаг 3: Введите имя клиента:")
+    # edit_or_send_message
+    data = await state.get_data()
+    data.get("last_bot_message_id")
+    await state.update_data(last_bot_message_id=1000 + step)
+    await state.set_state(ManagerFSM.app_entering_first_name)
+
+
+async def measure(name: str, storage: CountingStorage, key: StorageKey, steps: int, buffered: bool):
+    storage.calls = 0
+    durations = []
+    for step in range(steps):
+        started = time.perf_counter()
+        if buffered:
+            # Как в BufferedFSMMiddleware: состояние уже прочитано до хендлера (raw_state)
+            state = BufferedFSMContext(storage=storage, key=key, raw_state=ManagerFSM.app_entering_last_name.state)
+            await application_step(state, step)
+            await state.flush()
+        else:
+            await application_step(FSMContext(storage=storage, key=key), step)
+        durations.append((time.perf_counter() - started) * 1000)
+
+    print(f"{name:<10} round trips/step={storage.calls / steps:5.1f}  "
+          f"avg={statistics.mean(durations):6.2f}ms  p95={sorted(durations)[int(steps * 0.95) - 1]:6.2f}ms")
+
+
+async def run(steps: int):
+    redis_storage = create_fsm_storage(settings)
+    storage = CountingStorage(redis_storage)
+    key = StorageKey(bot_id=0, chat_id=-1, user_id=-1)
+    try:
+        await measure("plain", storage, key, steps, buffered=False)
+        await measure("buffered", storage, key, steps, buffered=True)
+        await redis_storage.set_state(key, None)
+        await redis_storage.set_data(key, {})
+        print(redis_latency.report())
+    finally:
+        await redis_manager.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--steps", type=int, default=500)
+    args = parser.parse_args()
+    asyncio.run(run(args.steps))
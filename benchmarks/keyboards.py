@@ -0,0 +1,56 @@
+"""
+Стоимость построения клавиатур на шаг заявки: InlineKeyboardBuilder на каждый вызов
+против запомненных клавиатур (keyboards/inline.py).
+
+Наборы кнопок те же, что в main.py: валюты, бренды, направление, даты,
+пустой шаг (только Пауза/Отмена) и пульт менеджера.
+
+Запуск: python -m benchmarks.keyboards --calls 20000
+"""
+import argparse
+import time
+
+from keyboards.inline import _build_app_step_keyboard, get_app_step_keyboard, get_manager_control_panel
+from main import BRANDS, CURRENCIES
+
+CASES = {
+    "currencies": {c: c for c in CURRENCIES},
+    "brands": {b: b for b in BRANDS},
+    "direction": {"Обратная": "Обратная", "Прямая": "Прямая"},
+    "dates": {"Сегодня": "set_date_today", "Завтра": "set_date_tomorrow", "Послезавтра": "set_date_day_after"},
+    "text step": None,
+}
+
+
+def per_call_us(func, calls: int) -> float:
+    started = time.perf_counter()
+    for _ in range(calls):
+        func()
+    return (time.perf_counter() - started) / calls * 1_000_000
+
+
+def run(calls: int):
+    build_step = _build_app_step_keyboard.__wrapped__
+    build_panel = get_manager_control_panel.__wrapped__
+
+    print(f"{'keyboard':<14} {'builder':>10} {'memoized':>10} {'speedup':>8}")
+    for name, buttons in CASES.items():
+        key = tuple(buttons.items()) if buttons else ()
+        plain = per_call_us(lambda: build_step(key), calls)
+        cached = per_call_us(lambda: get_app_step_keyboard(buttons), calls)
+        print(f"{name:<14} {plain:>8.1f}us {cached:>8.2f}us {plain / cached:>7.0f}x")
+
+    # Пульт: несколько сотен открытых диалогов вперемешку
+    dialog_ids = [1000 + i % 500 for i in range(calls)]
+    panels = iter(dialog_ids * 2)
+    plain = per_call_us(lambda: build_panel(next(panels)), calls)
+    cached = per_call_us(lambda: get_manager_control_panel(next(panels)), calls)
+    print(f"{'control panel':<14} {plain:>8.1f}us {cached:>8.2f}us {plain / cached:>7.0f}x")
+    print(get_manager_control_panel.cache_info())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+    run(args.calls)
@@ -0,0 +1,107 @@
+import copy
+from typing import Callable, Dict, Any, Awaitable, Optional
+from aiogram import BaseMiddleware
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.state import State
+from aiogram.types import TelegramObject
+
+# Маркер "состояние еще не загружено" (None - законное значение состояния)
+_NOT_LOADED = object()
+
+
+class BufferedFSMContext(FSMContext):
+    """
+    FSMContext на время одного апдейта: данные читаются из хранилища один раз,
+    все get/update_data работают с локальной копией, а состояние и данные
+    записываются обратно одним flush() после успешного хендлера.
+    """
+    def __init__(self, storage: BaseStorage, key: StorageKey, raw_state: Any = _NOT_LOADED):
+        super().__init__(storage=storage, key=key)
+        # Состояние уже прочитано FSMContextMiddleware (raw_state) - повторно не читаем
+        self._state = raw_state
+        self._data: Optional[Dict[str, Any]] = None
+        self._state_dirty = False
+        self._data_dirty = False
+
+    async def get_state(self) -> Optional[str]:
+        if self._state is _NOT_LOADED:
+            self._state = await self.storage.get_state(key=self.key)
+        return self._state
+
+    async def set_state(self, state: StateType = None) -> None:
+        self._state = state.state if isinstance(state, State) else state
+        self._state_dirty = True
+
+    async def _load_data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = await self.storage.get_data(key=self.key)
+        return self._data
+
+    async def get_data(self) -> Dict[str, Any]:
+        return copy.deepcopy(await self._load_data())
+
+    async def get_value(self, key: str, default: Optional[Any] = None) -> Optional[Any]:
+        return copy.deepcopy((await self._load_data()).get(key, default))
+
+    async def set_data(self, data: Dict[str, Any]) -> None:
+        self._data = copy.deepcopy(data)
+        self._data_dirty = True
+
+    async def update_data(self, data: Optional[Dict[str, Any]] = None, **kwargs: Any) -> Dict[str, Any]:
+        current = await self._load_data()
+        if data:
+            current.update(copy.deepcopy(data))
+        current.update(copy.deepcopy(kwargs))
+        self._data_dirty = True
+        return copy.deepcopy(current)
+
+    async def clear(self) -> None:
+        await self.set_state(None)
+        await self.set_data({})
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения: при поддержке хранилища - одним запросом."""
+        if self._state_dirty and self._data_dirty and hasattr(self.storage, "set_state_and_data"):
+            await self.storage.set_state_and_data(self.key, self._state, self._data)
+        else:
+            if self._state_dirty:
+                await self.storage.set_state(key=self.key, state=self._state)
+            if self._data_dirty:
+                await self.storage.set_data(key=self.key, data=self._data)
+        self._state_dirty = self._data_dirty = False
+
+    def discard(self) -> None:
+        """Отбрасывает несохраненные изменения: следующее чтение пойдет в хранилище."""
+        self._state = _NOT_LOADED
+        self._data = None
+        self._state_dirty = self._data_dirty = False
+
+
+class BufferedFSMMiddleware(BaseMiddleware):
+    """
+    Inner-middleware на message/callback_query: подменяет FSMContext на BufferedFSMContext,
+    чтобы шаг заявки стоил одно чтение и одну запись в хранилище вместо 4-6 обращений.
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        context = data.get("state")
+        if context is None:
+            return await handler(event, data)
+
+        buffered = BufferedFSMContext(storage=context.storage, key=context.key, raw_state=data.get("raw_state", _NOT_LOADED))
+        data["state"] = buffered
+        try:
+            result = await handler(event, data)
+        except BaseException:
+            # Хендлер упал на полпути (или уступил апдейт через SkipHandler):
+            # его частичные изменения состояния не сохраняем
+            buffered.discard()
+            raise
+        else:
+            await buffered.flush()
+            return result
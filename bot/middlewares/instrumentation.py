@@ -0,0 +1,61 @@
+import time
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.types import TelegramObject, Update
+
+from monitoring.instrumentation import instrumentation, current_stats
+
+
+class UpdateInstrumentationMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: открывает замер на весь апдейт
+    (включая открытие/закрытие сессии БД).
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = f"update:{event.event_type}" if isinstance(event, Update) else type(event).__name__
+        async with instrumentation.track(name):
+            return await handler(event, data)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Inner-middleware на наблюдателях событий: подписывает замер именем сработавшего хендлера."""
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        stats = current_stats.get()
+        handler_object = data.get("handler")
+        if stats is not None and handler_object is not None:
+            name = getattr(handler_object.callback, "__name__", "")
+            # Служебный хендлер диспетчера, который пробрасывает апдейт дальше
+            if name and not name.startswith("_"):
+                stats.name = name
+        return await handler(event, data)
+
+
+class ApiCallTimingMiddleware(BaseRequestMiddleware):
+    """Request-middleware сессии бота: считает вызовы Bot API, время на них и ошибки."""
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ):
+        started = time.perf_counter()
+        error = None
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            error = type(e).__name__
+            raise
+        finally:
+            instrumentation.record_api_call(type(method).__name__, time.perf_counter() - started, error)
@@ -0,0 +1,26 @@
+import random
+from typing import Callable, Dict, Any, Awaitable
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from monitoring.profiler import profiler
+
+
+class ProfilingMiddleware(BaseMiddleware):
+    """
+    Inner-middleware на наблюдателях событий: профилирует долю апдейтов,
+    пока профилировщик включен (/profile on или SIGUSR2).
+    """
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        if not profiler.enabled or random.random() >= profiler.sample_rate:
+            return await handler(event, data)
+
+        handler_object = data.get("handler")
+        name = getattr(handler_object.callback, "__name__", "") if handler_object is not None else ""
+        async with profiler.profile(name or type(event).__name__):
+            return await handler(event, data)
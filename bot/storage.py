@@ -0,0 +1,63 @@
+"""
+Хранилище FSM в Redis.
+
+Черновики заявок (ManagerFSM.app_*), поставленные на паузу сценарии (saved_state)
+и last_bot_message_id переживают перезапуск и доступны любой реплике бота.
+- отдельная БД Redis (redis_fsm_db), не пересекается с очередью redis_queue_name;
+  соединения берутся из общего пула (services.redis_pool);
+- у каждого ключа свой TTL: брошенные сценарии удаляются сами;
+- данные пишутся компактным JSON, ключи со значением None не сохраняются,
+  пустые данные удаляют ключ целиком.
+"""
+import json
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+
+from config import Settings
+from services.redis_pool import redis_manager
+
+
+def compact_dumps(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+
+class CompactRedisStorage(RedisStorage):
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        # None в данных FSM означает "значения нет" - хранить его незачем
+        await super().set_data(key, {name: value for name, value in data.items() if value is not None})
+
+    async def set_state_and_data(self, key: StorageKey, state: StateType, data: Optional[Dict[str, Any]]) -> None:
+        """
+        Записывает состояние и данные за одно обращение к Redis (pipeline).
+        data=None - данные не менялись и не трогаются.
+        """
+        state_key = self.key_builder.build(key, "state")
+        state_value = state.state if isinstance(state, State) else state
+        async with self.redis.pipeline(transaction=True) as pipe:
+            if state_value is None:
+                pipe.delete(state_key)
+            else:
+                pipe.set(state_key, state_value, ex=self.state_ttl)
+
+            if data is not None:
+                data_key = self.key_builder.build(key, "data")
+                data = {name: value for name, value in data.items() if value is not None}
+                if data:
+                    pipe.set(data_key, self.json_dumps(data), ex=self.data_ttl)
+                else:
+                    pipe.delete(data_key)
+            await pipe.execute()
+
+
+def create_fsm_storage(settings: Settings) -> CompactRedisStorage:
+    return CompactRedisStorage(
+        redis_manager.client(settings.redis_fsm_db),
+        # Без ID бота в ключе: все реплики видят один и тот же сценарий менеджера
+        key_builder=DefaultKeyBuilder(prefix="fsm", with_bot_id=False),
+        state_ttl=settings.fsm_state_ttl_seconds,
+        data_ttl=settings.fsm_data_ttl_seconds,
+        json_dumps=compact_dumps
+    )
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 # 1. Получаем абсолютный путь к папке, где лежит этот файл (config.py)
@@ -9,6 +10,10 @@ ENV_FILE_PATH = os.path.join(BASE_DIR, ".env")
 class Settings(BaseSettings):
     bot_token: str
     db_url: str
+    # Реплика для тяжелых read-only запросов (история, заметки, БЗ, SLA)
+    db_replica_url: Optional[str] = None
+    db_replica_max_lag_seconds: int = 10
+    db_replica_check_seconds: int = 15
     message_checker_chat_id: int
     applications_channel_id: int
     escalation_channel_id: int
@@ -16,10 +21,104 @@ class Settings(BaseSettings):
     technical_chat_id: int
     sla_timeout_minutes: int = 5
 
+    # Индекс (чат менеджера, топик) -> диалог в памяти. Изменения этого процесса попадают в него
+    # сразу после commit, поэтому по умолчанию записи не истекают (вытесняются только по LRU).
+    # TTL > 0 - верхняя граница устаревания, если диалоги меняет еще кто-то (несколько реплик бота)
+    topic_index_max_size: int = 20000
+    topic_index_ttl_seconds: int = 0
+    # Кэш (чат, сообщение) -> запись лога для синхронизации правок и удалений
+    message_map_cache_size: int = 50000
+
+    # Как часто сверять версию справочника городов (cities:version, меняет seed_cities.py)
+    city_catalog_check_seconds: int = 60
+
+    # Окно склейки правок сообщения: применяется последний текст серии (0 - без задержки)
+    edit_debounce_seconds: float = 3.0
+
+    # Архивация логов закрытых диалогов и свертка старых нарушений SLA
+    retention_days: int = 90
+    sla_rollup_days: int = 30
+    retention_batch_size: int = 1000
+    retention_batch_pause_seconds: float = 0.5
+
+    # Замеры SQL/Bot API на апдейт и детектор N+1
+    instrumentation_enabled: bool = True
+    instrumentation_report_minutes: int = 15
+    instrumentation_top_n: int = 10
+    instrumentation_n_plus_one_threshold: int = 5
+    # Метрики Prometheus: GET http://metrics_host:metrics_port/metrics
+    metrics_enabled: bool = True
+    metrics_host: str = '127.0.0.1'
+    metrics_port: int = 9108
+    # Как часто выравнивать счетчики диалогов по статусам по БД
+    metrics_resync_seconds: int = 300
+    # Профилировщик хендлеров (/profile, SIGUSR2): доля апдейтов, порог "медленного" вызова, куда писать отчеты
+    profiler_sample_rate: float = 0.1
+    profiler_slow_seconds: float = 1.0
+    profiler_dir: str = os.path.join(BASE_DIR, 'profiles')
+    profiler_top_n: int = 20
+
+    # Поиск по Базе Знаний
+    kb_search_limit: int = 50
+    # Сколько постов показывать на одной странице выдачи
+    kb_page_size: int = 5
+    # Инлайн-режим (@bot запрос): кэш Telegram, размер страницы, кэш выдачи, время жизни и размер кэша проверки прав
+    kb_inline_cache_seconds: int = 30
+    kb_inline_page_size: int = 20
+    kb_inline_cache_size: int = 1000
+    kb_inline_staff_ttl_seconds: int = 600
+    kb_inline_staff_cache_size: int = 5000
+    # Кэш выдачи поиска: размер, время жизни и общий слой в Redis для всех реплик
+    kb_cache_size: int = 2000
+    kb_cache_ttl_seconds: int = 600
+    kb_cache_shared: bool = True
+    # Как часто проверять kb:index_version после массовой загрузки (kb_backfill.py)
+    kb_reindex_check_seconds: int = 60
+    # Исправление опечаток и раскладки в запросах (бюджет времени на подбор, мс)
+    kb_fuzzy_enabled: bool = True
+    kb_fuzzy_budget_ms: int = 20
+    # memory - индекс в памяти, fulltext - MySQL FULLTEXT (ngram), like - LIKE '%...%'
+    kb_search_backend: str = 'memory'
+
     redis_host: str = 'localhost'
     redis_port: int = 6379
     redis_db: int = 1
     redis_queue_name: str = 'main_task_queue'
+    # Пул соединений Redis (на каждую БД): размер, ожидание свободного соединения, таймауты, health check
+    redis_max_connections: int = 20
+    redis_pool_timeout_seconds: int = 5
+    redis_socket_timeout_seconds: int = 10
+    redis_connect_timeout_seconds: int = 3
+    redis_health_check_seconds: int = 30
+    redis_warmup_connections: int = 4
+    # Команды дольше порога пишутся в лог как медленные
+    redis_slow_command_ms: int = 100
+    # Транспорт заявок: list (RPUSH в redis_queue_name) или stream (XADD + consumer group)
+    redis_transport: str = 'list'
+    redis_stream_name: str = 'deals_stream'
+    redis_stream_group: str = 'deal_processor'
+    redis_stream_maxlen: int = 100000
+    # Алерт в технический чат: порог PEL/отставания, простой без ACK, пауза между алертами
+    redis_stream_pending_alert: int = 100
+    redis_stream_idle_alert_seconds: int = 600
+    redis_stream_check_seconds: int = 60
+    redis_stream_alert_cooldown_seconds: int = 1800
+    # События по сделкам от обработчика заявок (deals_id, topic_id, status)
+    deal_events_enabled: bool = True
+    redis_deal_events_stream: str = 'deal_events'
+    redis_deal_events_group: str = 'servicedesk_bot'
+    deal_events_batch_size: int = 100
+    # FSM в Redis: отдельная БД и время жизни брошенных сценариев (черновики заявок, пауза)
+    redis_fsm_db: int = 2
+    fsm_state_ttl_seconds: int = 3 * 24 * 3600
+    fsm_data_ttl_seconds: int = 3 * 24 * 3600
+
+    # Outbox заявок: как часто и какими пачками доставлять в Redis, backoff при сбоях
+    outbox_relay_seconds: int = 2
+    outbox_batch_size: int = 100
+    outbox_backoff_base_seconds: int = 5
+    outbox_backoff_max_seconds: int = 300
+    outbox_retention_days: int = 7
 
     # 3. Указываем конкретный путь к файлу
     model_config = SettingsConfigDict(
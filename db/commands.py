@@ -7,22 +7,37 @@ from sqlalchemy import select, func, and_, or_
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload
 from aiogram.types import User as AiogramUser
-from sqlalchemy import select, func, and_, or_, case
-from db.models import User, Dialog, Note, Employee, MessageLog, KnowledgeBaseEntry, City, SLAViolation
+from sqlalchemy import select, func, and_, or_, case, insert, delete, update
+from sqlalchemy.dialects.mysql import insert as mysql_insert, match
+from db.models import (
+    User, Dialog, Note, Employee, MessageLog, MessageLogArchive, KnowledgeBaseEntry, City,
+    SLAViolation, SLAViolationDaily, OutboxMessage, Deal, TelegramMessageMap
+)
+from db.hooks import on_commit
+from db.routing import replica_read
+from db.topic_index import topic_index, DialogRef
+from db.message_map import message_map, MessageRef
+from monitoring.metrics import metrics
+from services.kb_cache import kb_cache
+from services.kb_search import kb_index, KBSearchHit, make_title, make_snippet
+from services.ru_stemmer import stem
+from config import settings
+import functools
+import json
 import re
 
+def extract_kb_keywords(text: str) -> str:
+    """Хештеги поста одной строкой в нижнем регистре: "#крипта #btc"."""
+    # Ищем хештеги (слова с решеткой в начале)
+    hashtags = re.findall(r"#\w+", text or "")
+    # Если хештегов нет, сохраняем пустую строку, чтобы не было ошибки NoneType
+    return " ".join(hashtags).lower()[:255]
+
 async def add_or_update_kb_entry(session: AsyncSession, message_id: int, text: str):
     """
     Сохраняет пост. Извлекает хештеги для поиска.
     """
-    # Ищем хештеги (слова с решеткой в начале)
-    hashtags = re.findall(r"#\w+", text)
-    
-    # Если хештегов нет, сохраняем пустую строку, чтобы не было ошибки NoneType
-    if hashtags:
-        keywords_str = " ".join(hashtags).lower() # "#крипта #btc"
-    else:
-        keywords_str = ""
+    keywords_str = extract_kb_keywords(text)
 
     # Проверяем, есть ли запись
     stmt = select(KnowledgeBaseEntry).where(KnowledgeBaseEntry.message_id == message_id)
@@ -42,6 +57,137 @@ async def add_or_update_kb_entry(session: AsyncSession, message_id: int, text: s
     
     await session.flush()
     print(f"✅ [DB] Saved Entry {message_id}: Keywords='{keywords_str}'")
+    return entry
+
+async def bulk_upsert_kb_entries(session: AsyncSession, posts: list[tuple[int, str]]) -> int:
+    """
+    Массовая загрузка постов одним многострочным INSERT ... ON DUPLICATE KEY UPDATE.
+    Используется для первичного наполнения и переиндексации (kb_backfill.py).
+    """
+    if not posts:
+        return 0
+    stmt = mysql_insert(KnowledgeBaseEntry).values([
+        {"message_id": message_id, "text": text, "keywords": extract_kb_keywords(text)}
+        for message_id, text in posts
+    ])
+    stmt = stmt.on_duplicate_key_update(text=stmt.inserted.text, keywords=stmt.inserted.keywords)
+    await session.execute(stmt)
+    return len(posts)
+
+@replica_read
+async def search_knowledge_base(session: AsyncSession, query: str, limit: int = 50, offset: int = 0) -> list[KBSearchHit]:
+    """
+    Ищет посты Базы Знаний выбранным в настройках способом (kb_search_backend):
+    - memory: индекс в памяти (BM25, морфология, фразы, префиксы), БД нужна только для его построения;
+    - fulltext: MySQL FULLTEXT с ngram-парсером;
+    - like: полный перебор LIKE '%...%' (эталон для сравнения).
+    Выдача на kb_search_limit постов кэшируется (services/kb_cache.py).
+    """
+    if offset + limit > settings.kb_search_limit:
+        return await _search_knowledge_base_uncached(session, query, limit, offset)
+
+    key = kb_cache.make_key(query, settings.kb_search_backend)
+    hits = await kb_cache.get(key)
+    if hits is None:
+        generation = kb_cache.generation
+        # Исправленные опечатки и раскладка тоже нужны кэшу: по ним он сбрасывает выдачу
+        corrected_terms = set()
+        hits = await _search_knowledge_base_uncached(session, query, settings.kb_search_limit, corrected_terms=corrected_terms)
+        await kb_cache.put(key, hits, generation, extra_terms=corrected_terms)
+    return hits[offset:offset + limit]
+
+async def _search_knowledge_base_uncached(
+    session: AsyncSession, query: str, limit: int, offset: int = 0, corrected_terms: set[str] | None = None
+) -> list[KBSearchHit]:
+    if settings.kb_search_backend == 'fulltext':
+        return await search_knowledge_base_fulltext(session, query, limit, offset)
+    if settings.kb_search_backend == 'like':
+        return await search_knowledge_base_like(session, query, limit, offset)
+
+    if not kb_index.ready:
+        await kb_index.rebuild(session)
+    return kb_index.search(query, limit=offset + limit, corrected_terms=corrected_terms)[offset:]
+
+def build_boolean_query(query: str) -> str:
+    """
+    Превращает запрос менеджера в BOOLEAN MODE для ngram-парсера:
+    каждое слово обязательно (+) и берется по основе, чтобы находить
+    другие словоформы; "фразы" сохраняются как есть.
+    """
+    parts = []
+    for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query.lower()):
+        if phrase:
+            cleaned = re.sub(r'[^\w\s]', ' ', phrase).strip()
+            if cleaned:
+                parts.append(f'+"{cleaned}"')
+            continue
+        word = re.sub(r'[^\w]', '', word)
+        if word:
+            parts.append(f'+"{stem(word)}"')
+    return " ".join(parts)
+
+def _kb_hit(message_id: int, text: str, score: float, query: str) -> KBSearchHit:
+    return KBSearchHit(
+        message_id=message_id,
+        score=float(score),
+        title=make_title(text or ""),
+        snippet=make_snippet(text or "", query.split())
+    )
+
+async def search_knowledge_base_fulltext(session: AsyncSession, query: str, limit: int = 50, offset: int = 0) -> list[KBSearchHit]:
+    """Поиск по FULLTEXT-индексу ft_knowledge_base_text с сортировкой по релевантности."""
+    boolean_query = build_boolean_query(query)
+    if not boolean_query:
+        return []
+    relevance = match(KnowledgeBaseEntry.text, KnowledgeBaseEntry.keywords, against=boolean_query).in_boolean_mode()
+    stmt = (
+        select(KnowledgeBaseEntry.message_id, KnowledgeBaseEntry.text, relevance.label('score'))
+        .where(relevance)
+        .order_by(relevance.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+    result = await session.execute(stmt)
+    return [_kb_hit(message_id, text, score, query) for message_id, text, score in result.all()]
+
+async def search_knowledge_base_like(session: AsyncSession, query: str, limit: int = 50, offset: int = 0) -> list[KBSearchHit]:
+    """Поиск перебором LIKE '%слово%' по всем словам запроса (без индекса)."""
+    words = [w for w in re.findall(r"\w+", query.lower()) if w]
+    if not words:
+        return []
+    conditions = [
+        or_(KnowledgeBaseEntry.text.ilike(f"%{w}%"), KnowledgeBaseEntry.keywords.ilike(f"%{w}%"))
+        for w in words
+    ]
+    stmt = (
+        select(KnowledgeBaseEntry.message_id, KnowledgeBaseEntry.text)
+        .where(and_(*conditions))
+        .order_by(KnowledgeBaseEntry.message_id.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+    result = await session.execute(stmt)
+    return [_kb_hit(message_id, text, 0.0, query) for message_id, text in result.all()]
+
+@replica_read
+async def search_message_history(
+    session: AsyncSession,
+    query: str,
+    client_id: int | None = None,
+    limit: int = 20,
+    offset: int = 0
+) -> list[MessageLog]:
+    """Полнотекстовый поиск по переписке (ft_message_logs_text), опционально по одному клиенту."""
+    boolean_query = build_boolean_query(query)
+    if not boolean_query:
+        return []
+    relevance = match(MessageLog.text, against=boolean_query).in_boolean_mode()
+    stmt = select(MessageLog).where(relevance, MessageLog.is_deleted == False)
+    if client_id is not None:
+        stmt = stmt.where(MessageLog.client_id == client_id)
+    stmt = stmt.order_by(relevance.desc(), MessageLog.created_at.desc()).limit(limit).offset(offset)
+    result = await session.execute(stmt)
+    return result.scalars().all()
 
 # --- ФУНКЦИЯ ДЛЯ SYNC (которой сейчас не хватает) ---
 async def get_live_messages_for_sync(session: AsyncSession) -> list[MessageLog]:
@@ -49,7 +195,6 @@ async def get_live_messages_for_sync(session: AsyncSession) -> list[MessageLog]:
     time_threshold = datetime.now() - timedelta(hours=24)
     stmt = (
         select(MessageLog)
-        .join(Dialog, MessageLog.dialog_id == Dialog.id)
         .where(
             MessageLog.is_deleted == False,
             MessageLog.created_at >= time_threshold
@@ -61,6 +206,7 @@ async def get_live_messages_for_sync(session: AsyncSession) -> list[MessageLog]:
     return result.scalars().all()
 
 # --- ФУНКЦИИ ДЛЯ SLA ---
+@replica_read
 async def get_overdue_dialogs(session: AsyncSession, timeout_minutes: int):
     """Ищет активные диалоги, где ответ не дан вовремя"""
     threshold = datetime.now() - timedelta(minutes=timeout_minutes)
@@ -76,13 +222,19 @@ async def get_overdue_dialogs(session: AsyncSession, timeout_minutes: int):
     return result.scalars().all()
 
 async def reset_sla_status(session: AsyncSession, dialog_id: int):
-    """Сбрасывает таймеры SLA, когда менеджер ответил"""
-    dialog = await session.get(Dialog, dialog_id)
-    if dialog:
-        dialog.unanswered_since = None
-        dialog.sla_alert_sent = False
-        dialog.sla_last_alert_at = None # Сбрасываем время уведомления
-        await session.flush()
+    """Сбрасывает таймеры SLA, когда менеджер ответил (один UPDATE без предварительного SELECT)"""
+    stmt = (
+        update(Dialog)
+        .where(Dialog.id == dialog_id, Dialog.unanswered_since.isnot(None))
+        .values(
+            unanswered_since=None,
+            sla_alert_sent=False,
+            sla_last_alert_at=None # Сбрасываем время уведомления
+        )
+    )
+    result = await session.execute(stmt)
+    if result.rowcount:
+        on_commit(session, lambda: metrics.sla_queue_changed(-1))
 
 async def log_sla_violation(session: AsyncSession, dialog_id: int, manager_id: int, v_type: str, delay: int):
     """Записывает факт нарушения в историю."""
@@ -95,6 +247,7 @@ async def log_sla_violation(session: AsyncSession, dialog_id: int, manager_id: i
     session.add(violation)
     await session.flush()
 
+@replica_read
 async def get_all_overdue_dialogs(session: AsyncSession):
     """Получает все активные диалоги, где клиент ждет ответа."""
     stmt = select(Dialog).where(
@@ -113,6 +266,7 @@ async def update_dialog_last_client_message_time(session: AsyncSession, dialog_i
         if dialog.unanswered_since is None:
             dialog.unanswered_since = timestamp
             dialog.sla_alert_sent = False
+            on_commit(session, lambda: metrics.sla_queue_changed(1))
         await session.flush()
 
 # Обновите существующую функцию записи времени сообщения клиента:
@@ -124,6 +278,7 @@ async def update_dialog_last_client_message_time(session: AsyncSession, dialog_i
         if dialog.unanswered_since is None:
             dialog.unanswered_since = timestamp
             dialog.sla_alert_sent = False
+            on_commit(session, lambda: metrics.sla_queue_changed(1))
         await session.flush()
 
 # --- Остальной код без изменений (оставляем старый) ---
@@ -141,11 +296,17 @@ async def add_message_to_log(
     sender_role: str,
     sender_name: str,
     text: str,
+    client_id: int | None = None,
+    client_chat_id: int | None = None,
+    manager_chat_id: int | None = None,
     client_telegram_message_id: int | None = None,
     manager_telegram_message_id: int | None = None
 ) -> MessageLog:
     log_entry = MessageLog(
         dialog_id=dialog_id,
+        client_id=client_id,
+        client_chat_id=client_chat_id,
+        manager_chat_id=manager_chat_id,
         sender_role=sender_role,
         sender_name=sender_name,
         text=text,
@@ -156,39 +317,85 @@ async def add_message_to_log(
     )
     session.add(log_entry)
     await session.flush()
+    _map_log_entry(session, log_entry)
     return log_entry
 
-async def mark_message_as_deleted(session: AsyncSession, message_id: int):
-    stmt = select(MessageLog).where(
-        or_(
-            MessageLog.client_telegram_message_id == message_id,
-            MessageLog.manager_telegram_message_id == message_id
-        )
+def _map_log_entry(session: AsyncSession, log_entry: MessageLog):
+    """Записывает (чат, сообщение) обеих сторон в telegram_message_map, а после commit - в кэш."""
+    sides = (
+        ('client', log_entry.client_chat_id, log_entry.client_telegram_message_id,
+         log_entry.manager_chat_id, log_entry.manager_telegram_message_id),
+        ('manager', log_entry.manager_chat_id, log_entry.manager_telegram_message_id,
+         log_entry.client_chat_id, log_entry.client_telegram_message_id),
     )
-    result = await session.execute(stmt)
-    log_entry = result.scalar_one_or_none()
-    if log_entry:
-        log_entry.is_deleted = True
-        await session.flush()
-        return True
-    return False
+    for side, chat_id, message_id, mirror_chat_id, mirror_message_id in sides:
+        if chat_id is None or message_id is None:
+            continue
+        session.add(TelegramMessageMap(
+            chat_id=chat_id, message_id=message_id, log_id=log_entry.id, side=side,
+            mirror_chat_id=mirror_chat_id, mirror_message_id=mirror_message_id
+        ))
+        # В кэш - только после commit: при откате запись ссылалась бы на несуществующий log_id
+        ref = MessageRef(log_entry.id, side, mirror_chat_id, mirror_message_id)
+        on_commit(session, functools.partial(message_map.put, chat_id, message_id, ref))
+
+async def resolve_message(session: AsyncSession, chat_id: int, message_id: int) -> Optional[MessageRef]:
+    """(чат, сообщение) -> запись лога: из кэша или одним запросом по первичному ключу."""
+    ref = message_map.get(chat_id, message_id)
+    if ref is not None:
+        return ref
+    row = await session.get(TelegramMessageMap, (chat_id, message_id))
+    if row is None:
+        return None
+    ref = MessageRef(row.log_id, row.side, row.mirror_chat_id, row.mirror_message_id)
+    message_map.put(chat_id, message_id, ref)
+    return ref
+
+async def _get_log_entry_by_message(session: AsyncSession, chat_id: int, message_id: int, side: str) -> Optional[MessageLog]:
+    ref = await resolve_message(session, chat_id, message_id)
+    if ref is None or ref.side != side:
+        return None
+    log_entry = await session.get(MessageLog, ref.log_id)
+    if log_entry is None:
+        # Запись лога ушла в архив
+        message_map.discard(chat_id, message_id)
+    return log_entry
+
+async def mark_message_as_deleted(session: AsyncSession, chat_id: int, message_id: int) -> bool:
+    ref = await resolve_message(session, chat_id, message_id)
+    if ref is None:
+        return False
+    result = await session.execute(
+        update(MessageLog).where(MessageLog.id == ref.log_id).values(is_deleted=True)
+    )
+    return result.rowcount > 0
 
+@replica_read
 async def get_full_history_for_client(session: AsyncSession, client_id: int) -> list[MessageLog]:
     """
     Получает ПОЛНУЮ историю сообщений клиента по ВСЕМ его диалогам.
     Позволяет видеть переписку со всеми предыдущими менеджерами.
+    Старые сообщения берутся из архива (message_logs_archive).
     """
+    archived = await session.execute(
+        select(MessageLogArchive)
+        .where(
+            MessageLogArchive.client_id == client_id,
+            MessageLogArchive.is_deleted == False
+        )
+        .order_by(MessageLogArchive.created_at.asc())
+    )
     stmt = (
         select(MessageLog)
-        .join(Dialog, MessageLog.dialog_id == Dialog.id)
         .where(
-            Dialog.client_id == client_id,
+            MessageLog.client_id == client_id,
             MessageLog.is_deleted == False
         )
         .order_by(MessageLog.created_at.asc()) 
     )
     result = await session.execute(stmt)
-    return result.scalars().all()
+    # Архив всегда старше живых логов, поэтому достаточно склеить списки
+    return list(archived.scalars().all()) + list(result.scalars().all())
 
 async def get_or_create_user(session: AsyncSession, aiogram_user: AiogramUser, role: str = 'client') -> User:
     stmt = select(User).where(User.telegram_id == aiogram_user.id)
@@ -222,6 +429,20 @@ async def get_or_create_user(session: AsyncSession, aiogram_user: AiogramUser, r
 async def get_user_by_telegram_id(session: AsyncSession, telegram_id: int) -> Optional[User]:
     return await session.get(User, telegram_id)
 
+async def is_staff_member(session: AsyncSession, telegram_id: int) -> bool:
+    """Сотрудник ли пользователь: есть в таблице сотрудников или имеет роль менеджера/супервайзера."""
+    employee_id = await session.scalar(
+        select(Employee.id).where(Employee.personal_telegram_id == telegram_id).limit(1)
+    )
+    if employee_id is not None:
+        return True
+    role = await session.scalar(select(User.role).where(User.telegram_id == telegram_id))
+    return role in ('manager', 'supervisor')
+
+async def is_supervisor(session: AsyncSession, telegram_id: int) -> bool:
+    role = await session.scalar(select(User.role).where(User.telegram_id == telegram_id))
+    return role == 'supervisor'
+
 async def set_manager_status(session: AsyncSession, user_id: int, status: str):
     user = await session.get(User, user_id)
     if user and user.role in ('manager', 'supervisor'):
@@ -282,10 +503,63 @@ async def find_last_dialog_for_client(session: AsyncSession, client_id: int) ->
     result = await session.execute(stmt)
     return result.scalars().first()
 
-async def find_dialog_by_topic(session: AsyncSession, topic_id: int) -> Optional[Dialog]:
-    stmt = select(Dialog).where(Dialog.manager_topic_id == topic_id)
+async def find_dialog_by_topic(session: AsyncSession, chat_id: int, topic_id: int) -> Optional[Dialog]:
+    """Ищет диалог по паре (чат менеджера, топик): ID топиков уникальны только внутри чата."""
+    stmt = (
+        select(Dialog)
+        .where(Dialog.manager_chat_id == chat_id, Dialog.manager_topic_id == topic_id)
+        .options(joinedload(Dialog.client))
+    )
     result = await session.execute(stmt)
     return result.scalar_one_or_none()
+
+def _index_dialog(dialog: Dialog, client_chat_id: int):
+    topic_index.put(
+        dialog.manager_chat_id,
+        dialog.manager_topic_id,
+        DialogRef(
+            dialog_id=dialog.id,
+            client_id=dialog.client_id,
+            client_chat_id=client_chat_id,
+            status=dialog.status
+        )
+    )
+
+async def resolve_dialog_by_topic(session: AsyncSession, chat_id: int, topic_id: int) -> Optional[DialogRef]:
+    """
+    Находит диалог топика через горячий индекс в памяти.
+    В БД идем только при промахе (после рестарта, вытеснения или истечения TTL).
+    """
+    ref = topic_index.get(chat_id, topic_id)
+    if ref is not None:
+        return ref
+
+    dialog = await find_dialog_by_topic(session, chat_id, topic_id)
+    if not dialog or not dialog.client:
+        return None
+    _index_dialog(dialog, dialog.client.telegram_id)
+    return topic_index.get(chat_id, topic_id)
+
+async def warm_topic_index(session: AsyncSession) -> int:
+    """Загружает в индекс все незакрытые диалоги (при старте бота)."""
+    stmt = (
+        select(Dialog)
+        .where(Dialog.status.in_(('new', 'active', 'escalated')))
+        .options(joinedload(Dialog.client))
+    )
+    result = await session.execute(stmt)
+    dialogs = result.scalars().all()
+    for dialog in dialogs:
+        if dialog.client:
+            _index_dialog(dialog, dialog.client.telegram_id)
+    return len(dialogs)
+
+async def update_dialog_topic(session: AsyncSession, dialog: Dialog, topic_id: int):
+    """Привязывает диалог к новому топику (старый был удален вручную)."""
+    dialog.manager_topic_id = topic_id
+    await session.flush()
+    dialog_id, chat_id = dialog.id, dialog.manager_chat_id
+    on_commit(session, lambda: topic_index.move(dialog_id, chat_id, topic_id))
     
 async def get_dialog_by_id(session: AsyncSession, dialog_id: int) -> Optional[Dialog]:
     stmt = (
@@ -306,23 +580,36 @@ async def create_dialog(session: AsyncSession, client_id: int, manager_id: int,
     )
     session.add(new_dialog)
     await session.flush()
+    on_commit(session, lambda: metrics.dialog_status_changed(None, 'active'))
+
+    # Клиент уже загружен в этой сессии - берется из identity map без запроса
+    client = await session.get(User, client_id)
+    if client:
+        client_chat_id = client.telegram_id
+        on_commit(session, lambda: _index_dialog(new_dialog, client_chat_id))
     return new_dialog
 
 async def update_dialog_status(session: AsyncSession, dialog_id: int, new_status: str):
     dialog = await session.get(Dialog, dialog_id)
     if dialog:
+        old_status = dialog.status
         dialog.status = new_status
+        dialog.resolved_at = datetime.now() if new_status in ('resolved', 'transferred') else None
         await session.flush()
+        # Индекс и счетчики - только после commit: при откате в них остался бы несохраненный статус
+        on_commit(session, lambda: topic_index.set_status(dialog_id, new_status))
+        on_commit(session, lambda: metrics.dialog_status_changed(old_status, new_status))
 
-async def get_log_entry_by_client_msg_id(session: AsyncSession, client_msg_id: int) -> Optional[MessageLog]:
-    stmt = select(MessageLog).where(MessageLog.client_telegram_message_id == client_msg_id)
-    result = await session.execute(stmt)
-    return result.scalar_one_or_none()
+async def count_dialogs_by_status(session: AsyncSession) -> dict[str, int]:
+    """Диалоги по статусам для метрик: при старте и для периодического выравнивания."""
+    result = await session.execute(select(Dialog.status, func.count(Dialog.id)).group_by(Dialog.status))
+    return {status: count for status, count in result.all()}
 
-async def get_log_entry_by_manager_msg_id(session: AsyncSession, manager_msg_id: int) -> Optional[MessageLog]:
-    stmt = select(MessageLog).where(MessageLog.manager_telegram_message_id == manager_msg_id)
-    result = await session.execute(stmt)
-    return result.scalar_one_or_none()
+async def get_log_entry_by_client_msg_id(session: AsyncSession, client_chat_id: int, client_msg_id: int) -> Optional[MessageLog]:
+    return await _get_log_entry_by_message(session, client_chat_id, client_msg_id, 'client')
+
+async def get_log_entry_by_manager_msg_id(session: AsyncSession, manager_chat_id: int, manager_msg_id: int) -> Optional[MessageLog]:
+    return await _get_log_entry_by_message(session, manager_chat_id, manager_msg_id, 'manager')
 
 async def update_log_text(session: AsyncSession, log_entry: MessageLog, new_text: str):
     log_entry.text = new_text
@@ -339,6 +626,7 @@ async def create_note(session: AsyncSession, dialog_id: int, author_id: int, tex
     await session.flush()
     return new_note
 
+@replica_read
 async def get_notes_by_dialog(session: AsyncSession, dialog_id: int) -> list[Note]:
     """Получает список всех заметок по конкретному диалогу."""
     stmt = (
@@ -351,6 +639,7 @@ async def get_notes_by_dialog(session: AsyncSession, dialog_id: int) -> list[Not
     return result.scalars().all()
 
 
+@replica_read
 async def get_all_notes_for_client(session: AsyncSession, dialog_id: int) -> list[Note]:
     """
     Получает ВСЕ заметки по клиенту, зная ID любого его диалога.
@@ -382,4 +671,222 @@ async def get_all_cities(session: AsyncSession) -> list[City]:
 
 async def get_city_by_id(session: AsyncSession, city_id: int) -> Optional[City]:
     """Получает город по ID."""
-    return await session.get(City, city_id)
\ No newline at end of file
+    return await session.get(City, city_id)
+
+# --- АРХИВАЦИЯ И СВЕРТКА (RETENTION) ---
+_ARCHIVE_COLUMNS = [
+    'id', 'dialog_id', 'client_id', 'client_chat_id', 'manager_chat_id',
+    'client_telegram_message_id', 'manager_telegram_message_id',
+    'sender_role', 'sender_name', 'text', 'created_at', 'is_deleted', 'is_edited'
+]
+
+async def archive_resolved_dialog_logs(session: AsyncSession, older_than_days: int, batch_size: int) -> int:
+    """
+    Переносит ОДНУ пачку сообщений закрытых давно диалогов в message_logs_archive.
+    Возвращает количество перенесенных строк (0 - переносить больше нечего).
+    """
+    threshold = datetime.now() - timedelta(days=older_than_days)
+    ids_stmt = (
+        select(MessageLog.id)
+        .join(Dialog, MessageLog.dialog_id == Dialog.id)
+        .where(
+            Dialog.status.in_(('resolved', 'transferred')),
+            Dialog.resolved_at <= threshold
+        )
+        .order_by(MessageLog.id.asc())
+        .limit(batch_size)
+    )
+    ids = list((await session.execute(ids_stmt)).scalars().all())
+    if not ids:
+        return 0
+
+    source = select(*[getattr(MessageLog, c) for c in _ARCHIVE_COLUMNS]).where(MessageLog.id.in_(ids))
+    # IGNORE - на случай повторного запуска после сбоя между INSERT и DELETE
+    await session.execute(
+        insert(MessageLogArchive).prefix_with('IGNORE').from_select(_ARCHIVE_COLUMNS, source)
+    )
+    # Правки и удаления архивных сообщений больше не синхронизируются - соответствия не нужны
+    await session.execute(delete(TelegramMessageMap).where(TelegramMessageMap.log_id.in_(ids)))
+    await session.execute(delete(MessageLog).where(MessageLog.id.in_(ids)))
+    return len(ids)
+
+async def rollup_sla_violations(session: AsyncSession, older_than_days: int, batch_size: int) -> int:
+    """
+    Сворачивает ОДНУ пачку старых нарушений SLA в дневные агрегаты и удаляет сырые записи.
+    Возвращает количество свернутых строк.
+    """
+    threshold = datetime.combine(datetime.now().date() - timedelta(days=older_than_days), datetime.min.time())
+    ids_stmt = (
+        select(SLAViolation.id)
+        .where(SLAViolation.created_at < threshold)
+        .order_by(SLAViolation.id.asc())
+        .limit(batch_size)
+    )
+    ids = list((await session.execute(ids_stmt)).scalars().all())
+    if not ids:
+        return 0
+
+    day = func.date(SLAViolation.created_at)
+    manager_id = func.coalesce(SLAViolation.manager_id, 0)
+    violation_type = func.coalesce(SLAViolation.violation_type, '')
+    agg_stmt = (
+        select(
+            day.label('day'),
+            SLAViolation.dialog_id,
+            manager_id.label('manager_id'),
+            violation_type.label('violation_type'),
+            func.count(SLAViolation.id).label('violations_count'),
+            func.coalesce(func.max(SLAViolation.minutes_delayed), 0).label('max_minutes_delayed')
+        )
+        .where(SLAViolation.id.in_(ids))
+        .group_by(day, SLAViolation.dialog_id, manager_id, violation_type)
+    )
+    rows = [dict(row) for row in (await session.execute(agg_stmt)).mappings().all()]
+
+    upsert = mysql_insert(SLAViolationDaily).values(rows)
+    upsert = upsert.on_duplicate_key_update(
+        violations_count=SLAViolationDaily.violations_count + upsert.inserted.violations_count,
+        max_minutes_delayed=func.greatest(SLAViolationDaily.max_minutes_delayed, upsert.inserted.max_minutes_delayed)
+    )
+    await session.execute(upsert)
+    await session.execute(delete(SLAViolation).where(SLAViolation.id.in_(ids)))
+    return len(ids)
+
+# --- Outbox ---
+
+async def add_outbox_message(
+    session: AsyncSession, idempotency_key: str, queue: str, payload: dict, dialog_id: int | None = None
+) -> bool:
+    """
+    Кладет сообщение в outbox (коммит - на вызывающей стороне, вместе с бизнес-данными).
+    Возвращает False, если сообщение с таким ключом уже есть (повторное подтверждение).
+    """
+    stmt = mysql_insert(OutboxMessage).values(
+        idempotency_key=idempotency_key,
+        dialog_id=dialog_id,
+        queue=queue,
+        payload=json.dumps(payload, ensure_ascii=False),
+        status='pending',
+        attempts=0,
+        next_attempt_at=datetime.now()
+    ).prefix_with('IGNORE')
+    result = await session.execute(stmt)
+    return result.rowcount > 0
+
+async def get_outbox_batch(session: AsyncSession, batch_size: int) -> list[OutboxMessage]:
+    """
+    Пачка сообщений, которые пора отправить. SKIP LOCKED - чтобы несколько реплик
+    бота не отправляли одни и те же строки одновременно.
+    """
+    stmt = (
+        select(OutboxMessage)
+        .where(OutboxMessage.status == 'pending', OutboxMessage.next_attempt_at <= datetime.now())
+        .order_by(OutboxMessage.id.asc())
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return list((await session.execute(stmt)).scalars().all())
+
+async def mark_outbox_sent(session: AsyncSession, ids: list[int]):
+    if ids:
+        await session.execute(
+            update(OutboxMessage)
+            .where(OutboxMessage.id.in_(ids))
+            .values(status='sent', sent_at=datetime.now(), last_error=None)
+        )
+
+async def mark_outbox_retry(session: AsyncSession, messages: list[OutboxMessage], error: str, base_seconds: int, max_seconds: int):
+    """Откладывает сообщения с экспоненциальным backoff. Сообщения не отбрасываются никогда."""
+    now = datetime.now()
+    for message in messages:
+        message.attempts += 1
+        delay = min(base_seconds * 2 ** (message.attempts - 1), max_seconds)
+        message.next_attempt_at = now + timedelta(seconds=delay)
+        message.last_error = error[:1000]
+
+async def delete_sent_outbox_messages(session: AsyncSession, older_than_days: int, batch_size: int) -> int:
+    """Удаляет ОДНУ пачку давно доставленных сообщений outbox."""
+    threshold = datetime.now() - timedelta(days=older_than_days)
+    ids_stmt = (
+        select(OutboxMessage.id)
+        .where(OutboxMessage.status == 'sent', OutboxMessage.sent_at < threshold)
+        .order_by(OutboxMessage.id.asc())
+        .limit(batch_size)
+    )
+    ids = list((await session.execute(ids_stmt)).scalars().all())
+    if ids:
+        await session.execute(delete(OutboxMessage).where(OutboxMessage.id.in_(ids)))
+    return len(ids)
+
+# --- Сделки (обратная связь от обработчика заявок) ---
+
+async def apply_deal_events(session: AsyncSession, events: list[dict]) -> list[dict]:
+    """
+    Сохраняет пачку событий {deals_id, topic_id, status, ...} одним INSERT ... ON DUPLICATE KEY UPDATE.
+    Сделка привязывается к диалогу по dialog_id из события, а если его нет - по ключу заявки в outbox.
+    Возвращает сделки диалогов, у которых сменился статус (для уведомления в топик менеджера).
+    """
+    # Несколько событий одной сделки в пачке: итог - последнее состояние
+    latest: dict[int, dict] = {}
+    for event in events:
+        merged = latest.setdefault(event['deals_id'], {})
+        merged.update({name: value for name, value in event.items() if value is not None})
+    if not latest:
+        return []
+
+    existing = {
+        row.deals_id: row
+        for row in (await session.execute(
+            select(Deal.deals_id, Deal.status, Deal.dialog_id).where(Deal.deals_id.in_(list(latest)))
+        )).all()
+    }
+    keys = {e['idempotency_key'] for e in latest.values() if not e.get('dialog_id') and e.get('idempotency_key')}
+    dialog_by_key = {}
+    if keys:
+        dialog_by_key = dict((await session.execute(
+            select(OutboxMessage.idempotency_key, OutboxMessage.dialog_id).where(OutboxMessage.idempotency_key.in_(keys))
+        )).all())
+
+    rows = []
+    for deals_id, event in latest.items():
+        known = existing.get(deals_id)
+        rows.append({
+            'deals_id': deals_id,
+            'dialog_id': event.get('dialog_id') or (known.dialog_id if known else None) or dialog_by_key.get(event.get('idempotency_key')),
+            'idempotency_key': event.get('idempotency_key'),
+            'topic_id': event.get('topic_id'),
+            'original_message_id': event.get('original_message_id'),
+            'status': event.get('status'),
+        })
+
+    stmt = mysql_insert(Deal).values(rows)
+    stmt = stmt.on_duplicate_key_update(
+        status=func.coalesce(stmt.inserted.status, Deal.status),
+        topic_id=func.coalesce(stmt.inserted.topic_id, Deal.topic_id),
+        original_message_id=func.coalesce(stmt.inserted.original_message_id, Deal.original_message_id),
+        dialog_id=func.coalesce(Deal.dialog_id, stmt.inserted.dialog_id),
+        idempotency_key=func.coalesce(Deal.idempotency_key, stmt.inserted.idempotency_key),
+        updated_at=func.now()
+    )
+    await session.execute(stmt)
+
+    changed = [
+        row for row in rows
+        if row['status'] and row['dialog_id']
+        and (row['deals_id'] not in existing or existing[row['deals_id']].status != row['status'])
+    ]
+    if not changed:
+        return []
+
+    dialogs = {
+        row.id: row
+        for row in (await session.execute(
+            select(Dialog.id, Dialog.manager_chat_id, Dialog.manager_topic_id)
+            .where(Dialog.id.in_({row['dialog_id'] for row in changed}))
+        )).all()
+    }
+    return [
+        {**row, 'manager_chat_id': dialogs[row['dialog_id']].manager_chat_id,
+         'manager_topic_id': dialogs[row['dialog_id']].manager_topic_id}
+        for row in changed if row['dialog_id'] in dialogs
+    ]
@@ -0,0 +1,40 @@
+"""
+Действия, которые выполняются только после успешного commit сессии.
+
+Состояние в памяти процесса (индекс топиков, счетчики метрик) должно меняться
+вместе с данными в БД: функции db/commands.py откладывают такие изменения через
+on_commit(session, callback). Если транзакция откатилась или сессию закрыли
+без commit, отложенные действия отбрасываются.
+"""
+import logging
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, SessionTransaction
+
+log = logging.getLogger(__name__)
+
+# Ключ в session.info со списком отложенных действий
+PENDING_KEY = "on_commit"
+
+
+def on_commit(session: AsyncSession, callback: Callable[[], None]):
+    """Выполнит callback после commit текущей транзакции сессии (в порядке добавления)."""
+    session.info.setdefault(PENDING_KEY, []).append(callback)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_pending(session: Session):
+    for callback in session.info.pop(PENDING_KEY, ()):
+        try:
+            callback()
+        except Exception as e:
+            log.error(f"[DB] After-commit action failed: {e}")
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _discard_pending(session: Session, transaction: SessionTransaction):
+    # Внешняя транзакция закончилась без commit (rollback, close) - изменения не применяем
+    if transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
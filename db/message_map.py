@@ -0,0 +1,50 @@
+"""
+Кэш соответствий (чат, сообщение Telegram) -> запись message_logs в памяти процесса.
+
+ID сообщений в Telegram уникальны только внутри чата, поэтому сообщение
+определяется парой (chat_id, message_id). Пара пишется в telegram_message_map
+при отправке (db/commands.add_message_to_log), а последние сообщения держатся
+здесь: правка или удаление свежего сообщения находит запись лога без поиска
+по message_logs.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class MessageRef:
+    """Куда ведет сообщение: запись лога, сторона и его "зеркало" в другом чате."""
+    log_id: int
+    side: str  # 'client' или 'manager'
+    mirror_chat_id: Optional[int]
+    mirror_message_id: Optional[int]
+
+
+class MessageMapCache:
+    def __init__(self, max_size: int = 50000):
+        self.max_size = max_size
+        self._refs: OrderedDict[tuple[int, int], MessageRef] = OrderedDict()
+
+    def configure(self, max_size: int):
+        self.max_size = max_size
+
+    def get(self, chat_id: int, message_id: int) -> Optional[MessageRef]:
+        key = (chat_id, message_id)
+        ref = self._refs.get(key)
+        if ref is not None:
+            self._refs.move_to_end(key)
+        return ref
+
+    def put(self, chat_id: int, message_id: int, ref: MessageRef):
+        key = (chat_id, message_id)
+        self._refs[key] = ref
+        self._refs.move_to_end(key)
+        while len(self._refs) > self.max_size:
+            self._refs.popitem(last=False)
+
+    def discard(self, chat_id: int, message_id: int):
+        self._refs.pop((chat_id, message_id), None)
+
+
+message_map = MessageMapCache()
@@ -6,11 +6,14 @@ from sqlalchemy import (
     String,
     Enum,
     DateTime,
+    Date,
     ForeignKey,
     Text,
     func,
     Table,
-    Boolean
+    Boolean,
+    Index,
+    UniqueConstraint
 )
 from sqlalchemy.orm import DeclarativeBase, relationship
 
@@ -55,6 +58,10 @@ class User(Base):
 class Dialog(Base):
     """Модель диалога между клиентом/партнером и менеджером."""
     __tablename__ = 'dialogs'
+    __table_args__ = (
+        # ID топика уникален только внутри конкретного чата менеджера
+        UniqueConstraint('manager_chat_id', 'manager_topic_id', name='ux_dialogs_chat_topic'),
+    )
 
     id = Column(Integer, primary_key=True)
     client_id = Column(Integer, ForeignKey('users.id'), nullable=False)
@@ -75,12 +82,15 @@ class Dialog(Base):
 
     unanswered_since = Column(DateTime, nullable=True) 
     sla_alert_sent = Column(Boolean, default=False)
+    # Когда диалог был закрыт (resolved/transferred) - по нему работает архивация логов
+    resolved_at = Column(DateTime, nullable=True, index=True)
 
     # Отношения
     client = relationship("User", foreign_keys=[client_id])
     manager = relationship("User", foreign_keys=[manager_id])
     messages = relationship("Message", back_populates="dialog", cascade="all, delete-orphan")
     notes = relationship("Note", back_populates="dialog", cascade="all, delete-orphan")
+    deals = relationship("Deal", back_populates="dialog")
     sla_last_alert_at = Column(DateTime, nullable=True)
 
     def __repr__(self):
@@ -105,7 +115,23 @@ class SLAViolation(Base):
     manager_id = Column(Integer, ForeignKey('users.id'), nullable=True)
     violation_type = Column(String(50)) 
     minutes_delayed = Column(Integer)
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, default=func.now(), index=True)
+
+
+class SLAViolationDaily(Base):
+    """Дневные агрегаты старых нарушений SLA (сырые записи после свертки удаляются)."""
+    __tablename__ = 'sla_violations_daily'
+    __table_args__ = (
+        UniqueConstraint('day', 'dialog_id', 'manager_id', 'violation_type', name='ux_sla_daily'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    dialog_id = Column(Integer, nullable=False, index=True)
+    manager_id = Column(Integer, nullable=False, default=0, index=True)  # 0 - менеджер не назначен
+    violation_type = Column(String(50), nullable=False)
+    violations_count = Column(Integer, nullable=False, default=0)
+    max_minutes_delayed = Column(Integer, nullable=False, default=0)
 
 class Message(Base):
     """Модель сообщения в рамках диалога."""
@@ -182,9 +208,21 @@ class MessageLog(Base):
     """Модель для логирования всех сообщений диалога для истории."""
     __tablename__ = 'message_logs'
 
+    __table_args__ = (
+        Index('ix_message_logs_client_created', 'client_id', 'created_at'),
+        Index('ix_message_logs_client_chat_msg', 'client_chat_id', 'client_telegram_message_id'),
+        Index('ix_message_logs_manager_chat_msg', 'manager_chat_id', 'manager_telegram_message_id'),
+        Index('ft_message_logs_text', 'text', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
+
     id = Column(Integer, primary_key=True)
     dialog_id = Column(Integer, ForeignKey('dialogs.id'), nullable=False, index=True)
 
+    # Денормализованные поля диалога, чтобы не делать JOIN/доп. запрос к dialogs
+    client_id = Column(Integer, ForeignKey('users.id', name='fk_message_logs_client_id'), nullable=True)
+    client_chat_id = Column(BigInteger, nullable=True)   # Личный чат клиента с ботом
+    manager_chat_id = Column(BigInteger, nullable=True)  # Рабочий чат менеджера
+
     # ID оригинального сообщения от клиента в его личном чате с ботом
     client_telegram_message_id = Column(BigInteger, nullable=True, index=True)
     # ID "зеркального" сообщения в чате (топике) менеджера
@@ -204,9 +242,60 @@ class MessageLog(Base):
     def __repr__(self):
         return f"<MessageLog(id={self.id}, dialog_id={self.dialog_id}, from='{self.sender_role}')>"
 
+class TelegramMessageMap(Base):
+    """
+    Соответствие сообщения Telegram записи лога: ключ - (chat_id, message_id),
+    т.к. ID сообщений уникальны только внутри чата. Для каждой записи лога -
+    по строке на сообщение клиента и на его зеркало в топике менеджера.
+    """
+    __tablename__ = 'telegram_message_map'
+
+    chat_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    message_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    log_id = Column(Integer, ForeignKey('message_logs.id'), nullable=False, index=True)
+    side = Column(Enum('client', 'manager', name='message_side_enum'), nullable=False)
+    # Это же сообщение на другой стороне (у клиента или в топике менеджера)
+    mirror_chat_id = Column(BigInteger, nullable=True)
+    mirror_message_id = Column(BigInteger, nullable=True)
+
+    def __repr__(self):
+        return f"<TelegramMessageMap(chat_id={self.chat_id}, message_id={self.message_id}, log_id={self.log_id})>"
+
+class MessageLogArchive(Base):
+    """
+    Архив сообщений давно закрытых диалогов.
+    Структура повторяет message_logs (id сохраняется), но без внешних ключей,
+    чтобы перенос пачками был дешевым.
+    """
+    __tablename__ = 'message_logs_archive'
+    __table_args__ = (
+        Index('ix_message_logs_archive_client_created', 'client_id', 'created_at'),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    dialog_id = Column(Integer, nullable=False, index=True)
+    client_id = Column(Integer, nullable=True)
+    client_chat_id = Column(BigInteger, nullable=True)
+    manager_chat_id = Column(BigInteger, nullable=True)
+    client_telegram_message_id = Column(BigInteger, nullable=True)
+    manager_telegram_message_id = Column(BigInteger, nullable=True)
+    sender_role = Column(String(50), nullable=False)
+    sender_name = Column(String(255), nullable=False)
+    text = Column(Text, nullable=False)
+    created_at = Column(DateTime)
+    is_deleted = Column(Boolean, default=False, nullable=False)
+    is_edited = Column(Boolean, default=False, nullable=False)
+    archived_at = Column(DateTime, default=func.now())
+
+    def __repr__(self):
+        return f"<MessageLogArchive(id={self.id}, dialog_id={self.dialog_id}, from='{self.sender_role}')>"
+
 class KnowledgeBaseEntry(Base):
     """Модель для хранения ссылок на посты в канале Базы Знаний."""
     __tablename__ = 'knowledge_base'
+    __table_args__ = (
+        Index('ft_knowledge_base_text', 'text', 'keywords', mysql_prefix='FULLTEXT', mysql_with_parser='ngram'),
+    )
 
     id = Column(Integer, primary_key=True)
     message_id = Column(BigInteger, unique=True, nullable=False) # ID сообщения в канале
@@ -216,4 +305,55 @@ class KnowledgeBaseEntry(Base):
 
     def __repr__(self):
         return f"<KB(id={self.message_id})>"
-  
\ No newline at end of file
+  
+
+class OutboxMessage(Base):
+    """
+    Исходящее сообщение во внешнюю очередь Redis (transactional outbox).
+    Пишется в той же транзакции, что и бизнес-данные; в Redis его доставляет
+    фоновый relay (scheduler.outbox_relay_job) с повторами и backoff.
+    """
+    __tablename__ = 'outbox_messages'
+    __table_args__ = (
+        Index('ix_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # Ключ идемпотентности: повторное подтверждение той же заявки не создаст вторую запись,
+    # а потребитель очереди по нему отбрасывает повторные доставки
+    idempotency_key = Column(String(64), unique=True, nullable=False)
+    dialog_id = Column(Integer, ForeignKey('dialogs.id'), nullable=True, index=True)
+    queue = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)
+    status = Column(Enum('pending', 'sent', name='outbox_status_enum'), default='pending', nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, default=func.now(), nullable=False)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, key='{self.idempotency_key}', status='{self.status}')>"
+
+
+class Deal(Base):
+    """
+    Сделка, созданная обработчиком заявок (CryptoDeals) по заявке из диалога.
+    Статусы приходят событиями из Redis (services/deal_events.py); заменяет topic_data.json.
+    """
+    __tablename__ = 'deals'
+
+    id = Column(Integer, primary_key=True)
+    deals_id = Column(BigInteger, unique=True, nullable=False)  # ID сделки в CryptoDeals
+    dialog_id = Column(Integer, ForeignKey('dialogs.id'), nullable=True, index=True)
+    idempotency_key = Column(String(64), nullable=True, index=True)  # Ключ заявки из outbox
+    topic_id = Column(BigInteger, nullable=True, index=True)  # Тема сделки у обработчика
+    original_message_id = Column(BigInteger, nullable=True)
+    status = Column(String(64), nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    dialog = relationship("Dialog", back_populates="deals")
+
+    def __repr__(self):
+        return f"<Deal(deals_id={self.deals_id}, dialog_id={self.dialog_id}, status='{self.status}')>"
@@ -0,0 +1,148 @@
+"""
+Маршрутизация запросов между основной БД и репликой.
+
+Тяжелые read-only запросы (история, заметки, База Знаний, SLA) помечаются
+декоратором `replica_read` и уходят на реплику, если она настроена и не отстает.
+Рабочие сессии бота привязаны к основной БД: все записи идут только туда,
+а на реплику ходит отдельная короткая сессия внутри `replica_read`.
+"""
+import functools
+import logging
+from typing import Optional
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import InstanceState
+
+from config import Settings
+
+log = logging.getLogger(__name__)
+
+# Ключ в session.info, которым помечается сессия реплики
+USE_REPLICA_KEY = "use_replica"
+
+
+class ReplicaRouter:
+    """Хранит движки и текущее состояние реплики (жива/отстает)."""
+
+    def __init__(self):
+        self.primary: Optional[AsyncEngine] = None
+        self.replica: Optional[AsyncEngine] = None
+        self.healthy: bool = False
+
+    def configure(self, primary: AsyncEngine, replica: Optional[AsyncEngine] = None):
+        self.primary = primary
+        self.replica = replica
+        self.healthy = replica is not None
+
+    @property
+    def replica_available(self) -> bool:
+        return self.replica is not None and self.healthy
+
+    def mark_unhealthy(self, reason: str):
+        if self.healthy:
+            log.warning(f"[Replica] Отключаю реплику: {reason}")
+        self.healthy = False
+
+    def replica_session(self) -> AsyncSession:
+        """Отдельная сессия на реплике для одного вызова replica_read."""
+        return AsyncSession(self.replica, expire_on_commit=False, info={USE_REPLICA_KEY: True})
+
+    def mark_healthy(self):
+        if not self.healthy:
+            log.info("[Replica] Реплика снова в работе.")
+        self.healthy = True
+
+
+router = ReplicaRouter()
+
+
+async def _attach(session: AsyncSession, result):
+    """
+    Переносит ORM-объекты, прочитанные отдельной сессией реплики, в сессию вызывающего
+    (merge без запросов в БД): их изменения сохранит его commit, как и раньше.
+    """
+    if isinstance(result, (list, tuple)):
+        return [await _attach(session, item) for item in result]
+    if isinstance(inspect(result, raiseerr=False), InstanceState):
+        return await session.merge(result, load=False)
+    return result
+
+
+def replica_read(func):
+    """
+    Декоратор для read-only функций из db/commands.py.
+    Выполняет функцию в отдельной короткой сессии на реплике, а при ошибке реплики -
+    в сессии вызывающего на основной БД. Ошибка не затрагивает транзакцию вызывающего:
+    в общей сессии сбой соединения реплики оставил бы ее в PendingRollbackError.
+    """
+    @functools.wraps(func)
+    async def wrapper(session: AsyncSession, *args, **kwargs):
+        # Реплики нет или мы уже внутри другой replica-функции
+        if not router.replica_available or session.info.get(USE_REPLICA_KEY):
+            return await func(session, *args, **kwargs)
+
+        try:
+            async with router.replica_session() as replica_session:
+                result = await func(replica_session, *args, **kwargs)
+            return await _attach(session, result)
+        except DBAPIError as e:
+            router.mark_unhealthy(f"{func.__name__}: {type(e).__name__}: {e}")
+
+        # Фолбэк на основную БД
+        return await func(session, *args, **kwargs)
+
+    return wrapper
+
+
+def create_session_pool(settings: Settings) -> async_sessionmaker:
+    """Создает движки (основной и, если задан, реплику) и фабрику сессий."""
+    primary = create_async_engine(settings.db_url, echo=False, pool_pre_ping=True)
+    replica = None
+    if settings.db_replica_url:
+        replica = create_async_engine(settings.db_replica_url, echo=False, pool_pre_ping=True)
+    router.configure(primary, replica)
+
+    return async_sessionmaker(primary, expire_on_commit=False)
+
+
+async def dispose_engines():
+    if router.replica is not None:
+        await router.replica.dispose()
+    if router.primary is not None:
+        await router.primary.dispose()
+
+
+async def check_replica_lag_job(settings: Settings):
+    """
+    Проверяет отставание реплики. Если отставание больше допустимого
+    или репликация остановлена, чтения временно идут на основную БД.
+    """
+    if router.replica is None:
+        return
+
+    try:
+        async with router.replica.connect() as conn:
+            try:
+                result = await conn.execute(text("SHOW REPLICA STATUS"))
+            except DBAPIError:
+                # MySQL < 8.0.22
+                result = await conn.execute(text("SHOW SLAVE STATUS"))
+            row = result.mappings().first()
+    except Exception as e:
+        router.mark_unhealthy(f"проверка лага: {type(e).__name__}: {e}")
+        return
+
+    if row is None:
+        # Не реплика в классическом смысле (прокси, managed-кластер) - лаг не известен
+        router.mark_healthy()
+        return
+
+    lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+    if lag is None:
+        router.mark_unhealthy("репликация остановлена")
+    elif lag > settings.db_replica_max_lag_seconds:
+        router.mark_unhealthy(f"лаг {lag} с")
+    else:
+        router.mark_healthy()
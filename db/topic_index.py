@@ -0,0 +1,89 @@
+"""
+Горячий индекс (чат менеджера, топик) -> диалог в памяти процесса.
+
+Каждое сообщение менеджера в топике должно находить свой диалог без запроса в БД.
+Индекс обновляется функциями db/commands.py при создании диалога, смене статуса
+и восстановлении топика - после commit (db/hooks.py), чтобы откат не оставил в нем
+несохраненных изменений. Поэтому записи по умолчанию не истекают и вытесняются только
+по размеру (LRU). Если диалоги меняют и другие реплики бота, TTL ограничивает время,
+за которое их изменения подхватываются.
+"""
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class DialogRef:
+    """Минимум данных о диалоге, нужный для пересылки ответа менеджера клиенту."""
+    dialog_id: int
+    client_id: int
+    client_chat_id: int
+    status: str
+    cached_at: float = field(default_factory=time.monotonic)
+
+
+class TopicIndex:
+    def __init__(self, max_size: int = 20000, ttl_seconds: int = 0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._by_topic: OrderedDict[tuple[int, int], DialogRef] = OrderedDict()
+        self._topic_by_dialog: dict[int, tuple[int, int]] = {}
+
+    def configure(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, chat_id: int, topic_id: int) -> Optional[DialogRef]:
+        key = (chat_id, topic_id)
+        ref = self._by_topic.get(key)
+        if ref is None:
+            return None
+        # ttl_seconds = 0 - без истечения
+        if self.ttl_seconds and time.monotonic() - ref.cached_at > self.ttl_seconds:
+            self._remove(key)
+            return None
+        self._by_topic.move_to_end(key)
+        return ref
+
+    def put(self, chat_id: int, topic_id: int, ref: DialogRef):
+        # Диалог мог раньше жить в другом топике (восстановление)
+        old_key = self._topic_by_dialog.get(ref.dialog_id)
+        if old_key is not None and old_key != (chat_id, topic_id):
+            self._by_topic.pop(old_key, None)
+
+        key = (chat_id, topic_id)
+        previous = self._by_topic.get(key)
+        if previous is not None and previous.dialog_id != ref.dialog_id:
+            self._topic_by_dialog.pop(previous.dialog_id, None)
+
+        self._by_topic[key] = ref
+        self._by_topic.move_to_end(key)
+        self._topic_by_dialog[ref.dialog_id] = key
+
+        while len(self._by_topic) > self.max_size:
+            evicted_key, evicted = self._by_topic.popitem(last=False)
+            self._topic_by_dialog.pop(evicted.dialog_id, None)
+
+    def set_status(self, dialog_id: int, status: str):
+        key = self._topic_by_dialog.get(dialog_id)
+        if key is not None and key in self._by_topic:
+            self._by_topic[key].status = status
+
+    def move(self, dialog_id: int, chat_id: int, topic_id: int):
+        key = self._topic_by_dialog.get(dialog_id)
+        ref = self._by_topic.get(key) if key is not None else None
+        if ref is not None:
+            self.put(chat_id, topic_id, ref)
+
+    def _remove(self, key: tuple[int, int]):
+        ref = self._by_topic.pop(key, None)
+        if ref is not None:
+            self._topic_by_dialog.pop(ref.dialog_id, None)
+
+    def __len__(self):
+        return len(self._by_topic)
+
+
+topic_index = TopicIndex()
@@ -0,0 +1,153 @@
+"""
+Массовая загрузка Базы Знаний из экспорта канала.
+
+Поддерживаются:
+- экспорт Telegram Desktop (result.json: {"name": ..., "messages": [...]});
+- JSONL: по одному сообщению на строку (формат экспорта или {"message_id": ..., "text": ...}).
+
+Файл читается потоково, посты пишутся пачками через INSERT ... ON DUPLICATE KEY UPDATE,
+поэтому память не растет с размером экспорта. По завершении увеличивается версия
+kb:index_version в Redis - запущенный бот перестраивает поисковый индекс и сбрасывает кэш выдачи.
+
+Запуск: python kb_backfill.py result.json [--format jsonl] [--batch-size 500]
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+from itertools import islice
+from typing import Iterator, Optional
+
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from config import settings
+from db import commands as db_commands
+from services.kb_cache import KBQueryCache
+from services.kb_search import INDEX_VERSION_KEY
+from services.redis_pool import redis_manager
+
+_SKIP_RE = re.compile(r"[\s,]*")
+
+
+def iter_export_messages(path: str, chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """
+    Потоково отдает элементы массива "messages" из экспорта Telegram Desktop.
+    В памяти держится только текущий кусок файла и одно сообщение.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        # 1. Ищем начало массива messages (заголовок экспорта небольшой)
+        buffer = ""
+        while True:
+            key = buffer.find('"messages"')
+            bracket = buffer.find("[", key) if key != -1 else -1
+            if bracket != -1:
+                buffer = buffer[bracket + 1:]
+                break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+
+        # 2. Разбираем сообщения по одному
+        position = 0
+        while True:
+            position = _SKIP_RE.match(buffer, position).end()
+            if position >= len(buffer):
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    return
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                message, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Сообщение обрезано границей куска - дочитываем
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            yield message
+            position = end
+
+
+def iter_jsonl_messages(path: str) -> Iterator[dict]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def export_text(value) -> str:
+    """Текст сообщения экспорта: строка или список кусков с разметкой."""
+    if isinstance(value, str):
+        return value
+    return "".join(part if isinstance(part, str) else part.get("text", "") for part in value or [])
+
+
+def parse_post(message: dict) -> Optional[tuple[int, str]]:
+    if message.get("type", "message") != "message":
+        return None  # Служебные сообщения (закрепы, смена названия и т.п.)
+    message_id = message.get("message_id", message.get("id"))
+    text = export_text(message.get("text", "")).strip()
+    if message_id is None or not text:
+        return None
+    return int(message_id), text
+
+
+def iter_posts(path: str, file_format: str) -> Iterator[tuple[int, str]]:
+    if file_format == "auto":
+        file_format = "jsonl" if path.endswith(".jsonl") else "export"
+    messages = iter_jsonl_messages(path) if file_format == "jsonl" else iter_export_messages(path)
+    for message in messages:
+        post = parse_post(message)
+        if post is not None:
+            yield post
+
+
+async def backfill(path: str, file_format: str, batch_size: int, reindex: bool):
+    engine = create_async_engine(settings.db_url)
+    session_pool = async_sessionmaker(engine, expire_on_commit=False)
+    redis_client = redis_manager.client(settings.redis_db)
+
+    started = time.perf_counter()
+    total = 0
+    try:
+        posts = iter_posts(path, file_format)
+        async with session_pool() as session:
+            while batch := list(islice(posts, batch_size)):
+                total += await db_commands.bulk_upsert_kb_entries(session, batch)
+                await session.commit()
+                elapsed = time.perf_counter() - started
+                print(f"Upserted {total} posts ({total / elapsed:.0f} rows/s)")
+
+        elapsed = time.perf_counter() - started
+        print(f"DONE: {total} posts in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s)")
+
+        if reindex and total:
+            # Бот перестроит индекс при следующей проверке версии; общий кэш выдачи устарел
+            version = await redis_client.incr(INDEX_VERSION_KEY)
+            cache = KBQueryCache()
+            cache.configure(max_size=0, ttl_seconds=0, redis=redis_client)
+            await cache.clear()
+            print(f"Index version bumped to {version}, shared search cache cleared.")
+    except Exception as e:
+        print(f"ERROR: {e}")
+    finally:
+        await redis_manager.close()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="result.json из Telegram Desktop или .jsonl")
+    parser.add_argument("--format", choices=["auto", "export", "jsonl"], default="auto")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--no-reindex", action="store_true", help="Не трогать версию индекса в Redis")
+    args = parser.parse_args()
+    asyncio.run(backfill(args.path, args.format, args.batch_size, reindex=not args.no_reindex))
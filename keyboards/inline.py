@@ -3,7 +3,12 @@
 
 Здесь определяются фабрики CallbackData для структурирования данных
 и функции-конструкторы для генерации клавиатур.
+
+Клавиатуры шагов заявки и пульты менеджера запоминаются (lru_cache): одинаковый
+набор кнопок строится один раз, дальше отдается тот же объект. Возвращенные
+клавиатуры общие для всех вызовов - изменять их нельзя.
 """
+from functools import lru_cache
 
 from aiogram.filters.callback_data import CallbackData
 from aiogram.types import InlineKeyboardMarkup
@@ -32,11 +37,30 @@ class CsatCallback(CallbackData, prefix="csat"):
     rating: int
 
 
+class KBSearchCallback(CallbackData, prefix="kbs"):
+    """
+    Фабрика для колбэков выдачи поиска по Базе Знаний.
+    - 'action': 'page' (перелистнуть выдачу) или 'forward' (переслать пост в топик).
+    - 'page': Номер страницы выдачи.
+    - 'message_id': ID поста в канале Базы Знаний (для 'forward').
+    """
+    action: str
+    page: int = 0
+    message_id: int = 0
+
+
+# Сколько клавиатур держать в памяти: наборы кнопок шагов заявки и пульты диалогов
+APP_STEP_KEYBOARDS_CACHE_SIZE = 256
+CONTROL_PANELS_CACHE_SIZE = 4096
+
+
 # --- Функции-конструкторы клавиатур ---
 
+@lru_cache(maxsize=CONTROL_PANELS_CACHE_SIZE)
 def get_manager_control_panel(dialog_id: int) -> InlineKeyboardMarkup:
     """
     Создает "пульт управления" для менеджера в теме диалога.
+    Пульт одного диалога не меняется, поэтому последние пульты запоминаются.
 
     :param dialog_id: ID диалога для включения в callback_data.
     :return: Объект InlineKeyboardMarkup.
@@ -132,11 +156,16 @@ def get_app_step_keyboard(extra_buttons: dict = None) -> InlineKeyboardMarkup:
     
     :param extra_buttons: Словарь {'Текст кнопки': 'callback_data'} для выбора (например, валюты).
     """
+    # Словарь не хэшируется: ключ кэша - кортеж пар в порядке кнопок
+    return _build_app_step_keyboard(tuple(extra_buttons.items()) if extra_buttons else ())
+
+@lru_cache(maxsize=APP_STEP_KEYBOARDS_CACHE_SIZE)
+def _build_app_step_keyboard(extra_buttons: tuple[tuple[str, str], ...]) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
 
     # 1. Кнопки выбора (если есть)
     if extra_buttons:
-        for text, data in extra_buttons.items():
+        for text, data in extra_buttons:
             builder.button(text=text, callback_data=data)
         
         # Адаптация сетки: если кнопок много (валюты) - по 2, иначе по 1
@@ -155,4 +184,45 @@ def get_app_step_keyboard(extra_buttons: dict = None) -> InlineKeyboardMarkup:
     # Если были кнопки выбора, row() добавит новый ряд под ними.
     builder.row(*control_row)
 
-    return builder.as_markup()
\ No newline at end of file
+    return builder.as_markup()
+
+def get_kb_results_keyboard(message_ids: list[int], first_number: int, page: int, total_pages: int) -> InlineKeyboardMarkup:
+    """
+    Создает клавиатуру для страницы выдачи поиска по Базе Знаний.
+    Кнопка с номером пересылает в топик только этот пост, стрелки листают выдачу.
+
+    :param message_ids: ID постов канала на текущей странице (в порядке выдачи).
+    :param first_number: Порядковый номер первого поста страницы в выдаче.
+    :param page: Номер текущей страницы (с нуля).
+    :param total_pages: Общее количество страниц.
+    :return: Объект InlineKeyboardMarkup.
+    """
+    builder = InlineKeyboardBuilder()
+
+    # 1. Пересылка отдельных постов (один ряд с номерами)
+    forward_row = [
+        InlineKeyboardButton(
+            text=f"📨 {first_number + i}",
+            callback_data=KBSearchCallback(action="forward", page=page, message_id=message_id).pack()
+        )
+        for i, message_id in enumerate(message_ids)
+    ]
+    if forward_row:
+        builder.row(*forward_row)
+
+    # 2. Навигация по страницам
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton(
+            text="◀️ Назад", callback_data=KBSearchCallback(action="page", page=page - 1).pack()
+        ))
+    if page + 1 < total_pages:
+        nav_row.append(InlineKeyboardButton(
+            text="Вперед ▶️", callback_data=KBSearchCallback(action="page", page=page + 1).pack()
+        ))
+    if nav_row:
+        builder.row(*nav_row)
+
+    builder.row(InlineKeyboardButton(text="❌ Выйти из поиска", callback_data="cancel_kb_search"))
+
+    return builder.as_markup()
@@ -1,24 +1,43 @@
 import asyncio
+import html
 import logging
+import signal
 from datetime import datetime, date, timedelta
 from typing import Callable, Dict, Any, Awaitable, Generator
 import uuid
-import redis.asyncio as redis
-import json
 from telegram import InlineKeyboardMarkup
 from aiogram.exceptions import TelegramBadRequest 
 from aiogram import types, Bot, Dispatcher, F, BaseMiddleware
 from aiogram.fsm.context import FSMContext  
-from aiogram.fsm.storage.memory import MemoryStorage 
-from aiogram.types import Message, CallbackQuery, TelegramObject, User as AiogramUser, InlineQueryResultArticle, InputTextMessageContent, SwitchInlineQueryChosenChat
-from aiogram.filters import Command, StateFilter
+from aiogram.types import Message, CallbackQuery, TelegramObject, User as AiogramUser, InlineQuery, InlineQueryResultArticle, InputTextMessageContent, SwitchInlineQueryChosenChat, FSInputFile
+from aiogram.filters import Command, CommandObject, StateFilter
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
 from config import settings
 from db import commands as db_commands
 from db.models import User, Dialog, Base
-from keyboards.inline import ManagerCallback, get_manager_control_panel, get_app_step_keyboard
+from db.routing import create_session_pool, dispose_engines, router as replica_router
+from db.topic_index import topic_index
+from db.message_map import message_map
+from services.kb_search import kb_index, INDEX_VERSION_KEY
+from services.kb_inline import inline_kb_search
+from services.kb_cache import kb_cache
+from services.deal_stream import destination_for, ensure_consumer_group
+from services.deal_events import deal_events_consumer
+from services.redis_pool import redis_manager
+from services.city_catalog import city_catalog, CITY_CATALOG_VERSION_KEY
+from services.notifications import fan_out
+from services.edit_coalescer import edit_coalescer
+from keyboards.inline import ManagerCallback, KBSearchCallback, get_manager_control_panel, get_app_step_keyboard, get_kb_results_keyboard
 from scheduler import setup_scheduler
+from monitoring.instrumentation import instrumentation
+from monitoring.metrics import metrics
+from monitoring.profiler import profiler
+from bot.storage import create_fsm_storage
+from bot.middlewares.fsm import BufferedFSMMiddleware
+from bot.middlewares.instrumentation import UpdateInstrumentationMiddleware, HandlerNameMiddleware, ApiCallTimingMiddleware
+from bot.middlewares.profiling import ProfilingMiddleware
 from states.manager_states import ManagerFSM 
 
 from aiogram.enums import ContentType
@@ -36,14 +55,8 @@ class DbSessionMiddleware(BaseMiddleware):
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 log = logging.getLogger(__name__)
 
-dp = Dispatcher()
-
-redis_client = redis.Redis(
-    host=settings.redis_host,
-    port=settings.redis_port,
-    db=settings.redis_db,
-    decode_responses=True
-)
+# FSM хранится в Redis: сценарии менеджеров переживают перезапуск и видны всем репликам
+dp = Dispatcher(storage=create_fsm_storage(settings))
 
 BRANDS = ["KeineExchange", "ftCash", "BitRocket", "AvanChange", "CoinsBlack", "DocrtorBit", "FOEX", "DIMMAR", "SberBit", "ArkedUSDT", "MULTIKASSA", "Fox", "ZombieCash", "AWX"]
 CURRENCIES = ["Tether (TRC-20)", "Tether (ERC-20)", "Tether (BEP20)", "Bitcoin", "Litecoin", "Ethereum (ERC-20)", "Tron (TRX)", "USD Coin (ERC-20)", "USD Coin (TRC-20)", "Рубль (RUB)"]
@@ -189,6 +202,46 @@ async def forward_message_to_client(bot: Bot, client_tg_id: int, message: Messag
         return None
 
   
+# === ПРОФИЛИРОВАНИЕ (только руководитель; до общих хендлеров сообщений) ===
+@dp.message(Command("profile"))
+async def profile_command(message: Message, command: CommandObject, session: AsyncSession):
+    """/profile [on [доля] | off | dump] - профилировщик хендлеров (monitoring/profiler.py)."""
+    if not await db_commands.is_supervisor(session, message.from_user.id):
+        # Для остальных это обычное сообщение - пусть его обработают следующие хендлеры
+        raise SkipHandler()
+
+    args = (command.args or "").split()
+    action = args[0].lower() if args else "status"
+
+    if action == "on":
+        sample_rate = None
+        try:
+            if len(args) > 1:
+                # "0.25" или "25%"
+                sample_rate = float(args[1].rstrip('%')) / 100 if args[1].endswith('%') else float(args[1])
+        except ValueError:
+            await message.answer("Доля апдейтов - число от 0 до 1 или процент, например: /profile on 0.25")
+            return
+        profiler.enable(sample_rate)
+        await message.answer(
+            f"🔬 Профилирование включено: {profiler.sample_rate:.0%} апдейтов, "
+            f"медленные - от {profiler.slow_seconds} с."
+        )
+    elif action in ("off", "dump"):
+        path = profiler.disable() if action == "off" else profiler.dump()
+        if path is None:
+            await message.answer("🔬 Профилирование выключено, замеров нет.")
+            return
+        await message.answer_document(FSInputFile(path), caption=f"🔬 Отчет профилировщика: {path}")
+    else:
+        state = "включено" if profiler.enabled else "выключено"
+        await message.answer(
+            f"🔬 Профилирование {state}.\n\n<pre>{html.escape(profiler.summary())}</pre>\n\n"
+            f"/profile on [доля] | off | dump",
+            parse_mode="HTML"
+        )
+
+
 # === ЛОГИКА ДЛЯ КЛИЕНТОВ (без изменений) ===
 @dp.message(F.chat.type == "private")
 async def handle_client_message(message: Message, session: AsyncSession, bot: Bot):
@@ -264,9 +317,8 @@ async def handle_client_message(message: Message, session: AsyncSession, bot: Bo
                     name=f"🗣️ {user_display_name} (Restored)"
                 )
                 
-                # Обновляем ID топика в БД
-                dialog.manager_topic_id = new_topic.message_thread_id
-                await session.flush()
+                # Обновляем ID топика в БД (и в горячем индексе топиков)
+                await db_commands.update_dialog_topic(session, dialog, new_topic.message_thread_id)
                 
                 # Отправляем сообщение в НОВЫЙ топик
                 manager_message = await send_message_to_manager(
@@ -312,6 +364,9 @@ async def handle_client_message(message: Message, session: AsyncSession, bot: Bo
                 sender_role='client',
                 sender_name=message.from_user.full_name,
                 text=log_text.strip(),
+                client_id=user.id,
+                client_chat_id=message.chat.id,
+                manager_chat_id=dialog.manager_chat_id,
                 client_telegram_message_id=message.message_id,           
                 manager_telegram_message_id=manager_message.message_id   
             )
@@ -387,6 +442,9 @@ async def handle_client_message(message: Message, session: AsyncSession, bot: Bo
                 sender_role='client',
                 sender_name=message.from_user.full_name,
                 text=log_text.strip(),
+                client_id=user.id,
+                client_chat_id=message.chat.id,
+                manager_chat_id=manager_work_chat_id,
                 client_telegram_message_id=message.message_id,
                 manager_telegram_message_id=manager_message.message_id
             )
@@ -422,17 +480,20 @@ async def send_message_to_manager(bot: Bot, chat_id: int, topic_id: int, from_us
 # === ОБРАБОТКА РЕДАКТИРОВАНИЯ СООБЩЕНИЙ ===
 # ==========================================
 
+# Серия правок одного сообщения склеивается (services/edit_coalescer.py):
+# через edit_debounce_seconds после последней правки применяется только итоговый текст
+
 # 1. КЛИЕНТ изменил сообщение
 @dp.edited_message(F.chat.type == "private")
-async def handle_client_edited_message(message: Message, session: AsyncSession, bot: Bot):
-    # Ищем запись в БД по ID сообщения клиента
-    log_entry = await db_commands.get_log_entry_by_client_msg_id(session, message.message_id)
-    if not log_entry:
-        return
+async def handle_client_edited_message(message: Message):
+    edit_coalescer.submit(
+        ("client", message.chat.id, message.message_id), message, propagate_client_edit, order=message.edit_date
+    )
 
-    # Получаем диалог, чтобы знать куда отправлять уведомление
-    dialog = await db_commands.get_dialog_by_id(session, log_entry.dialog_id)
-    if not dialog or not dialog.manager_chat_id:
+async def propagate_client_edit(session: AsyncSession, message: Message):
+    # Ищем запись в БД по ID сообщения клиента (чат менеджера хранится в самой записи)
+    log_entry = await db_commands.get_log_entry_by_client_msg_id(session, message.chat.id, message.message_id)
+    if not log_entry or not log_entry.manager_chat_id:
         return
 
     # Определяем новый текст
@@ -446,9 +507,9 @@ async def handle_client_edited_message(message: Message, session: AsyncSession,
     notification_text = f"✏️ <b>Клиент изменил сообщение:</b>\n\n{new_text}"
     
     try:
-        await bot.send_message(
-            chat_id=dialog.manager_chat_id,
-            message_thread_id=dialog.manager_topic_id,
+        # Ответ на сообщение из топика сам попадает в этот топик
+        await message.bot.send_message(
+            chat_id=log_entry.manager_chat_id,
             text=notification_text,
             reply_to_message_id=log_entry.manager_telegram_message_id, # Отвечаем на исходное
             parse_mode="HTML"
@@ -463,19 +524,15 @@ async def handle_client_edited_message(message: Message, session: AsyncSession,
     F.message_thread_id,
     F.from_user.is_bot == False
 )
-async def handle_manager_edited_message(message: Message, session: AsyncSession, bot: Bot):
-    # Ищем запись в БД по ID сообщения менеджера
-    log_entry = await db_commands.get_log_entry_by_manager_msg_id(session, message.message_id)
-    if not log_entry:
-        return
-
-    dialog = await db_commands.get_dialog_by_id(session, log_entry.dialog_id)
-    if not dialog:
-        return
+async def handle_manager_edited_message(message: Message):
+    edit_coalescer.submit(
+        ("manager", message.chat.id, message.message_id), message, propagate_manager_edit, order=message.edit_date
+    )
 
-    # Получаем данные клиента
-    client_user = await session.get(User, dialog.client_id)
-    if not client_user:
+async def propagate_manager_edit(session: AsyncSession, message: Message):
+    # Ищем запись в БД по ID сообщения менеджера (чат клиента хранится в самой записи)
+    log_entry = await db_commands.get_log_entry_by_manager_msg_id(session, message.chat.id, message.message_id)
+    if not log_entry or not log_entry.client_chat_id:
         return
 
     # ТЗ: "у клиента оно должно просто поменяется"
@@ -489,20 +546,20 @@ async def handle_manager_edited_message(message: Message, session: AsyncSession,
     try:
         # Если это текст
         if message.text:
-            await bot.edit_message_text(
-                chat_id=client_user.telegram_id,
+            await message.bot.edit_message_text(
+                chat_id=log_entry.client_chat_id,
                 message_id=log_entry.client_telegram_message_id,
                 text=message.text
             )
         # Если это подпись к медиа (фото/видео)
         elif message.caption:
-            await bot.edit_message_caption(
-                chat_id=client_user.telegram_id,
+            await message.bot.edit_message_caption(
+                chat_id=log_entry.client_chat_id,
                 message_id=log_entry.client_telegram_message_id,
                 caption=message.caption
             )
     except Exception as e:
-        log.warning(f"Failed to edit message for client {client_user.telegram_id}: {e}")
+        log.warning(f"Failed to edit message for client {log_entry.client_chat_id}: {e}")
 
 # === ЛОГИКА ДЛЯ МЕНЕДЖЕРОВ (ОТВЕТ КЛИЕНТУ) ===
 @dp.message(
@@ -527,19 +584,19 @@ async def handle_manager_reply_to_client(message: Message, session: AsyncSession
     if message.text and message.text.startswith('/'):
         return
 
-    # 1. Находим диалог по ID топика
-    dialog = await db_commands.find_dialog_by_topic(session, message.message_thread_id)
+    # 1. Находим диалог по (чат, топик) - из горячего индекса, без запроса в БД
+    dialog = await db_commands.resolve_dialog_by_topic(session, message.chat.id, message.message_thread_id)
     if not dialog:
         return
 
     # === НОВАЯ ЛОГИКА ВОЗОБНОВЛЕНИЯ ===
     if dialog.status in ('resolved', 'transferred'):
         # 1. Меняем статус на active
-        await db_commands.update_dialog_status(session, dialog.id, 'active')
+        await db_commands.update_dialog_status(session, dialog.dialog_id, 'active')
         
         # 2. Пытаемся технически открыть топик (если он был закрыт галочкой)
         try:
-            await bot.reopen_forum_topic(chat_id=dialog.manager_chat_id, message_thread_id=dialog.manager_topic_id)
+            await bot.reopen_forum_topic(chat_id=message.chat.id, message_thread_id=message.message_thread_id)
         except Exception:
             pass # Если уже открыт или ошибка, не страшно
 
@@ -552,15 +609,15 @@ async def handle_manager_reply_to_client(message: Message, session: AsyncSession
             )
             
             control_panel_msg = await bot.send_message(
-                chat_id=dialog.manager_chat_id,
-                message_thread_id=dialog.manager_topic_id,
+                chat_id=message.chat.id,
+                message_thread_id=message.message_thread_id,
                 text=reopen_text,
-                reply_markup=get_manager_control_panel(dialog.id),
+                reply_markup=get_manager_control_panel(dialog.dialog_id),
                 parse_mode="HTML"
             )
             
             await bot.pin_chat_message(
-                chat_id=dialog.manager_chat_id,
+                chat_id=message.chat.id,
                 message_id=control_panel_msg.message_id,
                 disable_notification=True
             )
@@ -576,19 +633,13 @@ async def handle_manager_reply_to_client(message: Message, session: AsyncSession
         return
     # ===================================
 
-    # 2. Получаем данные клиента из БД
-    client_user = await session.get(User, dialog.client_id)
-    if not client_user:
-        await message.reply(f"❌ Ошибка: Не удалось найти профиль клиента ID={dialog.client_id}!")
-        return
-
-    # 3. Пересылаем сообщение клиенту
-    sent_to_client_message = await forward_message_to_client(bot, client_user.telegram_id, message)
+    # 2. Пересылаем сообщение клиенту (его chat id уже есть в индексе)
+    sent_to_client_message = await forward_message_to_client(bot, dialog.client_chat_id, message)
 
     if not sent_to_client_message:
         return
 
-    # 4. Логируем сообщение в БД
+    # 3. Логируем сообщение в БД
     log_text = ""
     if message.text:
         log_text = message.text
@@ -601,14 +652,17 @@ async def handle_manager_reply_to_client(message: Message, session: AsyncSession
     
     await db_commands.add_message_to_log(
         session=session,
-        dialog_id=dialog.id,
+        dialog_id=dialog.dialog_id,
         sender_role='manager',
         sender_name=manager_user.full_name,
         text=log_text.strip(),
+        client_id=dialog.client_id,
+        client_chat_id=dialog.client_chat_id,
+        manager_chat_id=message.chat.id,
         client_telegram_message_id=sent_to_client_message.message_id, 
         manager_telegram_message_id=message.message_id                
     )
-    await db_commands.reset_sla_status(session, dialog.id)
+    await db_commands.reset_sla_status(session, dialog.dialog_id)
 
     await session.commit()
 
@@ -635,15 +689,13 @@ async def on_raw_update(update: Update, session: AsyncSession, bot: Bot):
         # Если это чат менеджеров (группа), значит менеджер удалил сообщение
         # Можно попытаться найти его в БД и удалить у клиента сразу
         async with session.begin():
-            log_entry = await db_commands.get_log_entry_by_manager_msg_id(session, message_id)
+            log_entry = await db_commands.get_log_entry_by_manager_msg_id(session, chat_id, message_id)
             if log_entry and not log_entry.is_deleted:
                 log_entry.is_deleted = True
-                # Получаем диалог, чтобы узнать ID клиента
-                dialog = await db_commands.get_dialog_by_id(session, log_entry.dialog_id)
-                if dialog and dialog.client:
+                if log_entry.client_chat_id:
                     try:
-                        await bot.delete_message(chat_id=dialog.client.telegram_id, message_id=log_entry.client_telegram_message_id)
-                        log.info(f"Instant delete sync: Removed message from client {dialog.client.telegram_id}")
+                        await bot.delete_message(chat_id=log_entry.client_chat_id, message_id=log_entry.client_telegram_message_id)
+                        log.info(f"Instant delete sync: Removed message from client {log_entry.client_chat_id}")
                     except Exception as e:
                         log.warning(f"Failed instant delete: {e}")
 
@@ -657,7 +709,7 @@ async def on_raw_update(update: Update, session: AsyncSession, bot: Bot):
         # Используем транзакцию для массового обновления
         async with session.begin():
             for message_id in message_ids:
-                await db_commands.mark_message_as_deleted(session, message_id)
+                await db_commands.mark_message_as_deleted(session, chat_id, message_id)
         
         # session.commit() здесь не нужен, т.к. `async with session.begin()` делает это автоматически
         log.info(f"Finished marking {len(message_ids)} bulk-deleted messages.")
@@ -935,7 +987,10 @@ async def start_kb_search(query: CallbackQuery, callback_data: ManagerCallback,
     )
     
     builder = InlineKeyboardBuilder()
+    # Инлайн-поиск: результаты появляются по мере набора, без отправки сообщений
+    builder.button(text="⚡ Искать по мере ввода", switch_inline_query_current_chat="")
     builder.button(text="❌ Выйти из поиска", callback_data="cancel_kb_search")
+    builder.adjust(1)
     
     # Отправляем НОВОЕ сообщение вниз
     msg = await query.message.answer(text, reply_markup=builder.as_markup(), parse_mode="HTML")
@@ -968,12 +1023,62 @@ async def cancel_note_handler(query: CallbackQuery, state: FSMContext, bot: Bot)
 
     await query.answer("Отменено")
 
+def build_kb_results_page(search_query: str, results: list, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    """Текст и клавиатура одной страницы выдачи: заголовки и сниппеты со ссылками на посты канала."""
+    page_size = settings.kb_page_size
+    total_pages = max(1, -(-len(results) // page_size))
+    page = min(max(page, 0), total_pages - 1)
+    first = page * page_size
+    page_hits = results[first:first + page_size]
+
+    channel_id_clean = str(settings.knowledge_base_channel_id).replace("-100", "")
+    lines = [
+        f"🔎 <b>Результаты по запросу «{html.escape(search_query)}»</b>\n"
+        f"Найдено: {len(results)} · Страница {page + 1}/{total_pages}\n"
+    ]
+    for number, hit in enumerate(page_hits, start=first + 1):
+        link = f"https://t.me/c/{channel_id_clean}/{hit.message_id}"
+        lines.append(
+            f"<b>{number}.</b> <a href='{link}'>{html.escape(hit.title)}</a>\n"
+            f"<i>{html.escape(hit.snippet)}</i>\n"
+        )
+    lines.append("👇 Введите следующий запрос или нажмите Выйти.")
+
+    keyboard = get_kb_results_keyboard([hit.message_id for hit in page_hits], first + 1, page, total_pages)
+    return "\n".join(lines), keyboard
+
+async def show_kb_search_message(bot: Bot, message: Message, state: FSMContext, text: str, reply_markup: InlineKeyboardMarkup):
+    """
+    Показывает выдачу в одном и том же сообщении меню поиска (edit вместо delete + send).
+    Новое сообщение отправляется, только если старое недоступно.
+    """
+    data = await state.get_data()
+    search_msg_id = data.get('search_message_id')
+    if search_msg_id:
+        try:
+            await bot.edit_message_text(
+                text=text,
+                chat_id=message.chat.id,
+                message_id=search_msg_id,
+                reply_markup=reply_markup,
+                parse_mode="HTML",
+                disable_web_page_preview=True
+            )
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                return
+            log.warning(f"KB search menu edit failed, sending new one: {e}")
+
+    new_msg = await message.answer(text, reply_markup=reply_markup, parse_mode="HTML", disable_web_page_preview=True)
+    await state.update_data(search_message_id=new_msg.message_id)
+
 @dp.message(StateFilter(ManagerFSM.searching_kb))
 async def perform_kb_search(message: Message, state: FSMContext, session: AsyncSession, bot: Bot):
     print(f"📨 [Search] Получен запрос: '{message.text}'")
     
     # Игнорируем команды
-    if message.text.startswith("/"):
+    if not message.text or message.text.startswith("/"):
         return
 
     search_query = message.text.strip()
@@ -984,62 +1089,85 @@ async def perform_kb_search(message: Message, state: FSMContext, session: AsyncS
     except:
         pass
 
-    # Ищем в БД
-    results = await db_commands.search_knowledge_base(session, search_query)
-    
-    # Кнопка выхода нужна в любом случае
-    builder = InlineKeyboardBuilder()
-    builder.button(text="❌ Выйти из поиска", callback_data="cancel_kb_search")
+    # Ищем по индексу Базы Знаний
+    results = await db_commands.search_knowledge_base(session, search_query, limit=settings.kb_search_limit)
 
     if not results:
         print("❌ [Search] Ничего не найдено")
-        # Удаляем старое меню поиска, чтобы прислать новое с ошибкой
-        data = await state.get_data()
-        old_msg_id = data.get('search_message_id')
-        if old_msg_id:
-            try: await bot.delete_message(chat_id=message.chat.id, message_id=old_msg_id)
-            except: pass
-
-        new_msg = await message.answer(
-            f"😔 По запросу '<b>{search_query}</b>' ничего не найдено.\nПопробуйте другой запрос.",
-            reply_markup=builder.as_markup(),
-            parse_mode="HTML"
+        builder = InlineKeyboardBuilder()
+        builder.button(text="❌ Выйти из поиска", callback_data="cancel_kb_search")
+        await show_kb_search_message(
+            bot, message, state,
+            f"😔 По запросу '<b>{html.escape(search_query)}</b>' ничего не найдено.\nПопробуйте другой запрос.",
+            builder.as_markup()
         )
-        await state.update_data(search_message_id=new_msg.message_id)
         return
 
-    # Если нашли
-    print(f"✅ [Search] Найдено {len(results)} записей. Пересылаем...")
-    
-    # Удаляем меню поиска перед отправкой результатов
+    # Если нашли: одна страница выдачи в сообщении меню поиска, остальное - по кнопкам
+    print(f"✅ [Search] Найдено {len(results)} записей.")
+    await state.update_data(kb_query=search_query)
+    text, keyboard = build_kb_results_page(search_query, results, page=0)
+    await show_kb_search_message(bot, message, state, text, keyboard)
+
+@dp.callback_query(KBSearchCallback.filter(F.action == "page"), StateFilter(ManagerFSM.searching_kb))
+async def kb_search_page_handler(query: CallbackQuery, callback_data: KBSearchCallback, state: FSMContext, session: AsyncSession):
+    """Листание выдачи: повторяет поиск по сохраненному запросу и редактирует то же сообщение."""
     data = await state.get_data()
-    old_msg_id = data.get('search_message_id')
-    if old_msg_id:
-        try: await bot.delete_message(chat_id=message.chat.id, message_id=old_msg_id)
-        except: pass
+    search_query = data.get('kb_query')
+    if not search_query:
+        await query.answer("Запрос устарел, введите его заново.")
+        return
 
-    # Пересылаем сообщения
-    await message.answer(f"🔎 <b>Результаты ({len(results)} шт.):</b>", parse_mode="HTML")
-    
-    for entry in results:
-        try:
-            await bot.forward_message(
-                chat_id=message.chat.id,
-                message_thread_id=message.message_thread_id,
-                from_chat_id=settings.knowledge_base_channel_id,
-                message_id=entry.message_id
-            )
-            await asyncio.sleep(0.2)
-        except Exception as e:
-            log.error(f"Forward error: {e}")
+    results = await db_commands.search_knowledge_base(session, search_query, limit=settings.kb_search_limit)
+    text, keyboard = build_kb_results_page(search_query, results, callback_data.page)
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML", disable_web_page_preview=True)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            log.error(f"KB page edit error: {e}")
+    await query.answer()
 
-    # Отправляем новое меню поиска вниз
-    final_msg = await message.answer(
-        "👇 Введите следующий запрос или нажмите Выйти:",
-        reply_markup=builder.as_markup(),
-        parse_mode="HTML"
+@dp.callback_query(KBSearchCallback.filter(F.action == "forward"))
+async def kb_search_forward_handler(query: CallbackQuery, callback_data: KBSearchCallback, bot: Bot):
+    """Пересылает в топик только выбранный пост Базы Знаний."""
+    try:
+        await bot.forward_message(
+            chat_id=query.message.chat.id,
+            message_thread_id=query.message.message_thread_id,
+            from_chat_id=settings.knowledge_base_channel_id,
+            message_id=callback_data.message_id
+        )
+    except Exception as e:
+        log.error(f"Forward error: {e}")
+        await query.answer("Не удалось переслать пост", show_alert=True)
+        return
+    await query.answer("Переслано")
+
+@dp.inline_query()
+async def kb_inline_query_handler(inline_query: InlineQuery, session: AsyncSession):
+    """
+    Инлайн-поиск по Базе Знаний: менеджер пишет "@bot запрос" в любом топике.
+    Выдача строится по индексу в памяти, SQL нужен только для первой проверки прав.
+    """
+    user_id = inline_query.from_user.id
+    is_staff = inline_kb_search.cached_staff(user_id)
+    if is_staff is None:
+        is_staff = await db_commands.is_staff_member(session, user_id)
+        inline_kb_search.remember_staff(user_id, is_staff)
+
+    search_query = inline_query.query.strip()
+    if not is_staff or not search_query:
+        await inline_query.answer([], cache_time=settings.kb_inline_cache_seconds, is_personal=True)
+        return
+
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    results, next_offset = inline_kb_search.build_results(search_query, offset, settings.kb_inline_page_size)
+    await inline_query.answer(
+        results,
+        cache_time=settings.kb_inline_cache_seconds,
+        is_personal=True,
+        next_offset=next_offset
     )
-    await state.update_data(search_message_id=final_msg.message_id)
 
 # ==========================================
 # === УПРАВЛЕНИЕ ПРОЦЕССОМ ЗАЯВКИ (ПАУЗА) ===
@@ -1090,9 +1218,7 @@ async def app_resume_handler(query: CallbackQuery, state: FSMContext, bot: Bot,
         kb = get_app_step_keyboard({"Обратная": "Обратная", "Прямая": "Прямая"})
     
     elif saved_state_str == ManagerFSM.app_selecting_city.state:
-        cities = await db_commands.get_all_cities(session)
-        city_btns = {city.name: f"city_id:{city.id}" for city in cities}
-        kb = get_app_step_keyboard(city_btns)
+        kb = await city_catalog.keyboard(session)
         
     elif saved_state_str == ManagerFSM.app_selecting_action.state:
         kb = get_app_step_keyboard({"Принять": "Принять", "Выдать": "Выдать"})
@@ -1205,7 +1331,10 @@ async def cancel_fsm(message: Message, state: FSMContext):
 async def start_create_application(query: CallbackQuery, callback_data: ManagerCallback, state: FSMContext):
     await query.answer()
     await state.clear()
-    await state.update_data(dialog_id=callback_data.dialog_id, type='Частная', brand='VIP-Obmen')
+    await state.update_data(
+        dialog_id=callback_data.dialog_id, type='Частная', brand='VIP-Obmen',
+        idempotency_key=str(uuid.uuid4())
+    )
     
     prompt = "Шаг 1: Выберите направление заявки:"
     await state.update_data(last_prompt=prompt)
@@ -1387,15 +1516,11 @@ async def app_enter_datetime(message: Message, state: FSMContext, session: Async
         await display_confirmation_screen(message, state)
         return
 
-    # Загружаем города из БД
-    cities = await db_commands.get_all_cities(session)
-    
     prompt = "Шаг 6: Выберите город:"
     await state.update_data(last_prompt=prompt)
     
-    # В callback_data кладем ID города
-    city_btns = {city.name: f"city_id:{city.id}" for city in cities}
-    kb = get_app_step_keyboard(city_btns)
+    # Клавиатура городов (в callback_data - ID города) берется из справочника в памяти
+    kb = await city_catalog.keyboard(session)
     
     await edit_or_send_message(message, state, text=prompt, reply_markup=kb)
     await state.set_state(ManagerFSM.app_selecting_city)
@@ -1403,7 +1528,7 @@ async def app_enter_datetime(message: Message, state: FSMContext, session: Async
 @dp.callback_query(StateFilter(ManagerFSM.app_selecting_city), F.data.startswith("city_id:"))
 async def app_select_city(query: CallbackQuery, state: FSMContext, session: AsyncSession):
     city_id = int(query.data.split(":")[1])
-    city = await db_commands.get_city_by_id(session, city_id)
+    city = await city_catalog.get(session, city_id)
     
     if not city:
         await query.answer("Ошибка: город не найден.")
@@ -1715,45 +1840,50 @@ async def app_confirmation_handler(query: CallbackQuery, state: FSMContext, bot:
         # Убираем лишние данные, которые не нужны бэкенду
         data.pop('editing_mode', None)
         
-        # --- 2. Отправка в Redis ---
+        # --- 2. Запись в outbox (в Redis заявку доставит фоновый relay) ---
+        # Ключ создан при старте заявки: повторное нажатие "Подтвердить" не создаст дубль
+        data['idempotency_key'] = data.get('idempotency_key') or str(uuid.uuid4())
         try:
-            await redis_client.rpush(settings.redis_queue_name, json.dumps(data))
-            log.info(f"Заявка успешно отправлена в очередь Redis '{settings.redis_queue_name}'")
+            created = await db_commands.add_outbox_message(
+                session,
+                idempotency_key=data['idempotency_key'],
+                queue=destination_for(settings),
+                payload=data,
+                dialog_id=data.get('dialog_id')
+            )
+            await session.commit()
         except Exception as e:
-            log.error(f"Ошибка отправки заявки в Redis: {e}")
-            await query.message.edit_text("❌ Критическая ошибка: не удалось отправить заявку в обработку. Свяжитесь с администратором.")
+            log.error(f"Ошибка записи заявки в outbox: {e}")
+            await query.message.edit_text("❌ Критическая ошибка: не удалось сохранить заявку. Попробуйте еще раз или свяжитесь с администратором.")
+            return
+
+        if not created:
+            log.info(f"Заявка {data['idempotency_key']} уже была подтверждена")
+            await query.message.edit_text("ℹ️ Эта заявка уже отправлена в обработку.")
             await state.clear()
             return
+        log.info(f"Заявка {data['idempotency_key']} записана в outbox ({destination_for(settings)})")
 
-        # --- 3. Отправка уведомлений (клиенту и в канал) ---
+        # --- 3. Уведомления: клиенту, в канал заявок, в чат города и итог менеджеру - параллельно ---
         summary_for_manager = format_application_summary(data)
         summary_for_client = format_summary_for_client(data)
         
-        # Отправка клиенту
         dialog_id = data.get('dialog_id')
         dialog = await db_commands.get_dialog_by_id(session, dialog_id)
+        city = await city_catalog.get(session, data['city_id']) if data.get('city_id') else None
+
+        targets = {}
         if dialog and dialog.client:
-            try:
-                await bot.send_message(
-                    chat_id=dialog.client.telegram_id, 
-                    text=summary_for_client, # <-- Используем новую переменную
-                    parse_mode="HTML"
-                )
-            except Exception as e:
-                log.warning(f"Не удалось отправить копию заявки клиенту {dialog.client.telegram_id}: {e}")
-        
-        # Отправка в канал заявок (остается без изменений, с полной информацией)
-        try:
-            await bot.send_message(
-                chat_id=settings.applications_channel_id, 
-                text=summary_for_manager, # <-- Используем полную версию для менеджеров
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            log.error(f"Не удалось отправить копию заявки в канал {settings.applications_channel_id}: {e}")
+            targets['client'] = bot.send_message(chat_id=dialog.client.telegram_id, text=summary_for_client, parse_mode="HTML")
+        targets['channel'] = bot.send_message(chat_id=settings.applications_channel_id, text=summary_for_manager, parse_mode="HTML")
+        if city:
+            targets['city'] = bot.send_message(chat_id=city.telegram_chat_id, text=summary_for_manager, parse_mode="HTML")
+        targets['confirmation'] = query.message.edit_text("✅ Заявка успешно создана и отправлена в обработку!")
+
+        # Заявка уже в outbox: сбой уведомления не отменяет ее, только попадает в лог
+        await fan_out(f"заявка {data['idempotency_key']}", targets)
 
         # --- 4. Завершение ---
-        await query.message.edit_text("✅ Заявка успешно создана и отправлена в обработку!")
         await state.clear()
 
     elif query.data == "edit_deal":
@@ -1837,9 +1967,8 @@ async def app_select_field_to_edit(query: CallbackQuery, state: FSMContext, sess
     
         
     if query.data == "edit_city":
-        cities = await db_commands.get_all_cities(session) # Теперь сессия есть!
         prompt = "Выберите новый город:"
-        kb = get_app_step_keyboard({city.name: f"city_id:{city.id}" for city in cities})
+        kb = await city_catalog.keyboard(session)
         await state.update_data(editing_mode=True, last_prompt=prompt)
         await query.message.edit_text(prompt, reply_markup=kb, parse_mode="HTML")
         await state.set_state(ManagerFSM.app_selecting_city)
@@ -1894,7 +2023,7 @@ async def app_select_field_to_edit(query: CallbackQuery, state: FSMContext, sess
     else:
         await query.message.answer("Редактирование этого поля пока не реализовано.")
 
-# === ИНДЕКСАЦИЯ БАЗЫ ЗНАНИЙ (ПО ХЕШТЕГАМ) ===
+# === ИНДЕКСАЦИЯ БАЗЫ ЗНАНИЙ (ТЕКСТ И ХЕШТЕГИ) ===
 @dp.message(F.chat.id == settings.knowledge_base_channel_id)
 @dp.edited_message(F.chat.id == settings.knowledge_base_channel_id)
 @dp.channel_post(F.chat.id == settings.knowledge_base_channel_id)
@@ -1903,16 +2032,17 @@ async def index_kb_content(message: Message, session: AsyncSession):
     text_content = message.text or message.caption or ""
     if not text_content: return
 
-    # Если в тексте нет #, игнорируем (или сохраняем, но искать не по чему)
-    if "#" not in text_content:
-        print(f"⚠️ [Index] Post {message.message_id} ignored (no hashtags)")
-        return
-
+    # Индексируем весь текст поста: хештеги дают дополнительный вес, но не обязательны
     try:
-        await db_commands.add_or_update_kb_entry(session, message.message_id, text_content)
+        entry = await db_commands.add_or_update_kb_entry(session, message.message_id, text_content)
         await session.commit()
     except Exception as e:
         log.error(f"KB Index Error: {e}")
+        return
+
+    # Инкрементально обновляем поисковый индекс в памяти и сбрасываем затронутые запросы в кэше
+    kb_index.add(entry.message_id, entry.text, entry.keywords)
+    await kb_cache.invalidate_post(entry.message_id, entry.text, entry.keywords)
 
 @dp.callback_query(F.data == "cancel_kb_search")
 async def cancel_kb_search_handler(query: CallbackQuery, state: FSMContext, bot: Bot):
@@ -1959,26 +2089,132 @@ async def debug_channel_id(message: Message):
 
 # === ФУНКЦИЯ ЗАПУСКА main ===
 async def main():
-    log.info("Starting bot... (FSM DISABLED)")
-    engine = create_async_engine(settings.db_url, echo=False)
+    log.info("Starting bot...")
+    session_pool = create_session_pool(settings)
 
-    async with engine.begin() as conn:
+    async with replica_router.primary.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
 
-    session_pool = async_sessionmaker(engine, expire_on_commit=False)
+    # Прогреваем индекс (чат, топик) -> диалог
+    topic_index.configure(max_size=settings.topic_index_max_size, ttl_seconds=settings.topic_index_ttl_seconds)
+    async with session_pool() as session:
+        warmed = await db_commands.warm_topic_index(session)
+    log.info(f"Topic index warmed: {warmed} dialogs")
+    message_map.configure(max_size=settings.message_map_cache_size)
+
+    # Общий пул Redis (очередь, кэши, FSM): соединения открываем до первых апдейтов
+    redis_client = redis_manager.client(settings.redis_db)
+    try:
+        await redis_manager.start(dbs=(settings.redis_db, settings.redis_fsm_db))
+    except Exception as e:
+        log.error(f"Redis warmup failed: {e}")
+
+    # Строим поисковый индекс Базы Знаний (запоминаем версию, чтобы не перестраивать его повторно)
+    try:
+        kb_index.external_version = await redis_client.get(INDEX_VERSION_KEY)
+    except Exception as e:
+        log.warning(f"KB index version is unavailable: {e}")
+    try:
+        city_catalog.external_version = await redis_client.get(CITY_CATALOG_VERSION_KEY)
+    except Exception as e:
+        log.warning(f"City catalog version is unavailable: {e}")
+    kb_index.configure_fuzzy(enabled=settings.kb_fuzzy_enabled, budget_ms=settings.kb_fuzzy_budget_ms)
+    async with session_pool() as session:
+        await kb_index.rebuild(session)
+    kb_cache.configure(
+        max_size=settings.kb_cache_size,
+        ttl_seconds=settings.kb_cache_ttl_seconds,
+        redis=redis_client if settings.kb_cache_shared else None
+    )
+    kb_cache_listener = asyncio.create_task(kb_cache.listen_invalidations())
+    inline_kb_search.configure(
+        max_queries=settings.kb_inline_cache_size,
+        max_hits=settings.kb_search_limit,
+        staff_ttl_seconds=settings.kb_inline_staff_ttl_seconds,
+        max_staff=settings.kb_inline_staff_cache_size
+    )
+
+    edit_coalescer.configure(session_pool=session_pool, debounce_seconds=settings.edit_debounce_seconds)
+
     bot = Bot(token=settings.bot_token)
     dp.update.middleware(DbSessionMiddleware(session_pool=session_pool))
+    # Одно чтение и одна запись FSM на апдейт вместо обращения к Redis на каждый get/update_data
+    dp.message.middleware(BufferedFSMMiddleware())
+    dp.callback_query.middleware(BufferedFSMMiddleware())
+
+    # Замеры стоимости апдейтов: SQL, Bot API, латентность (лог-отчет и/или метрики Prometheus)
+    tracking_enabled = settings.instrumentation_enabled or settings.metrics_enabled
+    instrumentation.configure(
+        enabled=tracking_enabled,
+        n_plus_one_threshold=settings.instrumentation_n_plus_one_threshold
+    )
+    if tracking_enabled:
+        for engine in (replica_router.primary, replica_router.replica):
+            if engine is not None:
+                instrumentation.install_engine(engine)
+        bot.session.middleware(ApiCallTimingMiddleware())
+        dp.update.outer_middleware(UpdateInstrumentationMiddleware())
+        for observer in (dp.update, dp.message, dp.edited_message, dp.callback_query,
+                         dp.channel_post, dp.edited_channel_post, dp.inline_query):
+            observer.middleware(HandlerNameMiddleware())
+
+    # Профилировщик: middleware стоит всегда, а работает только после /profile on или SIGUSR2
+    profiler.configure(
+        sample_rate=settings.profiler_sample_rate,
+        slow_seconds=settings.profiler_slow_seconds,
+        output_dir=settings.profiler_dir,
+        top_n=settings.profiler_top_n
+    )
+    for observer in (dp.message, dp.edited_message, dp.callback_query, dp.channel_post,
+                     dp.edited_channel_post, dp.inline_query):
+        observer.middleware(ProfilingMiddleware())
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR2, profiler.toggle)
+    except (AttributeError, NotImplementedError):
+        log.info("SIGUSR2 is not supported here, use /profile to toggle the profiler")
+
+    if settings.metrics_enabled:
+        for name, engine in (('primary', replica_router.primary), ('replica', replica_router.replica)):
+            if engine is not None:
+                metrics.watch_engine(name, engine)
+        # Начальные значения счетчиков; дальше их меняют db/commands.py, а dialog_metrics_job выравнивает
+        async with session_pool() as session:
+            metrics.set_dialog_counts(await db_commands.count_dialogs_by_status(session))
+        try:
+            await metrics.start_server(settings.metrics_host, settings.metrics_port)
+        except OSError as e:
+            log.error(f"Metrics endpoint is unavailable: {e}")
     
-    scheduler = setup_scheduler(session_pool, bot, settings)
+    # Stream заявок: группа потребителя должна существовать до первой записи
+    if settings.redis_transport == 'stream':
+        try:
+            await ensure_consumer_group(redis_client, settings.redis_stream_name, settings.redis_stream_group)
+        except Exception as e:
+            log.error(f"Failed to create consumer group for {settings.redis_stream_name}: {e}")
+
+    # Статусы сделок от обработчика заявок -> таблица deals и топики менеджеров
+    deal_events_task = None
+    if settings.deal_events_enabled:
+        deal_events_task = asyncio.create_task(deal_events_consumer.run(session_pool, redis_client, bot, settings))
+
+    scheduler = setup_scheduler(session_pool, bot, settings, redis_client=redis_client)
     scheduler.start()
 
     try:
         await dp.start_polling(bot)
     finally:
+        # Отложенные правки применяем, пока сессия бота еще открыта
+        await edit_coalescer.flush()
         await bot.session.close()
         if 'scheduler' in locals(): scheduler.shutdown()
-        if 'redis_client' in locals(): await redis_client.close()
-        await engine.dispose()
+        kb_cache_listener.cancel()
+        if deal_events_task is not None:
+            deal_events_task.cancel()
+        # Пулы Redis (в том числе FSM-хранилища) закрывает менеджер
+        await redis_manager.close()
+        await metrics.stop_server()
+        profiler.disable()
+        await dispose_engines()
         log.info("Bot stopped.")
 
 if __name__ == '__main__':
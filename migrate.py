@@ -0,0 +1,246 @@
+"""
+Миграции схемы для уже существующей БД.
+
+`Base.metadata.create_all` при старте бота создает только НОВЫЕ таблицы,
+поэтому новые колонки/индексы в старых таблицах и бэкфилл данных делаются здесь.
+Каждый шаг идемпотентен: скрипт можно запускать повторно.
+
+Запуск: python migrate.py
+"""
+import asyncio
+import json
+import os
+from sqlalchemy import text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncConnection
+from config import settings, BASE_DIR
+from db.models import Deal, TelegramMessageMap
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+async def column_exists(conn: AsyncConnection, table: str, column: str) -> bool:
+    result = await conn.execute(
+        text(
+            "SELECT COUNT(*) FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND COLUMN_NAME = :column"
+        ),
+        {"table": table, "column": column}
+    )
+    return result.scalar() > 0
+
+
+async def index_exists(conn: AsyncConnection, table: str, index: str) -> bool:
+    result = await conn.execute(
+        text(
+            "SELECT COUNT(*) FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND INDEX_NAME = :index"
+        ),
+        {"table": table, "index": index}
+    )
+    return result.scalar() > 0
+
+
+async def constraint_exists(conn: AsyncConnection, table: str, constraint: str) -> bool:
+    result = await conn.execute(
+        text(
+            "SELECT COUNT(*) FROM information_schema.TABLE_CONSTRAINTS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table AND CONSTRAINT_NAME = :constraint"
+        ),
+        {"table": table, "constraint": constraint}
+    )
+    return result.scalar() > 0
+
+
+async def add_column(conn: AsyncConnection, table: str, column: str, ddl: str):
+    if not await column_exists(conn, table, column):
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        print(f"  + {table}.{column}")
+
+
+async def add_index(conn: AsyncConnection, table: str, index: str, ddl: str):
+    if not await index_exists(conn, table, index):
+        await conn.execute(text(f"ALTER TABLE {table} ADD {ddl}"))
+        print(f"  + index {table}.{index}")
+
+
+# --- ШАГИ МИГРАЦИИ ---
+
+async def message_logs_denormalize(engine):
+    """client_id / client_chat_id / manager_chat_id в message_logs + бэкфилл из dialogs и users."""
+    async with engine.begin() as conn:
+        await add_column(conn, "message_logs", "client_id", "INTEGER NULL")
+        await add_column(conn, "message_logs", "client_chat_id", "BIGINT NULL")
+        await add_column(conn, "message_logs", "manager_chat_id", "BIGINT NULL")
+
+    # Бэкфилл пачками по id, чтобы не держать долгих блокировок
+    async with engine.connect() as conn:
+        max_id = (await conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM message_logs"))).scalar()
+
+    updated = 0
+    for start in range(0, max_id + 1, BACKFILL_BATCH_SIZE):
+        async with engine.begin() as conn:
+            result = await conn.execute(
+                text(
+                    "UPDATE message_logs ml "
+                    "JOIN dialogs d ON d.id = ml.dialog_id "
+                    "JOIN users u ON u.id = d.client_id "
+                    "SET ml.client_id = d.client_id, "
+                    "    ml.client_chat_id = u.telegram_id, "
+                    "    ml.manager_chat_id = d.manager_chat_id "
+                    "WHERE ml.id >= :start AND ml.id < :end AND ml.client_id IS NULL"
+                ),
+                {"start": start, "end": start + BACKFILL_BATCH_SIZE}
+            )
+            updated += result.rowcount
+    print(f"  message_logs backfilled: {updated}")
+
+    async with engine.begin() as conn:
+        await add_index(
+            conn, "message_logs", "ix_message_logs_client_created",
+            "INDEX ix_message_logs_client_created (client_id, created_at)"
+        )
+        await add_index(
+            conn, "message_logs", "ix_message_logs_client_chat_msg",
+            "INDEX ix_message_logs_client_chat_msg (client_chat_id, client_telegram_message_id)"
+        )
+        await add_index(
+            conn, "message_logs", "ix_message_logs_manager_chat_msg",
+            "INDEX ix_message_logs_manager_chat_msg (manager_chat_id, manager_telegram_message_id)"
+        )
+        if not await constraint_exists(conn, "message_logs", "fk_message_logs_client_id"):
+            await conn.execute(text(
+                "ALTER TABLE message_logs ADD CONSTRAINT fk_message_logs_client_id "
+                "FOREIGN KEY (client_id) REFERENCES users (id)"
+            ))
+            print("  + fk message_logs.client_id")
+
+
+async def retention_columns(engine):
+    """dialogs.resolved_at (с бэкфиллом для уже закрытых диалогов) и индекс по sla_violations.created_at."""
+    async with engine.begin() as conn:
+        await add_column(conn, "dialogs", "resolved_at", "DATETIME NULL")
+        result = await conn.execute(text(
+            "UPDATE dialogs d SET d.resolved_at = COALESCE("
+            "    (SELECT MAX(ml.created_at) FROM message_logs ml WHERE ml.dialog_id = d.id),"
+            "    d.last_client_message_at, d.created_at) "
+            "WHERE d.status IN ('resolved', 'transferred') AND d.resolved_at IS NULL"
+        ))
+        print(f"  dialogs.resolved_at backfilled: {result.rowcount}")
+        await add_index(conn, "dialogs", "ix_dialogs_resolved_at", "INDEX ix_dialogs_resolved_at (resolved_at)")
+        await add_index(
+            conn, "sla_violations", "ix_sla_violations_created_at",
+            "INDEX ix_sla_violations_created_at (created_at)"
+        )
+
+
+async def dialogs_chat_topic_unique(engine):
+    """Уникальный индекс (manager_chat_id, manager_topic_id) для поиска диалога по топику."""
+    async with engine.begin() as conn:
+        if await index_exists(conn, "dialogs", "ux_dialogs_chat_topic"):
+            return
+        duplicates = (await conn.execute(text(
+            "SELECT manager_chat_id, manager_topic_id, COUNT(*) AS cnt FROM dialogs "
+            "GROUP BY manager_chat_id, manager_topic_id HAVING cnt > 1"
+        ))).all()
+        if duplicates:
+            for chat_id, topic_id, cnt in duplicates:
+                print(f"  ! duplicate topic chat={chat_id} topic={topic_id}: {cnt} dialogs")
+            raise RuntimeError("Resolve duplicate (manager_chat_id, manager_topic_id) pairs before adding ux_dialogs_chat_topic")
+        await add_index(
+            conn, "dialogs", "ux_dialogs_chat_topic",
+            "UNIQUE INDEX ux_dialogs_chat_topic (manager_chat_id, manager_topic_id)"
+        )
+
+
+async def fulltext_indexes(engine):
+    """FULLTEXT (ngram) индексы для поиска по Базе Знаний и по переписке."""
+    async with engine.begin() as conn:
+        await add_index(
+            conn, "knowledge_base", "ft_knowledge_base_text",
+            "FULLTEXT INDEX ft_knowledge_base_text (text, keywords) WITH PARSER ngram"
+        )
+        await add_index(
+            conn, "message_logs", "ft_message_logs_text",
+            "FULLTEXT INDEX ft_message_logs_text (text) WITH PARSER ngram"
+        )
+
+
+async def import_topic_data(engine):
+    """Переносит соответствия тема -> сделка из topic_data.json обработчика в таблицу deals."""
+    path = os.path.join(BASE_DIR, "topic_data.json")
+    if not os.path.exists(path):
+        return
+    async with engine.begin() as conn:
+        await conn.run_sync(Deal.__table__.create, checkfirst=True)
+
+    with open(path, encoding="utf-8") as f:
+        topics = json.load(f)
+    rows = [
+        {"deals_id": int(item["deals_id"]), "topic_id": int(topic_id), "original_message_id": item.get("original_message_id")}
+        for topic_id, item in topics.items()
+        if item.get("deals_id") is not None
+    ]
+    if not rows:
+        return
+    async with engine.begin() as conn:
+        result = await conn.execute(mysql_insert(Deal).values(rows).prefix_with("IGNORE"))
+    print(f"  deals: {result.rowcount} imported from topic_data.json")
+
+
+async def telegram_message_map(engine):
+    """Таблица (chat_id, message_id) -> запись лога и ее заполнение по существующим message_logs."""
+    async with engine.begin() as conn:
+        await conn.run_sync(TelegramMessageMap.__table__.create, checkfirst=True)
+
+    async with engine.connect() as conn:
+        max_id = (await conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM message_logs"))).scalar()
+
+    # Сторона сообщения, его (чат, id) и зеркало на другой стороне
+    sides = (
+        ("client", "client_chat_id", "client_telegram_message_id", "manager_chat_id", "manager_telegram_message_id"),
+        ("manager", "manager_chat_id", "manager_telegram_message_id", "client_chat_id", "client_telegram_message_id"),
+    )
+    mapped = 0
+    for start in range(0, max_id + 1, BACKFILL_BATCH_SIZE):
+        async with engine.begin() as conn:
+            for side, chat_col, msg_col, mirror_chat_col, mirror_msg_col in sides:
+                # IGNORE: строки, уже записанные ботом, и повторный запуск
+                result = await conn.execute(
+                    text(
+                        "INSERT IGNORE INTO telegram_message_map "
+                        "(chat_id, message_id, log_id, side, mirror_chat_id, mirror_message_id) "
+                        f"SELECT {chat_col}, {msg_col}, id, '{side}', {mirror_chat_col}, {mirror_msg_col} "
+                        "FROM message_logs "
+                        f"WHERE id >= :start AND id < :end AND {chat_col} IS NOT NULL AND {msg_col} IS NOT NULL"
+                    ),
+                    {"start": start, "end": start + BACKFILL_BATCH_SIZE}
+                )
+                mapped += result.rowcount
+    print(f"  telegram_message_map backfilled: {mapped}")
+
+
+MIGRATIONS = [
+    message_logs_denormalize,
+    retention_columns,
+    dialogs_chat_topic_unique,
+    fulltext_indexes,
+    import_topic_data,
+    telegram_message_map,
+]
+
+
+async def migrate():
+    engine = create_async_engine(settings.db_url)
+    try:
+        for step in MIGRATIONS:
+            print(f"-> {step.__name__}")
+            await step(engine)
+        print("DONE: Migrations applied.")
+    except Exception as e:
+        print(f"ERROR: {e}")
+    finally:
+        await engine.dispose()
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
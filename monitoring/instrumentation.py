@@ -0,0 +1,205 @@
+"""
+Замер "стоимости" обработки одного апдейта или фоновой задачи.
+
+Для каждого вызова хендлера собирается:
+- количество SQL-запросов и суммарное время в БД (события движка SQLAlchemy);
+- количество вызовов Bot API и время на них (request-middleware сессии бота);
+- количество команд Redis и время на них (services.redis_pool);
+- общая латентность от начала до конца обработки.
+
+Одинаковые (с точностью до параметров) запросы, повторившиеся много раз
+за один апдейт, помечаются как N+1. Раз в N минут в лог пишется топ хендлеров.
+Те же замеры уходят в метрики Prometheus (monitoring.metrics).
+"""
+import functools
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from monitoring.metrics import metrics
+
+log = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# IN (%s, %s, %s) -> IN (?) : списки разной длины считаем одним запросом
+_PARAM_LIST_RE = re.compile(r"\((?:%s|\?|%\(\w+\)s)(?:,\s*(?:%s|\?|%\(\w+\)s))*\)")
+
+
+def normalize_statement(statement: str) -> str:
+    statement = _WHITESPACE_RE.sub(" ", statement).strip()
+    return _PARAM_LIST_RE.sub("(?)", statement)
+
+
+@dataclass
+class UpdateStats:
+    """Счетчики одного апдейта (или одного запуска фоновой задачи)."""
+    name: str
+    kind: str = "update"  # update - апдейт Telegram, job - фоновая задача
+    started_at: float = field(default_factory=time.perf_counter)
+    db_statements: int = 0
+    db_time: float = 0.0
+    api_calls: int = 0
+    api_time: float = 0.0
+    redis_calls: int = 0
+    redis_time: float = 0.0
+    statements: Counter = field(default_factory=Counter)
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started_at
+
+
+@dataclass
+class HandlerReport:
+    """Накопленная статистика по одному хендлеру между отчетами."""
+    calls: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+    total_statements: int = 0
+    max_statements: int = 0
+    total_db_time: float = 0.0
+    total_api_calls: int = 0
+    total_api_time: float = 0.0
+    total_redis_calls: int = 0
+    total_redis_time: float = 0.0
+    n_plus_one: int = 0
+    n_plus_one_example: Optional[str] = None
+
+
+current_stats: ContextVar[Optional[UpdateStats]] = ContextVar("current_update_stats", default=None)
+
+
+class Instrumentation:
+    def __init__(self, n_plus_one_threshold: int = 5):
+        self.enabled = False
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self._reports: dict[str, HandlerReport] = {}
+
+    def configure(self, enabled: bool, n_plus_one_threshold: int):
+        self.enabled = enabled
+        self.n_plus_one_threshold = n_plus_one_threshold
+
+    # --- Источники данных ---
+
+    def install_engine(self, engine: AsyncEngine):
+        """Подписывается на выполнение курсора в движке SQLAlchemy."""
+        sync_engine = engine.sync_engine
+
+        @event.listens_for(sync_engine, "before_cursor_execute")
+        def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+        @event.listens_for(sync_engine, "after_cursor_execute")
+        def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            started = conn.info["query_start_time"].pop()
+            self.record_statement(statement, time.perf_counter() - started)
+
+    def record_statement(self, statement: str, duration: float):
+        metrics.observe_statement(duration)
+        stats = current_stats.get()
+        if stats is None:
+            return
+        stats.db_statements += 1
+        stats.db_time += duration
+        stats.statements[normalize_statement(statement)] += 1
+
+    def record_api_call(self, method: str, duration: float, error: Optional[str] = None):
+        metrics.observe_api_call(method, duration, error)
+        stats = current_stats.get()
+        if stats is None:
+            return
+        stats.api_calls += 1
+        stats.api_time += duration
+
+    def record_redis_call(self, command: str, duration: float, failed: bool = False):
+        metrics.observe_redis(command, duration, failed)
+        stats = current_stats.get()
+        if stats is None:
+            return
+        stats.redis_calls += 1
+        stats.redis_time += duration
+
+    # --- Жизненный цикл замера ---
+
+    @asynccontextmanager
+    async def track(self, name: str, kind: str = "update"):
+        """Открывает замер на время блока. Вложенные замеры не создаются."""
+        if not self.enabled or current_stats.get() is not None:
+            yield current_stats.get()
+            return
+
+        stats = UpdateStats(name=name, kind=kind)
+        token = current_stats.set(stats)
+        try:
+            yield stats
+        finally:
+            current_stats.reset(token)
+            self._finish(stats)
+
+    def tracked(self, name: Optional[str] = None):
+        """Декоратор для фоновых задач: каждый запуск - отдельный замер."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with self.track(name or func.__name__, kind="job"):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish(self, stats: UpdateStats):
+        latency = stats.elapsed
+        metrics.observe_update(stats.name, stats.kind, latency)
+        report = self._reports.setdefault(stats.name, HandlerReport())
+        report.calls += 1
+        report.total_latency += latency
+        report.max_latency = max(report.max_latency, latency)
+        report.total_statements += stats.db_statements
+        report.max_statements = max(report.max_statements, stats.db_statements)
+        report.total_db_time += stats.db_time
+        report.total_api_calls += stats.api_calls
+        report.total_api_time += stats.api_time
+        report.total_redis_calls += stats.redis_calls
+        report.total_redis_time += stats.redis_time
+
+        repeated = [(sql, n) for sql, n in stats.statements.items() if n >= self.n_plus_one_threshold]
+        if repeated:
+            report.n_plus_one += 1
+            sql, count = max(repeated, key=lambda item: item[1])
+            report.n_plus_one_example = f"{count}x {sql[:200]}"
+            log.warning(f"[N+1] {stats.name}: {count}x {sql[:200]}")
+
+    # --- Отчет ---
+
+    def report(self, top_n: int = 10, reset: bool = True) -> str:
+        """Топ хендлеров по суммарному времени обработки."""
+        reports = sorted(self._reports.items(), key=lambda item: item[1].total_latency, reverse=True)
+        if reset:
+            self._reports = {}
+        if not reports:
+            return "[Instrumentation] Нет данных за период."
+
+        lines = [f"[Instrumentation] Топ-{top_n} хендлеров по суммарному времени:"]
+        for name, r in reports[:top_n]:
+            line = (
+                f"  {name}: calls={r.calls} "
+                f"avg={r.total_latency / r.calls * 1000:.0f}ms max={r.max_latency * 1000:.0f}ms | "
+                f"sql avg={r.total_statements / r.calls:.1f} max={r.max_statements} "
+                f"db={r.total_db_time / r.calls * 1000:.0f}ms | "
+                f"api avg={r.total_api_calls / r.calls:.1f} {r.total_api_time / r.calls * 1000:.0f}ms | "
+                f"redis avg={r.total_redis_calls / r.calls:.1f} {r.total_redis_time / r.calls * 1000:.0f}ms"
+            )
+            if r.n_plus_one:
+                line += f" | N+1 x{r.n_plus_one}: {r.n_plus_one_example}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+instrumentation = Instrumentation()
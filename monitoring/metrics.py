@@ -0,0 +1,159 @@
+"""
+Метрики бота в формате Prometheus: GET http://<metrics_host>:<metrics_port>/metrics
+
+Источники:
+- апдейты и фоновые задачи - завершение замера monitoring.instrumentation
+  (хендлеры: bot_updates_total / bot_update_duration_seconds, задачи: bot_job_duration_seconds);
+- Bot API, SQL и Redis - те же хуки, что и у instrumentation;
+- занятость пулов соединений БД снимается в момент скрейпа;
+- диалоги по статусам и очередь SLA - счетчики в памяти: db/commands.py меняет их
+  после commit вместе со статусом диалога (db/hooks.py). Между изменениями их выравнивают
+  по БД: диалоги - dialog_metrics_job, очередь SLA - check_sla_job по своей выборке.
+  Так сходятся и изменения, сделанные другими репликами бота.
+
+Проверка: curl -s http://127.0.0.1:9108/metrics | grep bot_
+"""
+import logging
+from typing import Optional
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.process_collector import ProcessCollector
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+log = logging.getLogger(__name__)
+
+# Обработка апдейта и вызовы Bot API: от миллисекунд до десятков секунд (скачивание файлов)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# SQL и Redis: основная масса - доли миллисекунды
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+class PoolCollector:
+    """Занятость пулов SQLAlchemy на момент скрейпа."""
+    def __init__(self):
+        self.engines: dict[str, AsyncEngine] = {}
+
+    def collect(self):
+        family = GaugeMetricFamily("bot_db_pool_connections", "Соединения пула БД", labels=["engine", "state"])
+        for name, engine in self.engines.items():
+            pool = engine.sync_engine.pool
+            for state in ("size", "checkedout", "checkedin", "overflow"):
+                value = getattr(pool, state, None)
+                if callable(value):
+                    family.add_metric([name, state], value())
+        yield family
+
+
+class BotMetrics:
+    def __init__(self):
+        self.registry = CollectorRegistry()
+        ProcessCollector(registry=self.registry)
+        self._pools = PoolCollector()
+        self.registry.register(self._pools)
+        self._runner: Optional[web.AppRunner] = None
+        self._dialog_statuses: set[str] = set()
+        self._sla_queue_size = 0
+
+        self.updates = Counter("bot_updates_total", "Обработанные апдейты", ["handler"], registry=self.registry)
+        self.update_duration = Histogram(
+            "bot_update_duration_seconds", "Время обработки апдейта", ["handler"],
+            buckets=LATENCY_BUCKETS, registry=self.registry
+        )
+        self.job_duration = Histogram(
+            "bot_job_duration_seconds", "Время выполнения фоновой задачи", ["job"],
+            buckets=LATENCY_BUCKETS, registry=self.registry
+        )
+        self.api_duration = Histogram(
+            "bot_api_request_duration_seconds", "Время вызова Bot API", ["method"],
+            buckets=LATENCY_BUCKETS, registry=self.registry
+        )
+        self.api_errors = Counter(
+            "bot_api_errors_total", "Ошибки вызовов Bot API", ["method", "error"], registry=self.registry
+        )
+        self.db_duration = Histogram(
+            "bot_db_query_duration_seconds", "Время выполнения SQL-запроса",
+            buckets=FAST_BUCKETS, registry=self.registry
+        )
+        self.redis_duration = Histogram(
+            "bot_redis_command_duration_seconds", "Время команды (или pipeline) Redis", ["command"],
+            buckets=FAST_BUCKETS, registry=self.registry
+        )
+        self.redis_errors = Counter(
+            "bot_redis_errors_total", "Ошибки команд Redis", ["command"], registry=self.registry
+        )
+        self.dialogs = Gauge("bot_dialogs", "Диалоги по статусам", ["status"], registry=self.registry)
+        self.sla_queue = Gauge(
+            "bot_sla_queue_size", "Активные диалоги, где клиент ждет ответа", registry=self.registry
+        )
+
+    # --- Источники ---
+
+    def observe_update(self, name: str, kind: str, duration: float):
+        if kind == "job":
+            self.job_duration.labels(name).observe(duration)
+        else:
+            self.updates.labels(name).inc()
+            self.update_duration.labels(name).observe(duration)
+
+    def observe_api_call(self, method: str, duration: float, error: Optional[str] = None):
+        self.api_duration.labels(method).observe(duration)
+        if error is not None:
+            self.api_errors.labels(method, error).inc()
+
+    def observe_statement(self, duration: float):
+        self.db_duration.observe(duration)
+
+    def observe_redis(self, command: str, duration: float, failed: bool = False):
+        self.redis_duration.labels(command).observe(duration)
+        if failed:
+            self.redis_errors.labels(command).inc()
+
+    def watch_engine(self, name: str, engine: AsyncEngine):
+        self._pools.engines[name] = engine
+
+    # --- Счетчики в памяти ---
+
+    def set_dialog_counts(self, counts: dict[str, int]):
+        # Статусы, которых больше нет в БД, обнуляем, а не оставляем старое значение
+        for status in self._dialog_statuses | set(counts):
+            self.dialogs.labels(status).set(counts.get(status, 0))
+        self._dialog_statuses |= set(counts)
+
+    def dialog_status_changed(self, old_status: Optional[str], new_status: str):
+        if old_status == new_status:
+            return
+        if old_status is not None:
+            self.dialogs.labels(old_status).dec()
+        self.dialogs.labels(new_status).inc()
+        self._dialog_statuses.add(new_status)
+
+    def set_sla_queue(self, size: int):
+        self._sla_queue_size = max(size, 0)
+        self.sla_queue.set(self._sla_queue_size)
+
+    def sla_queue_changed(self, delta: int):
+        # Не уходим ниже нуля: сброс таймера мог прийти раньше, чем счетчик его учел
+        self.set_sla_queue(self._sla_queue_size + delta)
+
+    # --- HTTP ---
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=generate_latest(self.registry), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+    async def start_server(self, host: str, port: int):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        log.info(f"[Metrics] Serving http://{host}:{port}/metrics")
+
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics = BotMetrics()
@@ -0,0 +1,183 @@
+"""
+Профилировщик хендлеров, включаемый на лету (/profile или SIGUSR2).
+
+Когда включен, профилирует долю апдейтов (sample_rate) и для каждого хендлера копит:
+- полное время (wall);
+- время ожидания БД, Bot API и Redis - из замера monitoring.instrumentation
+  (остальное - CPU хендлера и прочие ожидания);
+- для медленных вызовов (дольше slow_seconds) - статистику cProfile.
+cProfile включается для одного апдейта за раз и снимает весь поток: пока хендлер
+ждет await, в профиль попадают и другие задачи цикла - это картина нагрузки
+процесса за время медленного апдейта.
+
+Отчет с топом хендлеров пишется в файл (dump) при выключении и по /profile dump.
+Выключенный профилировщик стоит одну проверку флага в ProfilingMiddleware.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Optional
+
+from monitoring.instrumentation import current_stats
+
+log = logging.getLogger(__name__)
+
+# Сколько самых медленных профилей хранить на хендлер и сколько строк cProfile выводить
+SLOW_PROFILES_PER_HANDLER = 3
+PSTATS_LINES = 30
+
+
+@dataclass
+class HandlerProfile:
+    calls: int = 0
+    wall_total: float = 0.0
+    wall_max: float = 0.0
+    db_time: float = 0.0
+    api_time: float = 0.0
+    redis_time: float = 0.0
+    slow_calls: int = 0
+    # (wall, текст pstats) самых медленных вызовов, по убыванию
+    slowest: list = field(default_factory=list)
+
+    @property
+    def await_time(self) -> float:
+        return self.db_time + self.api_time + self.redis_time
+
+
+class HandlerProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = 0.1
+        self.slow_seconds = 1.0
+        self.output_dir = "profiles"
+        self.top_n = 20
+        self.enabled_at: Optional[datetime] = None
+        self._profiles: dict[str, HandlerProfile] = {}
+        self._cprofile_busy = False
+
+    def configure(self, sample_rate: float, slow_seconds: float, output_dir: str, top_n: int):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.output_dir = output_dir
+        self.top_n = top_n
+
+    # --- Управление ---
+
+    def enable(self, sample_rate: Optional[float] = None):
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if not self.enabled:
+            self.enabled = True
+            self.enabled_at = datetime.now()
+            self._profiles = {}
+        log.warning(f"[Profiler] Enabled: sample rate {self.sample_rate:.0%}, slow >= {self.slow_seconds}s")
+
+    def disable(self) -> Optional[str]:
+        """Выключает профилирование и пишет отчет. Возвращает путь к файлу (None - нечего писать)."""
+        if not self.enabled:
+            return None
+        self.enabled = False
+        path = self.dump() if self._profiles else None
+        log.warning(f"[Profiler] Disabled, report: {path or 'no samples'}")
+        return path
+
+    def toggle(self):
+        """Для обработчика сигнала: включить или выключить с записью отчета."""
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    # --- Замер ---
+
+    @asynccontextmanager
+    async def profile(self, name: str):
+        stats = current_stats.get()
+        io_before = (stats.db_time, stats.api_time, stats.redis_time) if stats is not None else None
+
+        profiler = None
+        if not self._cprofile_busy:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self._cprofile_busy = True
+            except ValueError:
+                # В потоке уже работает другой профилировщик
+                profiler = None
+
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - started
+            if profiler is not None:
+                profiler.disable()
+                self._cprofile_busy = False
+
+            report = self._profiles.setdefault(name, HandlerProfile())
+            report.calls += 1
+            report.wall_total += wall
+            report.wall_max = max(report.wall_max, wall)
+            if io_before is not None:
+                report.db_time += stats.db_time - io_before[0]
+                report.api_time += stats.api_time - io_before[1]
+                report.redis_time += stats.redis_time - io_before[2]
+            if wall >= self.slow_seconds:
+                report.slow_calls += 1
+                if profiler is not None:
+                    self._keep_slow_profile(report, wall, profiler)
+
+    def _keep_slow_profile(self, report: HandlerProfile, wall: float, profiler: cProfile.Profile):
+        if len(report.slowest) >= SLOW_PROFILES_PER_HANDLER and wall <= report.slowest[-1][0]:
+            return
+        buffer = io.StringIO()
+        pstats.Stats(profiler, stream=buffer).sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PSTATS_LINES)
+        report.slowest.append((wall, buffer.getvalue()))
+        report.slowest.sort(key=lambda item: item[0], reverse=True)
+        del report.slowest[SLOW_PROFILES_PER_HANDLER:]
+
+    # --- Отчет ---
+
+    def summary(self) -> str:
+        profiles = sorted(self._profiles.items(), key=lambda item: item[1].wall_total, reverse=True)
+        sampled = sum(p.calls for _, p in profiles)
+        lines = [
+            f"Profiling since {self.enabled_at:%Y-%m-%d %H:%M:%S}, sample rate {self.sample_rate:.0%}, "
+            f"slow >= {self.slow_seconds}s, sampled updates: {sampled}" if self.enabled_at else "No profiling session",
+            "",
+            f"{'handler':<40} {'calls':>6} {'avg ms':>8} {'max ms':>8} {'db ms':>7} {'api ms':>7} "
+            f"{'redis ms':>8} {'other ms':>8} {'slow':>5}",
+        ]
+        for name, p in profiles[:self.top_n]:
+            lines.append(
+                f"{name[:40]:<40} {p.calls:>6} {p.wall_total / p.calls * 1000:>8.1f} {p.wall_max * 1000:>8.1f} "
+                f"{p.db_time / p.calls * 1000:>7.1f} {p.api_time / p.calls * 1000:>7.1f} "
+                f"{p.redis_time / p.calls * 1000:>8.1f} {(p.wall_total - p.await_time) / p.calls * 1000:>8.1f} "
+                f"{p.slow_calls:>5}"
+            )
+        return "\n".join(lines)
+
+    def dump(self) -> str:
+        """Пишет топ хендлеров и профили медленных вызовов в файл, возвращает путь."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt")
+
+        slow = sorted(
+            ((wall, name, text) for name, p in self._profiles.items() for wall, text in p.slowest),
+            key=lambda item: item[0], reverse=True
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.summary())
+            f.write("\n")
+            for wall, name, text in slow[:self.top_n]:
+                f.write(f"\n{'=' * 100}\n{name}: {wall * 1000:.0f}ms\n{'=' * 100}\n{text}")
+        return path
+
+
+profiler = HandlerProfiler()
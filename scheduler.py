@@ -16,6 +16,14 @@ from sqlalchemy.orm import joinedload
 from config import Settings
 from db.models import Dialog
 from db import commands as db_commands
+from db.routing import check_replica_lag_job
+from monitoring.instrumentation import instrumentation
+from monitoring.metrics import metrics
+from services.kb_cache import kb_cache
+from services.deal_stream import enqueue, stream_lag_monitor
+from services.redis_pool import redis_latency
+from services.city_catalog import city_catalog
+from services.kb_search import kb_index, INDEX_VERSION_KEY
 
 log = logging.getLogger(__name__)
 
@@ -62,6 +70,7 @@ async def check_manager_message_exists(
         return True
 
 
+@instrumentation.tracked()
 async def sync_dialogs_job(session_pool: async_sessionmaker, bot: Bot, settings: Settings):
     # log.info("Running sync_dialogs_job...")
     technical_chat_id = settings.technical_chat_id 
@@ -83,16 +92,16 @@ async def sync_dialogs_job(session_pool: async_sessionmaker, bot: Bot, settings:
             # Небольшая пауза
             await asyncio.sleep(0.05)
 
-            try:
-                dialog = await db_commands.get_dialog_by_id(session, log_entry.dialog_id)
-                if not dialog or not dialog.client:
-                    continue
+            # Чаты берем из самой записи лога - без запроса диалога на каждую строку
+            if not log_entry.manager_chat_id or not log_entry.client_chat_id:
+                continue
 
+            try:
                 # Проверяем, существует ли сообщение в чате менеджера
                 exists = await check_manager_message_exists(
                     bot=bot,
                     check_chat_id=technical_chat_id,
-                    original_chat_id=dialog.manager_chat_id,
+                    original_chat_id=log_entry.manager_chat_id,
                     original_message_id=log_entry.manager_telegram_message_id
                 )
                 
@@ -107,7 +116,7 @@ async def sync_dialogs_job(session_pool: async_sessionmaker, bot: Bot, settings:
                     if log_entry.client_telegram_message_id:
                         try:
                             await bot.delete_message(
-                                chat_id=dialog.client.telegram_id, 
+                                chat_id=log_entry.client_chat_id, 
                                 message_id=log_entry.client_telegram_message_id
                             )
                         except Exception as e: 
@@ -146,10 +155,13 @@ async def send_sla_alerts(bot: Bot, dialog, text: str, escalation_chat_id: int):
     except Exception as e:
         log.error(f"SLA Escalation Group Alert Error: {e}")
 
+@instrumentation.tracked()
 async def check_sla_job(session_pool: async_sessionmaker, bot: Bot, settings):
     async with session_pool() as session:
         now = datetime.now()
         dialogs = await db_commands.get_all_overdue_dialogs(session)
+        # Выборка и есть очередь SLA: выравниваем счетчик, который между запусками меняют хендлеры
+        metrics.set_sla_queue(len(dialogs))
 
         for dialog in dialogs:
             # Считаем, сколько клиент ждет (в минутах)
@@ -208,7 +220,117 @@ async def check_sla_job(session_pool: async_sessionmaker, bot: Bot, settings):
 
         await session.commit()
 
-def setup_scheduler(session_pool: async_sessionmaker, bot: Bot, settings: Settings) -> AsyncIOScheduler:
+@instrumentation.tracked()
+async def retention_job(session_pool: async_sessionmaker, settings: Settings):
+    """
+    Переносит логи давно закрытых диалогов в архив и сворачивает старые нарушения SLA.
+    Работает маленькими пачками, каждая в своей транзакции, с паузой между ними,
+    чтобы не держать долгих блокировок на горячих таблицах.
+    """
+    steps = (
+        ('message_logs -> archive', db_commands.archive_resolved_dialog_logs, settings.retention_days),
+        ('sla_violations -> daily', db_commands.rollup_sla_violations, settings.sla_rollup_days),
+        ('outbox sent -> delete', db_commands.delete_sent_outbox_messages, settings.outbox_retention_days),
+    )
+    for name, step, older_than_days in steps:
+        total = 0
+        while True:
+            try:
+                async with session_pool() as session:
+                    moved = await step(session, older_than_days, settings.retention_batch_size)
+                    await session.commit()
+            except Exception as e:
+                log.error(f"[Retention] {name} failed: {e}")
+                break
+
+            total += moved
+            if moved < settings.retention_batch_size:
+                break
+            await asyncio.sleep(settings.retention_batch_pause_seconds)
+
+        if total:
+            log.info(f"[Retention] {name}: {total} rows")
+
+@instrumentation.tracked()
+async def outbox_relay_job(session_pool: async_sessionmaker, redis_client, settings: Settings):
+    """
+    Доставляет заявки из outbox в Redis (список или stream) пачками, один pipeline на пачку.
+    При недоступности Redis пачка откладывается с экспоненциальным backoff и не теряется.
+    Доставка "хотя бы один раз": потребитель отбрасывает повторы по idempotency_key.
+    """
+    while True:
+        async with session_pool() as session:
+            batch = await db_commands.get_outbox_batch(session, settings.outbox_batch_size)
+            if not batch:
+                return
+
+            try:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for message in batch:
+                        enqueue(pipe, message.queue, message.payload, message.idempotency_key, settings.redis_stream_maxlen)
+                    await pipe.execute()
+            except Exception as e:
+                await db_commands.mark_outbox_retry(
+                    session, batch, str(e),
+                    base_seconds=settings.outbox_backoff_base_seconds,
+                    max_seconds=settings.outbox_backoff_max_seconds
+                )
+                await session.commit()
+                log.error(f"[Outbox] Redis delivery failed for {len(batch)} messages "
+                          f"(max attempts {max(m.attempts for m in batch)}): {e}")
+                return
+
+            await db_commands.mark_outbox_sent(session, [message.id for message in batch])
+            await session.commit()
+
+        log.info(f"[Outbox] Relayed {len(batch)} messages to Redis")
+        if len(batch) < settings.outbox_batch_size:
+            return
+
+async def dialog_metrics_job(session_pool: async_sessionmaker):
+    """Выравнивает счетчики диалогов по БД: изменения других реплик и все, что прошло мимо db/commands.py."""
+    async with session_pool() as session:
+        metrics.set_dialog_counts(await db_commands.count_dialogs_by_status(session))
+
+async def stream_lag_job(redis_client, bot: Bot, settings: Settings):
+    await stream_lag_monitor.check(redis_client, bot, settings)
+
+async def instrumentation_report_job(settings: Settings):
+    log.info(instrumentation.report(top_n=settings.instrumentation_top_n))
+
+async def kb_cache_report_job():
+    log.info(kb_cache.report())
+
+async def redis_report_job(settings: Settings):
+    log.info(redis_latency.report(top_n=settings.instrumentation_top_n))
+
+async def kb_reindex_job(session_pool: async_sessionmaker, redis_client):
+    """
+    Перестраивает индекс Базы Знаний, если содержимое таблицы поменяли в обход бота
+    (kb_backfill.py увеличивает kb:index_version в Redis).
+    """
+    try:
+        version = await redis_client.get(INDEX_VERSION_KEY)
+    except Exception as e:
+        log.warning(f"[KB] Index version check failed: {e}")
+        return
+    if version is None or version == kb_index.external_version:
+        return
+
+    log.info(f"[KB] Index version changed ({kb_index.external_version} -> {version}), rebuilding...")
+    async with session_pool() as session:
+        await kb_index.rebuild(session)
+    kb_index.external_version = version
+    await kb_cache.clear()
+
+async def city_catalog_job(redis_client):
+    """Перечитывает справочник городов после seed_cities.py (версия в Redis)."""
+    try:
+        await city_catalog.check_version(redis_client)
+    except Exception as e:
+        log.warning(f"[Cities] Catalog version check failed: {e}")
+
+def setup_scheduler(session_pool: async_sessionmaker, bot: Bot, settings: Settings, redis_client=None) -> AsyncIOScheduler:
     scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
     scheduler.add_job(
         check_sla_job, 
@@ -223,4 +345,76 @@ def setup_scheduler(session_pool: async_sessionmaker, bot: Bot, settings: Settin
         max_instances=1, 
         kwargs={'session_pool': session_pool, 'bot': bot, 'settings': settings}
     )
+    scheduler.add_job(
+        retention_job,
+        trigger='cron',
+        hour=4,
+        minute=0,
+        max_instances=1,
+        kwargs={'session_pool': session_pool, 'settings': settings}
+    )
+    if settings.instrumentation_enabled:
+        scheduler.add_job(
+            instrumentation_report_job,
+            trigger='interval',
+            minutes=settings.instrumentation_report_minutes,
+            kwargs={'settings': settings}
+        )
+    if settings.metrics_enabled:
+        scheduler.add_job(
+            dialog_metrics_job,
+            trigger='interval',
+            seconds=settings.metrics_resync_seconds,
+            max_instances=1,
+            kwargs={'session_pool': session_pool}
+        )
+    if redis_client is not None:
+        scheduler.add_job(
+            outbox_relay_job,
+            trigger='interval',
+            seconds=settings.outbox_relay_seconds,
+            max_instances=1,
+            kwargs={'session_pool': session_pool, 'redis_client': redis_client, 'settings': settings}
+        )
+        if settings.redis_transport == 'stream':
+            scheduler.add_job(
+                stream_lag_job,
+                trigger='interval',
+                seconds=settings.redis_stream_check_seconds,
+                max_instances=1,
+                kwargs={'redis_client': redis_client, 'bot': bot, 'settings': settings}
+            )
+        scheduler.add_job(
+            kb_reindex_job,
+            trigger='interval',
+            seconds=settings.kb_reindex_check_seconds,
+            max_instances=1,
+            kwargs={'session_pool': session_pool, 'redis_client': redis_client}
+        )
+        scheduler.add_job(
+            city_catalog_job,
+            trigger='interval',
+            seconds=settings.city_catalog_check_seconds,
+            max_instances=1,
+            kwargs={'redis_client': redis_client}
+        )
+    scheduler.add_job(
+        kb_cache_report_job,
+        trigger='interval',
+        minutes=settings.instrumentation_report_minutes
+    )
+    scheduler.add_job(
+        redis_report_job,
+        trigger='interval',
+        minutes=settings.instrumentation_report_minutes,
+        kwargs={'settings': settings}
+    )
+    if settings.db_replica_url:
+        scheduler.add_job(
+            check_replica_lag_job,
+            trigger='interval',
+            seconds=settings.db_replica_check_seconds,
+            max_instances=1,
+            kwargs={'settings': settings}
+        )
     return scheduler
\ No newline at end of file
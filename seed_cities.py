@@ -4,6 +4,8 @@ from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy import delete
 from config import settings
 from db.models import City
+from services.city_catalog import CITY_CATALOG_VERSION_KEY
+from services.redis_pool import redis_manager
 
 async def seed_cities():
     # Создаем движок
@@ -36,10 +38,18 @@ async def seed_cities():
             
             await session.commit()
             print("DONE: Data saved to database successfully.") # Только английский для терминала
+
+        # Запущенные боты перечитают справочник городов при следующей проверке версии
+        try:
+            version = await redis_manager.client(settings.redis_db).incr(CITY_CATALOG_VERSION_KEY)
+            print(f"DONE: City catalog version bumped to {version}.")
+        except Exception as e:
+            print(f"WARNING: City catalog version not bumped, restart the bot to reload cities: {e}")
     except Exception as e:
         print(f"ERROR: {e}")
     finally:
         await engine.dispose() # Закрываем соединение правильно
+        await redis_manager.close()
 
 if __name__ == "__main__":
     asyncio.run(seed_cities())
\ No newline at end of file
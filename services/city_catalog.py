@@ -0,0 +1,81 @@
+"""
+Справочник городов в памяти процесса.
+
+Таблица cities (~20 строк) меняется только при запуске seed_cities.py, а читается
+на каждом шаге выбора города. Справочник загружается один раз, клавиатура выбора
+города строится сразу при загрузке и отдается готовой.
+seed_cities.py увеличивает cities:version в Redis - реплики сверяют версию
+по расписанию и перечитывают таблицу.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import commands as db_commands
+from keyboards.inline import get_app_step_keyboard
+
+log = logging.getLogger(__name__)
+
+CITY_CATALOG_VERSION_KEY = "cities:version"
+
+
+@dataclass(frozen=True)
+class CityRef:
+    """Город без привязки к сессии: безопасно держать между апдейтами."""
+    id: int
+    name: str
+    telegram_chat_id: int
+
+
+class CityCatalog:
+    def __init__(self):
+        self._cities: Optional[dict[int, CityRef]] = None
+        self._keyboard: Optional[InlineKeyboardMarkup] = None
+        self._lock = asyncio.Lock()
+        self.external_version: Optional[str] = None
+
+    async def _load(self, session: AsyncSession) -> dict[int, CityRef]:
+        cities = self._cities
+        if cities is not None:
+            return cities
+        async with self._lock:
+            if self._cities is None:
+                rows = await db_commands.get_all_cities(session)
+                # Порядок словаря = порядок по имени из get_all_cities
+                cities = {row.id: CityRef(row.id, row.name, row.telegram_chat_id) for row in rows}
+                self._keyboard = get_app_step_keyboard({city.name: f"city_id:{city.id}" for city in cities.values()})
+                self._cities = cities
+                log.info(f"[Cities] Catalog loaded: {len(cities)} cities")
+            return self._cities
+
+    async def all(self, session: AsyncSession) -> list[CityRef]:
+        return list((await self._load(session)).values())
+
+    async def get(self, session: AsyncSession, city_id: int) -> Optional[CityRef]:
+        return (await self._load(session)).get(city_id)
+
+    async def keyboard(self, session: AsyncSession) -> InlineKeyboardMarkup:
+        """Готовая клавиатура выбора города (с кнопками Пауза/Отмена)."""
+        await self._load(session)
+        return self._keyboard
+
+    def invalidate(self):
+        self._cities = None
+        self._keyboard = None
+
+    async def check_version(self, redis_client) -> bool:
+        """Сбрасывает справочник, если seed_cities.py поменял версию. True - если сбросили."""
+        version = await redis_client.get(CITY_CATALOG_VERSION_KEY)
+        if version == self.external_version:
+            return False
+        log.info(f"[Cities] Catalog version changed ({self.external_version} -> {version}), reloading")
+        self.external_version = version
+        self.invalidate()
+        return True
+
+
+city_catalog = CityCatalog()
@@ -0,0 +1,103 @@
+"""
+Обратная связь от обработчика заявок: события по сделкам из Redis Stream.
+
+Обработчик публикует в redis_deal_events_stream события
+{deals_id, topic_id, status[, dialog_id, idempotency_key, original_message_id]}
+(плоскими полями или JSON в поле payload). Бот читает их через consumer group
+пачками, сохраняет в таблицу deals и пишет смену статуса в топик менеджера.
+XACK - только после коммита: при падении пачка будет прочитана повторно,
+а повторное уведомление не уйдет, потому что статус уже не меняется.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+from typing import Optional
+
+from aiogram import Bot
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Settings
+from db import commands as db_commands
+from services.deal_stream import StreamConsumer, ensure_consumer_group
+
+log = logging.getLogger(__name__)
+
+DEAL_STATUS_LABELS = {
+    'created': '🆕 создана',
+    'accepted': '✅ принята',
+    'awaiting_wallet_address': '⏳ ожидает адрес кошелька',
+    'in_progress': '🔄 в работе',
+    'completed': '🏁 завершена',
+    'closed': '🔒 закрыта',
+    'cancelled': '❌ отменена',
+}
+_OPTIONAL_INT_FIELDS = ('topic_id', 'dialog_id', 'original_message_id')
+
+
+def parse_deal_event(fields: dict) -> Optional[dict]:
+    """Приводит запись stream к событию; None - если запись не похожа на событие сделки."""
+    try:
+        data = json.loads(fields['payload']) if 'payload' in fields else dict(fields)
+        event = {
+            'deals_id': int(data['deals_id']),
+            'status': data.get('status') or None,
+            'idempotency_key': data.get('idempotency_key') or None,
+        }
+        for name in _OPTIONAL_INT_FIELDS:
+            event[name] = int(data[name]) if data.get(name) not in (None, '') else None
+        return event
+    except (KeyError, TypeError, ValueError) as e:
+        log.warning(f"[Deals] Malformed event {fields}: {e}")
+        return None
+
+
+class DealEventsConsumer:
+    async def run(self, session_pool: async_sessionmaker, redis_client, bot: Bot, settings: Settings):
+        stream, group = settings.redis_deal_events_stream, settings.redis_deal_events_group
+        consumer = StreamConsumer(redis_client, stream, group, name=f"bot-{socket.gethostname()}-{os.getpid()}")
+        group_ready = False
+
+        while True:
+            try:
+                if not group_ready:
+                    await ensure_consumer_group(redis_client, stream, group)
+                    group_ready = True
+                    log.info(f"[Deals] Consuming '{stream}' as {consumer.name}")
+                entries = await consumer.read(count=settings.deal_events_batch_size, block_ms=5000)
+                if entries:
+                    await self.process(consumer, entries, session_pool, bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"[Deals] Event batch failed, retrying: {e}")
+                await asyncio.sleep(5)
+
+    async def process(self, consumer: StreamConsumer, entries: list, session_pool: async_sessionmaker, bot: Bot):
+        # Битые записи тоже подтверждаем, иначе они будут возвращаться вечно
+        events = [event for _, fields in entries if (event := parse_deal_event(fields)) is not None]
+
+        changes = []
+        if events:
+            async with session_pool() as session:
+                changes = await db_commands.apply_deal_events(session, events)
+                await session.commit()
+
+        for change in changes:
+            status = DEAL_STATUS_LABELS.get(change['status'], change['status'])
+            try:
+                await bot.send_message(
+                    chat_id=change['manager_chat_id'],
+                    message_thread_id=change['manager_topic_id'],
+                    text=f"📦 Сделка <b>#{change['deals_id']}</b>: {status}",
+                    parse_mode="HTML"
+                )
+            except Exception as e:
+                log.warning(f"[Deals] Status update for deal {change['deals_id']} not posted: {e}")
+
+        await consumer.ack([entry_id for entry_id, _ in entries])
+        log.info(f"[Deals] Processed {len(entries)} events, {len(changes)} status updates")
+
+
+deal_events_consumer = DealEventsConsumer()
@@ -0,0 +1,150 @@
+"""
+Передача заявок обработчику сделок через Redis.
+
+Два транспорта (settings.redis_transport):
+- list: RPUSH в redis_queue_name (исторический формат, без подтверждений);
+- stream: XADD в redis_stream_name с MAXLEN-обрезкой и версией схемы,
+  обработчик читает через consumer group и подтверждает XACK.
+
+Контракт для потребителя stream (см. StreamConsumer):
+- группа redis_stream_group создается ботом (XGROUP CREATE ... MKSTREAM);
+- запись: v (версия схемы), type, idempotency_key, created_at, payload (JSON заявки);
+- доставка "хотя бы один раз": XACK только после фиксации сделки в своей БД,
+  неподтвержденные записи забираются повторно (XAUTOCLAIM), дубли отбрасываются
+  по idempotency_key.
+
+Назначение хранится в outbox.queue: "stream:<ключ>" или имя списка.
+"""
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from aiogram import Bot
+
+from config import Settings
+
+log = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+STREAM_PREFIX = "stream:"
+
+
+def destination_for(settings: Settings) -> str:
+    """Куда отправлять новые заявки при текущих настройках (значение для outbox.queue)."""
+    if settings.redis_transport == "stream":
+        return f"{STREAM_PREFIX}{settings.redis_stream_name}"
+    return settings.redis_queue_name
+
+
+def stream_fields(payload: str, idempotency_key: str, message_type: str = "application") -> dict:
+    return {
+        "v": SCHEMA_VERSION,
+        "type": message_type,
+        "idempotency_key": idempotency_key,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "payload": payload,
+    }
+
+
+def enqueue(pipe, destination: str, payload: str, idempotency_key: str, maxlen: int):
+    """Добавляет команду отправки в pipeline согласно назначению."""
+    if destination.startswith(STREAM_PREFIX):
+        # approximate=True (~) - обрезка целыми узлами, почти бесплатная
+        pipe.xadd(destination[len(STREAM_PREFIX):], stream_fields(payload, idempotency_key), maxlen=maxlen, approximate=True)
+    else:
+        pipe.rpush(destination, payload)
+
+
+async def ensure_consumer_group(redis_client, stream: str, group: str):
+    """Создает consumer group (и сам stream), если их еще нет."""
+    try:
+        await redis_client.xgroup_create(stream, group, id="0", mkstream=True)
+        log.info(f"[Stream] Consumer group '{group}' created on '{stream}'")
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+class StreamConsumer:
+    """
+    Эталонный потребитель для обработчика сделок:
+
+        consumer = StreamConsumer(redis_client, stream, group, "processor-1")
+        for entry_id, fields in await consumer.read():
+            save_deal(fields)           # идемпотентно по fields["idempotency_key"]
+            await consumer.ack([entry_id])
+    """
+    def __init__(self, redis_client, stream: str, group: str, name: str, min_idle_ms: int = 60000):
+        self.redis = redis_client
+        self.stream = stream
+        self.group = group
+        self.name = name
+        self.min_idle_ms = min_idle_ms
+
+    async def read(self, count: int = 100, block_ms: int = 5000) -> list[tuple[str, dict]]:
+        # 1. Сначала забираем записи, зависшие у упавших потребителей
+        _, claimed, *_ = await self.redis.xautoclaim(
+            self.stream, self.group, self.name, min_idle_time=self.min_idle_ms, start_id="0-0", count=count
+        )
+        if claimed:
+            return [(entry_id, fields) for entry_id, fields in claimed if fields]
+        # 2. Затем новые
+        response = await self.redis.xreadgroup(self.group, self.name, {self.stream: ">"}, count=count, block=block_ms)
+        return [entry for _, entries in response for entry in entries]
+
+    async def ack(self, entry_ids: list[str]) -> int:
+        return await self.redis.xack(self.stream, self.group, *entry_ids) if entry_ids else 0
+
+
+class StreamLagMonitor:
+    """Следит за PEL группы и отставанием потребителей, шлет алерт в технический чат."""
+    def __init__(self):
+        self._last_alert_at: Optional[float] = None
+
+    async def check(self, redis_client, bot: Bot, settings: Settings):
+        stream, group = settings.redis_stream_name, settings.redis_stream_group
+        try:
+            groups = await redis_client.xinfo_groups(stream)
+        except Exception as e:
+            log.warning(f"[Stream] XINFO GROUPS failed for '{stream}': {e}")
+            return
+        info = next((g for g in groups if g.get("name") == group), None)
+        if info is None:
+            return
+
+        pending = int(info.get("pending") or 0)
+        lag = info.get("lag")  # Redis 7+: сколько записей еще не выдано группе
+        oldest_idle_seconds = 0.0
+        if pending:
+            oldest = await redis_client.xpending_range(stream, group, min="-", max="+", count=1)
+            if oldest:
+                oldest_idle_seconds = oldest[0]["time_since_delivered"] / 1000
+
+        log.info(f"[Stream] {stream}/{group}: pending={pending}, lag={lag}, oldest idle={oldest_idle_seconds:.0f}s")
+        problem = (
+            pending >= settings.redis_stream_pending_alert
+            or (lag is not None and int(lag) >= settings.redis_stream_pending_alert)
+            or oldest_idle_seconds >= settings.redis_stream_idle_alert_seconds
+        )
+        if not problem:
+            return
+
+        now = time.monotonic()
+        if self._last_alert_at is not None and now - self._last_alert_at < settings.redis_stream_alert_cooldown_seconds:
+            return
+        self._last_alert_at = now
+        text = (
+            f"⚠️ <b>Очередь заявок отстает</b>\n\n"
+            f"Stream: <code>{stream}</code>, группа <code>{group}</code>\n"
+            f"Неподтвержденных (PEL): <b>{pending}</b>\n"
+            f"Не выдано потребителям: <b>{lag if lag is not None else '—'}</b>\n"
+            f"Самая старая без ACK: <b>{oldest_idle_seconds / 60:.0f} мин</b>"
+        )
+        try:
+            await bot.send_message(settings.technical_chat_id, text, parse_mode="HTML")
+        except Exception as e:
+            log.error(f"[Stream] Lag alert failed: {e}")
+
+
+stream_lag_monitor = StreamLagMonitor()
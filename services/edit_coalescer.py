@@ -0,0 +1,95 @@
+"""
+Склейка серий правок одного сообщения.
+
+Клиент или менеджер, исправляющий опечатку несколько раз подряд, порождает
+серию edited_message. Вместо того чтобы на каждую правку обновлять лог
+и дергать Bot API, правка откладывается на edit_debounce_seconds: каждая
+следующая правка того же сообщения заменяет предыдущую и продлевает окно.
+По истечении окна применяется только последний текст - одна запись в лог
+и одно обращение к Bot API на серию.
+
+Отложенное применение выполняется вне апдейта, поэтому сессию БД
+открывает сам коалесер (session_pool задается в configure()).
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from monitoring.instrumentation import instrumentation
+
+log = logging.getLogger(__name__)
+
+ApplyEdit = Callable[[AsyncSession, Any], Awaitable[None]]
+
+
+@dataclass
+class _PendingEdit:
+    payload: Any
+    apply: ApplyEdit
+    order: Any
+    deadline: float
+    coalesced: int = 0
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+
+class EditCoalescer:
+    def __init__(self, debounce_seconds: float = 3.0):
+        self.debounce_seconds = debounce_seconds
+        self.session_pool: Optional[async_sessionmaker] = None
+        self._pending: dict[Hashable, _PendingEdit] = {}
+
+    def configure(self, session_pool: async_sessionmaker, debounce_seconds: float):
+        self.session_pool = session_pool
+        self.debounce_seconds = debounce_seconds
+
+    def submit(self, key: Hashable, payload: Any, apply: ApplyEdit, order: Any = None):
+        """
+        Откладывает правку. Правка с меньшим order (например, edit_date), пришедшая
+        после более новой, отбрасывается.
+        """
+        deadline = time.monotonic() + self.debounce_seconds
+        pending = self._pending.get(key)
+        if pending is not None:
+            if order is not None and pending.order is not None and order < pending.order:
+                return
+            pending.payload, pending.apply, pending.order = payload, apply, order
+            pending.deadline = deadline
+            pending.coalesced += 1
+            return
+
+        pending = _PendingEdit(payload=payload, apply=apply, order=order, deadline=deadline)
+        self._pending[key] = pending
+        pending.task = asyncio.create_task(self._wait_and_apply(key, pending))
+
+    async def _wait_and_apply(self, key: Hashable, pending: _PendingEdit):
+        # Каждая новая правка сдвигает deadline - досыпаем до последнего
+        while (delay := pending.deadline - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        if self._pending.get(key) is pending:
+            del self._pending[key]
+            await self._apply(key, pending)
+
+    async def _apply(self, key: Hashable, pending: _PendingEdit):
+        if pending.coalesced:
+            log.info(f"[Edits] {key}: {pending.coalesced + 1} edits coalesced into one")
+        try:
+            async with instrumentation.track(pending.apply.__name__):
+                async with self.session_pool() as session:
+                    await pending.apply(session, pending.payload)
+        except Exception as e:
+            log.error(f"[Edits] Failed to apply edit {key}: {e}")
+
+    async def flush(self):
+        """Применяет все отложенные правки сразу (при остановке бота)."""
+        pending_edits, self._pending = self._pending, {}
+        for key, pending in pending_edits.items():
+            if pending.task is not None:
+                pending.task.cancel()
+            await self._apply(key, pending)
+
+
+edit_coalescer = EditCoalescer()
@@ -0,0 +1,324 @@
+"""
+Кэш выдачи поиска по Базе Знаний.
+
+Менеджеры повторяют одни и те же запросы ("верификация", "#btc") сотни раз в день.
+Выдача кэшируется по нормализованному запросу:
+- локально в процессе (LRU + TTL);
+- при подключенном Redis - еще и общим слоем для всех реплик бота.
+
+Инвалидация точечная: когда index_kb_content видит новый или измененный пост,
+сбрасываются только запросы, чьи термины (основы слов, хештеги, префиксы,
+а для запросов с опечаткой или в другой раскладке - еще и исправленные термины)
+встречаются в посте, и запросы, в выдаче которых этот пост уже был.
+Другие реплики узнают о сброшенных ключах через pub/sub.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import Iterable, Optional
+
+from services.kb_search import KBSearchHit, parse_query, tokenize
+
+log = logging.getLogger(__name__)
+
+REDIS_PREFIX = "kb:cache"
+INVALIDATION_CHANNEL = f"{REDIS_PREFIX}:invalidate"
+# Префиксы закэшированных запросов (sorted set, score - когда истекает последний тег p:<префикс>)
+PREFIXES_KEY = f"{REDIS_PREFIX}:prefix_index"
+# Паузы между попытками переподключить слушателя инвалидаций
+LISTENER_RETRY_MIN_SECONDS = 1
+LISTENER_RETRY_MAX_SECONDS = 60
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+@dataclass
+class _Entry:
+    hits: list[KBSearchHit]
+    terms: frozenset[str]
+    prefixes: frozenset[str]
+    expires_at: float
+
+
+@dataclass
+class CacheStats:
+    local_hits: int = 0
+    redis_hits: int = 0
+    misses: int = 0
+    invalidated: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.local_hits + self.redis_hits + self.misses
+        return (self.local_hits + self.redis_hits) / total if total else 0.0
+
+
+def _query_terms(normalized: str) -> tuple[frozenset[str], frozenset[str]]:
+    """Термины запроса, по которым его нужно сбрасывать: точные и префиксы."""
+    terms, prefixes = set(), set()
+    for clause in parse_query(normalized):
+        if clause.is_prefix:
+            prefixes.add(clause.terms[0])
+        else:
+            terms.update(clause.terms)
+    return frozenset(terms), frozenset(prefixes)
+
+
+def _post_terms(text: str, keywords: Optional[str]) -> set[str]:
+    # Исходные формы слов тоже термины индекса: запросы по ним должны сбрасываться
+    forms = []
+    terms = set(tokenize(text or "", forms)) | set(tokenize(keywords or ""))
+    return terms | set(forms)
+
+
+class KBQueryCache:
+    def __init__(self, max_size: int = 2000, ttl_seconds: int = 600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.redis = None
+        self.stats = CacheStats()
+        # Растет при каждой инвалидации: выдачу, посчитанную до нее, класть в кэш нельзя
+        self.generation = 0
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._by_term: dict[str, set[str]] = {}
+        self._by_prefix: dict[str, set[str]] = {}
+        self._by_message: dict[int, set[str]] = {}
+
+    def configure(self, max_size: int, ttl_seconds: int, redis=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.redis = redis
+
+    @staticmethod
+    def make_key(query: str, backend: str) -> str:
+        return f"{backend}|{normalize_query(query)}"
+
+    @staticmethod
+    def _redis_key(key: str) -> str:
+        return f"{REDIS_PREFIX}:q:{hashlib.sha1(key.encode()).hexdigest()}"
+
+    # --- Чтение и запись ---
+
+    async def get(self, key: str) -> Optional[list[KBSearchHit]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats.local_hits += 1
+                return entry.hits
+            self._drop(key)
+
+        if self.redis is not None:
+            try:
+                raw = await self.redis.get(self._redis_key(key))
+            except Exception as e:
+                log.warning(f"[KB cache] Redis get failed: {e}")
+                raw = None
+            if raw:
+                hits = [KBSearchHit(**item) for item in json.loads(raw)]
+                self._store(key, hits)
+                self.stats.redis_hits += 1
+                return hits
+
+        self.stats.misses += 1
+        return None
+
+    async def put(
+        self, key: str, hits: list[KBSearchHit], generation: Optional[int] = None, extra_terms: Iterable[str] = ()
+    ):
+        """extra_terms - термины, найденные поиском вместо слов запроса (исправление опечаток и раскладки)."""
+        if generation is not None and generation != self.generation:
+            return
+        entry = self._store(key, hits, extra_terms)
+        if self.redis is None:
+            return
+
+        # В Redis храним выдачу и теги: по термину/префиксу/посту -> ключи запросов
+        redis_key = self._redis_key(key)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.set(redis_key, json.dumps([asdict(hit) for hit in hits], ensure_ascii=False), ex=self.ttl_seconds)
+                tags = [f"{REDIS_PREFIX}:t:{term}" for term in entry.terms]
+                tags += [f"{REDIS_PREFIX}:p:{prefix}" for prefix in entry.prefixes]
+                tags += [f"{REDIS_PREFIX}:m:{hit.message_id}" for hit in hits]
+                for tag in tags:
+                    pipe.sadd(tag, key)
+                    pipe.expire(tag, self.ttl_seconds)
+                if entry.prefixes:
+                    expires_at = time.time() + self.ttl_seconds
+                    pipe.zadd(PREFIXES_KEY, {prefix: expires_at for prefix in entry.prefixes})
+                    pipe.expire(PREFIXES_KEY, self.ttl_seconds)
+                await pipe.execute()
+        except Exception as e:
+            log.warning(f"[KB cache] Redis put failed: {e}")
+
+    def _store(self, key: str, hits: list[KBSearchHit], extra_terms: Iterable[str] = ()) -> _Entry:
+        self._drop(key)
+        terms, prefixes = _query_terms(key.split("|", 1)[1])
+        terms |= frozenset(extra_terms)
+        entry = _Entry(hits=hits, terms=terms, prefixes=prefixes, expires_at=time.monotonic() + self.ttl_seconds)
+        self._entries[key] = entry
+        for term in terms:
+            self._by_term.setdefault(term, set()).add(key)
+        for prefix in prefixes:
+            self._by_prefix.setdefault(prefix, set()).add(key)
+        for hit in hits:
+            self._by_message.setdefault(hit.message_id, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+        return entry
+
+    def _drop(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for index, values in ((self._by_term, entry.terms), (self._by_prefix, entry.prefixes),
+                              (self._by_message, (hit.message_id for hit in entry.hits))):
+            for value in values:
+                keys = index.get(value)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del index[value]
+        return True
+
+    # --- Инвалидация ---
+
+    def _affected_keys(self, message_id: int, terms: set[str]) -> set[str]:
+        keys = set(self._by_message.get(message_id, ()))
+        for term in terms:
+            keys.update(self._by_term.get(term, ()))
+        for prefix, prefix_keys in self._by_prefix.items():
+            if any(term.startswith(prefix) for term in terms):
+                keys.update(prefix_keys)
+        return keys
+
+    async def invalidate_post(self, message_id: int, text: str, keywords: Optional[str] = None) -> int:
+        """Сбрасывает запросы, на выдачу которых мог повлиять новый или измененный пост."""
+        self.generation += 1
+        terms = _post_terms(text, keywords)
+        keys = self._affected_keys(message_id, terms)
+        for key in keys:
+            self._drop(key)
+
+        if self.redis is not None:
+            try:
+                # Запись, поднятая из Redis, не знает исправленных терминов - ее находим по тегам в Redis
+                redis_keys = await self._invalidate_redis(message_id, terms)
+                for key in redis_keys - keys:
+                    self._drop(key)
+                keys |= redis_keys
+            except Exception as e:
+                log.warning(f"[KB cache] Redis invalidation failed: {e}")
+
+        self.stats.invalidated += len(keys)
+        if keys:
+            log.info(f"[KB cache] Post {message_id} changed, invalidated {len(keys)} cached queries")
+        return len(keys)
+
+    async def _invalidate_redis(self, message_id: int, terms: set[str]) -> set[str]:
+        # Префиксы, чьи теги уже истекли, выбрасываем - набор не растет со временем
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(PREFIXES_KEY, "-inf", now)
+            pipe.zrange(PREFIXES_KEY, 0, -1)
+            _, prefixes = await pipe.execute()
+        tags = [f"{REDIS_PREFIX}:m:{message_id}"]
+        tags += [f"{REDIS_PREFIX}:t:{term}" for term in terms]
+        tags += [f"{REDIS_PREFIX}:p:{prefix}" for prefix in prefixes
+                 if any(term.startswith(prefix) for term in terms)]
+
+        keys = set(await self.redis.sunion(tags))
+        if keys:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.delete(*(self._redis_key(key) for key in keys))
+                pipe.publish(INVALIDATION_CHANNEL, json.dumps(sorted(keys), ensure_ascii=False))
+                await pipe.execute()
+        return keys
+
+    async def listen_invalidations(self):
+        """
+        Фоновая задача: сбрасывает локальные записи, удаленные другой репликой.
+        При обрыве переподключается с нарастающей паузой; сообщения, пропущенные
+        за время обрыва, не вернуть - поэтому после переподписки локальный слой очищается.
+        """
+        if self.redis is None:
+            return
+        delay = LISTENER_RETRY_MIN_SECONDS
+        reconnect = False
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                if reconnect:
+                    self._clear_local()
+                    log.info("[KB cache] Invalidation listener reconnected, local cache cleared")
+                delay = LISTENER_RETRY_MIN_SECONDS
+                while True:
+                    # get_message с таймаутом, а не listen(): у соединений пула есть socket_timeout
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is None or message.get("type") != "message":
+                        continue
+                    for key in json.loads(message["data"]):
+                        self._drop(key)
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                log.error(f"[KB cache] Invalidation listener failed, reconnecting in {delay}s: {e}")
+                reconnect = True
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTENER_RETRY_MAX_SECONDS)
+
+    def _clear_local(self):
+        self.generation += 1
+        self._entries.clear()
+        self._by_term.clear()
+        self._by_prefix.clear()
+        self._by_message.clear()
+
+    async def clear(self):
+        """Полный сброс кэша (после массовой переиндексации)."""
+        self._clear_local()
+        if self.redis is None:
+            return
+        try:
+            batch = []
+            async for key in self.redis.scan_iter(match=f"{REDIS_PREFIX}:*", count=1000):
+                batch.append(key)
+                if len(batch) >= 1000:
+                    await self.redis.delete(*batch)
+                    batch = []
+            if batch:
+                await self.redis.delete(*batch)
+        except Exception as e:
+            log.warning(f"[KB cache] Redis clear failed: {e}")
+
+    # --- Статистика ---
+
+    def report(self, reset: bool = True) -> str:
+        stats = self.stats
+        elapsed = time.monotonic() - stats.started_at
+        text = (
+            f"[KB cache] {elapsed / 60:.0f} min: hit rate {stats.hit_rate:.1%} "
+            f"(local {stats.local_hits}, redis {stats.redis_hits}, misses {stats.misses}), "
+            f"invalidated {stats.invalidated}, entries {len(self._entries)}"
+        )
+        if reset:
+            self.stats = CacheStats()
+        return text
+
+
+kb_cache = KBQueryCache()
@@ -0,0 +1,123 @@
+"""
+Нечеткий поиск терминов Базы Знаний: опечатки и неверная раскладка клавиатуры.
+
+- Триграммный индекс по всем терминам индекса (основам слов и хештегам) дает
+  кандидатов, похожих на слово запроса.
+- Кандидаты ранжируются расстоянием Дамерау-Левенштейна (с ограничением сверху),
+  при равенстве - частотой термина в Базе Знаний.
+- "Dthbabrfwbz" / "ифтл" переводятся в другую раскладку (ЙЦУКЕН <-> QWERTY).
+
+Подбор укладывается в бюджет времени: при исчерпании возвращается лучшее найденное.
+"""
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+_RU = "йцукенгшщзхъфывапролджэячсмитьбю"
+_EN = "qwertyuiop[]asdfghjkl;'zxcvbnm,."
+_EN_TO_RU = str.maketrans(_EN, _RU)
+_RU_TO_EN = str.maketrans(_RU, _EN)
+
+# Минимальная длина слова, которое имеет смысл исправлять
+MIN_FUZZY_LENGTH = 3
+# Сколько кандидатов с наибольшим числом общих триграмм проверять расстоянием
+MAX_CANDIDATES = 50
+
+
+def switch_layout(word: str) -> str:
+    """Переводит слово, набранное не в той раскладке: 'dthbabrfwbz' -> 'верификация'."""
+    word = word.lower()
+    if any("a" <= ch <= "z" for ch in word):
+        return word.translate(_EN_TO_RU)
+    return word.translate(_RU_TO_EN)
+
+
+def trigrams(term: str) -> set[str]:
+    padded = f"${term}$"
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def max_distance_for(term: str) -> int:
+    return 1 if len(term) <= 4 else 2
+
+
+def damerau_levenshtein(a: str, b: str, max_distance: int) -> int:
+    """
+    Расстояние Дамерау-Левенштейна (с перестановкой соседних букв).
+    Если оно больше max_distance, возвращает max_distance + 1, не досчитывая матрицу.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous: Optional[list[int]] = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (previous_previous is not None and j > 1
+                    and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class TrigramIndex:
+    def __init__(self):
+        self._terms_by_trigram: dict[str, set[str]] = {}
+
+    def add_term(self, term: str):
+        if len(term) < MIN_FUZZY_LENGTH:
+            return
+        for trigram in trigrams(term):
+            self._terms_by_trigram.setdefault(trigram, set()).add(term)
+
+    def remove_term(self, term: str):
+        for trigram in trigrams(term):
+            terms = self._terms_by_trigram.get(trigram)
+            if terms is not None:
+                terms.discard(term)
+                if not terms:
+                    del self._terms_by_trigram[trigram]
+
+    def suggest(
+        self,
+        term: str,
+        frequency: Callable[[str], int],
+        deadline: float,
+        limit: int = 3
+    ) -> list[tuple[str, int]]:
+        """
+        Похожие термины индекса: [(термин, расстояние), ...], лучшие первыми.
+        deadline - момент time.perf_counter(), после которого поиск прекращается.
+        """
+        if len(term) < MIN_FUZZY_LENGTH:
+            return []
+        max_distance = max_distance_for(term)
+        query_trigrams = trigrams(term)
+        # Слова на расстоянии k делят хотя бы |T| - 3k триграмм
+        min_shared = max(1, len(query_trigrams) - 3 * max_distance)
+
+        shared: Counter = Counter()
+        for trigram in query_trigrams:
+            shared.update(self._terms_by_trigram.get(trigram, ()))
+            if time.perf_counter() > deadline:
+                break
+
+        scored = []
+        for candidate, count in shared.most_common(MAX_CANDIDATES):
+            if count < min_shared:
+                break
+            if time.perf_counter() > deadline:
+                break
+            if candidate == term:
+                continue
+            distance = damerau_levenshtein(term, candidate, max_distance)
+            if distance <= max_distance:
+                scored.append((distance, -frequency(candidate), candidate))
+
+        scored.sort()
+        return [(candidate, distance) for distance, _, candidate in scored[:limit]]
@@ -0,0 +1,104 @@
+"""
+Поиск по Базе Знаний в инлайн-режиме: менеджер пишет "@bot запрос" в любом топике.
+
+На каждое нажатие клавиши Telegram присылает новый inline_query, поэтому:
+- выдача строится только по индексу в памяти (services/kb_search.py), без SQL;
+- результаты кэшируются по нормализованному запросу и версии индекса;
+- проверка "сотрудник ли это" кэшируется на время staff_ttl_seconds; inline_query
+  может прислать любой пользователь Telegram, поэтому кэш ограничен и по размеру.
+
+Инлайн-режим должен быть включен у бота в @BotFather (/setinline).
+"""
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from aiogram.types import InlineQueryResultArticle, InputTextMessageContent
+
+from services.kb_search import KBIndex, KBSearchHit, kb_index
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+class InlineKBSearch:
+    def __init__(
+        self, index: KBIndex, max_queries: int = 1000, max_hits: int = 50,
+        staff_ttl_seconds: int = 600, max_staff: int = 5000
+    ):
+        self.index = index
+        self.max_queries = max_queries
+        self.max_hits = max_hits
+        self.staff_ttl_seconds = staff_ttl_seconds
+        self.max_staff = max_staff
+        # (запрос, версия индекса) -> выдача
+        self._hits: OrderedDict[tuple[str, int], list[KBSearchHit]] = OrderedDict()
+        # telegram_id -> (сотрудник?, когда проверили), в порядке проверки: самые старые в начале
+        self._staff: OrderedDict[int, tuple[bool, float]] = OrderedDict()
+
+    def configure(self, max_queries: int, max_hits: int, staff_ttl_seconds: int, max_staff: int):
+        self.max_queries = max_queries
+        self.max_hits = max_hits
+        self.staff_ttl_seconds = staff_ttl_seconds
+        self.max_staff = max_staff
+
+    # --- Права ---
+
+    def cached_staff(self, telegram_id: int) -> Optional[bool]:
+        cached = self._staff.get(telegram_id)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[1] > self.staff_ttl_seconds:
+            del self._staff[telegram_id]
+            return None
+        return cached[0]
+
+    def remember_staff(self, telegram_id: int, is_staff: bool):
+        now = time.monotonic()
+        self._staff.pop(telegram_id, None)
+        self._staff[telegram_id] = (is_staff, now)
+        # Сначала истекшие, затем самые давние проверки сверх лимита
+        while self._staff:
+            oldest_id, (_, checked_at) = next(iter(self._staff.items()))
+            if now - checked_at <= self.staff_ttl_seconds and len(self._staff) <= self.max_staff:
+                break
+            del self._staff[oldest_id]
+
+    # --- Выдача ---
+
+    def search(self, query: str) -> list[KBSearchHit]:
+        key = (normalize_query(query), self.index.version)
+        hits = self._hits.get(key)
+        if hits is not None:
+            self._hits.move_to_end(key)
+            return hits
+
+        # Последнее слово еще набирается - ищем его по префиксу
+        hits = self.index.search(query, limit=self.max_hits, prefix_last=True)
+        self._hits[key] = hits
+        while len(self._hits) > self.max_queries:
+            self._hits.popitem(last=False)
+        return hits
+
+    def build_results(self, query: str, offset: int, page_size: int) -> tuple[list[InlineQueryResultArticle], str]:
+        """Возвращает страницу результатов и next_offset для answer_inline_query."""
+        hits = self.search(query)
+        page = hits[offset:offset + page_size]
+        results = []
+        for hit in page:
+            text = self.index.get_text(hit.message_id)
+            if not text:
+                continue
+            results.append(InlineQueryResultArticle(
+                id=str(hit.message_id),
+                title=hit.title,
+                description=hit.snippet,
+                # В чат уходит сам пост: менеджер отвечает клиенту текстом из Базы Знаний
+                input_message_content=InputTextMessageContent(message_text=text)
+            ))
+        next_offset = str(offset + page_size) if offset + page_size < len(hits) else ""
+        return results, next_offset
+
+
+inline_kb_search = InlineKBSearch(kb_index)
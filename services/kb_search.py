@@ -0,0 +1,441 @@
+"""
+Поисковый движок по Базе Знаний в памяти процесса.
+
+Инвертированный индекс по тексту постов и их хештегам:
+- русские слова приводятся к основе стеммером (services/ru_stemmer.py), а если основа
+  отличается от слова - индексируется и само слово: стеммер режет формы одного слова
+  по-разному ("лимит" -> "лим", "лимиты" -> "лимит"), исходная форма их связывает;
+- ранжирование BM25, хештеги из keywords весят больше слов текста;
+- "фраза в кавычках" ищет слова подряд, слово* - по префиксу, #тег - точный хештег;
+- слово, которого нет в индексе, исправляется: неверная раскладка и опечатки
+  (триграммы + расстояние Дамерау-Левенштейна, services/kb_fuzzy.py).
+
+Индекс обновляется инкрементально из index_kb_content и может быть
+полностью перестроен из таблицы knowledge_base.
+"""
+import asyncio
+import bisect
+import logging
+import math
+import re
+import sys
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.models import KnowledgeBaseEntry
+from services.kb_fuzzy import TrigramIndex, switch_layout
+from services.ru_stemmer import stem
+
+log = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"#?[0-9a-zа-яё_]+", re.IGNORECASE)
+_QUERY_RE = re.compile(r'"([^"]+)"|(\S+)')
+_HASHTAG_RE = re.compile(r"#\w+")
+
+# Параметры BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Хештег из keywords считается как несколько вхождений слова
+KEYWORD_BOOST = 3
+# Исправленное слово весит меньше: множитель за каждую правку
+FUZZY_PENALTY = 0.7
+# Ключ Redis с версией содержимого knowledge_base: его увеличивает массовая
+# загрузка (kb_backfill.py), а бот по нему понимает, что индекс пора перестроить
+INDEX_VERSION_KEY = "kb:index_version"
+# Сколько текста поста храним в памяти: целиком (лимит сообщения Telegram),
+# чтобы инлайн-режим мог подставить пост без запроса в БД
+STORED_TEXT_LENGTH = 4096
+
+
+def tokenize(text: str, forms: Optional[list[str]] = None) -> list[str]:
+    """
+    Разбивает текст на термины: основы слов и хештеги.
+    Хештег дает два термина: '#btc' (точный) и 'btc' (как обычное слово).
+    forms - если передан, сюда добавляются слова в исходной форме там, где стеммер их изменил.
+    """
+    terms = []
+    for raw in _TOKEN_RE.findall(text.lower()):
+        if raw.startswith("#"):
+            if len(raw) > 1:
+                terms.append(sys.intern(raw))
+                terms.append(_stem_word(raw[1:], forms))
+        else:
+            terms.append(_stem_word(raw, forms))
+    return terms
+
+
+def _stem_word(word: str, forms: Optional[list[str]]) -> str:
+    base = sys.intern(stem(word))
+    if forms is not None and base != word:
+        forms.append(sys.intern(word))
+    return base
+
+
+def _word_variants(word: str) -> list[str]:
+    """Термины одного слова запроса: основа и, если она отличается, само слово."""
+    forms = []
+    return [_stem_word(word, forms), *forms]
+
+
+def _query_word_terms(word: str) -> list[list[str]]:
+    """
+    Части слова запроса (оно может распасться на несколько терминов) с их вариантами.
+    Хештег внутри слова дает, как и в tokenize, точный хештег и слово.
+    """
+    parts = []
+    for raw in _TOKEN_RE.findall(word.lower()):
+        if raw.startswith("#"):
+            parts.extend([term] for term in tokenize(raw))
+        else:
+            parts.append(_word_variants(raw))
+    return parts
+
+
+@dataclass
+class KBSearchHit:
+    message_id: int
+    score: float
+    title: str
+    snippet: str
+
+
+@dataclass
+class _Document:
+    length: int
+    vocabulary: tuple[str, ...]  # Уникальные термины поста (для удаления из индекса)
+    terms: tuple[str, ...]       # Последовательность терминов текста (для поиска фраз)
+    text: str                    # Усеченный текст для заголовка и сниппета
+
+
+@dataclass
+class _Clause:
+    """Одна часть запроса: слово, префикс, хештег или фраза."""
+    terms: list[str]
+    raw: str
+    is_phrase: bool = False
+    is_prefix: bool = False
+
+
+def parse_query(query: str, prefix_last: bool = False) -> list[_Clause]:
+    clauses = []
+    for phrase, word in _QUERY_RE.findall(query.lower()):
+        if phrase:
+            terms = tokenize(phrase)
+            if terms:
+                clauses.append(_Clause(terms=terms, raw=phrase, is_phrase=len(terms) > 1))
+            continue
+
+        is_prefix = word.endswith("*")
+        word = word.rstrip("*")
+        terms = tokenize(word)
+        if not terms:
+            continue
+        if word.startswith("#"):
+            # Точный хештег: только термин с решеткой
+            clauses.append(_Clause(terms=terms[:1], raw=word))
+            continue
+        # Любой из терминов части слова (основа или исходная форма) засчитывает ее
+        clauses.extend(_Clause(terms=terms, raw=word, is_prefix=is_prefix) for terms in _query_word_terms(word))
+
+    # В инлайн-режиме последнее слово еще дописывается - ищем по префиксу
+    if prefix_last and clauses and not clauses[-1].is_phrase and not query.endswith((" ", '"')):
+        clauses[-1].is_prefix = True
+    return clauses
+
+
+class KBIndex:
+    def __init__(self):
+        self._docs: dict[int, _Document] = {}
+        self._postings: dict[str, dict[int, int]] = {}
+        self._total_length = 0
+        self._vocabulary: list[str] = []
+        self._vocabulary_dirty = False
+        self._fuzzy = TrigramIndex()
+        self.fuzzy_enabled = True
+        self.fuzzy_budget_seconds = 0.02
+        self._lock = asyncio.Lock()
+        self.ready = False
+        # Растет при любом изменении индекса: по нему кэши выдачи понимают, что устарели
+        self.version = 0
+        # Значение INDEX_VERSION_KEY, с которым индекс был построен последний раз
+        self.external_version: Optional[str] = None
+        # Пока идет rebuild: посты, добавленные (text, keywords) или удаленные (None) за это время
+        self._touched: Optional[dict[int, Optional[tuple[str, Optional[str]]]]] = None
+
+    def __len__(self):
+        return len(self._docs)
+
+    def configure_fuzzy(self, enabled: bool, budget_ms: int):
+        self.fuzzy_enabled = enabled
+        self.fuzzy_budget_seconds = budget_ms / 1000
+
+    def get_text(self, message_id: int) -> Optional[str]:
+        doc = self._docs.get(message_id)
+        return doc.text if doc is not None else None
+
+    # --- Обновление ---
+
+    def add(self, message_id: int, text: str, keywords: Optional[str] = None):
+        """Добавляет или заменяет пост в индексе."""
+        self.remove(message_id)
+        self.version += 1
+        if self._touched is not None:
+            self._touched[message_id] = (text, keywords)
+
+        forms = []
+        terms = tokenize(text, forms)
+        counts = Counter(terms)
+        for tag in _HASHTAG_RE.findall((keywords or "").lower()):
+            counts[sys.intern(tag)] += KEYWORD_BOOST
+        if not counts:
+            return
+
+        length = sum(counts.values())
+        # Исходные формы слов - дополнительные термины для поиска, длину поста не меняют
+        counts.update(forms)
+        self._docs[message_id] = _Document(
+            length=length,
+            vocabulary=tuple(counts),
+            terms=tuple(t for t in terms if not t.startswith("#")),
+            text=text[:STORED_TEXT_LENGTH]
+        )
+        self._total_length += length
+        for term, tf in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                self._vocabulary_dirty = True
+                self._fuzzy.add_term(term)
+            postings[message_id] = tf
+
+    def remove(self, message_id: int):
+        if self._touched is not None:
+            self._touched[message_id] = None
+        doc = self._docs.pop(message_id, None)
+        if doc is None:
+            return
+        self.version += 1
+        self._total_length -= doc.length
+        for term in doc.vocabulary:
+            postings = self._postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(message_id, None)
+            if not postings:
+                del self._postings[term]
+                self._vocabulary_dirty = True
+                self._fuzzy.remove_term(term)
+
+    async def rebuild(self, session: AsyncSession, batch_size: int = 1000):
+        """
+        Полностью перестраивает индекс из таблицы knowledge_base (потоково, пачками).
+        Посты, которые add/remove изменили за время чтения, переносятся в новый индекс
+        перед подменой: их версия новее той, что могла попасть в выборку.
+        """
+        async with self._lock:
+            started = time.perf_counter()
+            fresh = KBIndex()
+            self._touched = {}
+            try:
+                stmt = (
+                    select(KnowledgeBaseEntry.message_id, KnowledgeBaseEntry.text, KnowledgeBaseEntry.keywords)
+                    .execution_options(yield_per=batch_size)
+                )
+                result = await session.stream(stmt)
+                async for message_id, text, keywords in result:
+                    if text:
+                        fresh.add(message_id, text, keywords)
+
+                # Без await до подмены: новых изменений между переносом и подменой не будет
+                for message_id, post in self._touched.items():
+                    if post is None:
+                        fresh.remove(message_id)
+                    else:
+                        fresh.add(message_id, *post)
+            finally:
+                self._touched = None
+
+            self._docs = fresh._docs
+            self._postings = fresh._postings
+            self._total_length = fresh._total_length
+            self._fuzzy = fresh._fuzzy
+            self._vocabulary_dirty = True
+            self.version += 1
+            self.ready = True
+            log.info(f"[KB] Index rebuilt: {len(self._docs)} posts, {len(self._postings)} terms "
+                     f"in {time.perf_counter() - started:.2f}s")
+
+    # --- Поиск ---
+
+    def _expand(self, clause_term: str, is_prefix: bool) -> list[str]:
+        if not is_prefix:
+            return [clause_term] if clause_term in self._postings else []
+        if self._vocabulary_dirty:
+            self._vocabulary = sorted(self._postings)
+            self._vocabulary_dirty = False
+        position = bisect.bisect_left(self._vocabulary, clause_term)
+        expanded = []
+        while position < len(self._vocabulary) and self._vocabulary[position].startswith(clause_term):
+            expanded.append(self._vocabulary[position])
+            position += 1
+        return expanded
+
+    def _bm25(self, term: str, doc_id: int, avg_length: float) -> float:
+        postings = self._postings[term]
+        tf = postings[doc_id]
+        idf = math.log(1 + (len(self._docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+        norm = 1 - BM25_B + BM25_B * self._docs[doc_id].length / avg_length
+        return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+    @staticmethod
+    def _has_phrase(doc: _Document, phrase: list[str]) -> bool:
+        n = len(phrase)
+        terms = doc.terms
+        for i in range(len(terms) - n + 1):
+            if terms[i] == phrase[0] and list(terms[i:i + n]) == phrase:
+                return True
+        return False
+
+    def _score_clause(self, clause: _Clause, avg_length: float) -> dict[int, float]:
+        if clause.is_phrase:
+            if any(term not in self._postings for term in clause.terms):
+                return {}
+            candidates = set.intersection(*(set(self._postings[t]) for t in clause.terms))
+            return {
+                doc_id: sum(self._bm25(t, doc_id, avg_length) for t in clause.terms)
+                for doc_id in candidates
+                if self._has_phrase(self._docs[doc_id], clause.terms)
+            }
+
+        # Слово, префикс или хештег: берем лучший из подходящих терминов
+        scores: dict[int, float] = {}
+        for clause_term in clause.terms:
+            for term in self._expand(clause_term, clause.is_prefix):
+                for doc_id in self._postings[term]:
+                    score = self._bm25(term, doc_id, avg_length)
+                    if score > scores.get(doc_id, 0.0):
+                        scores[doc_id] = score
+        return scores
+
+    def _score_fuzzy(
+        self, clause: _Clause, avg_length: float, deadline: float, switched: set[str]
+    ) -> tuple[dict[int, float], Optional[str], list[str]]:
+        """
+        Слово не нашлось: пробуем другую раскладку, затем исправление опечатки.
+        Возвращает оценки, исправленное слово и термины индекса, по которым нашлись посты.
+        """
+        # 1. Неверная раскладка ("dthbabrfwbz"). Слово могло распасться на несколько
+        # частей (раскладочные ",.;[]" не входят в термины) - переводим его один раз
+        if clause.raw in switched:
+            return {}, None, []
+        switched.add(clause.raw)
+        switched_raw = switch_layout(clause.raw)
+        if clause.raw.startswith("#"):
+            layout_parts = [tokenize(switched_raw)[:1]]
+        else:
+            layout_parts = _query_word_terms(switched_raw)
+        scores: dict[int, float] = {}
+        for terms in layout_parts:
+            for doc_id, score in self._score_clause(_Clause(terms=terms, raw=switched_raw, is_prefix=clause.is_prefix), avg_length).items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        if scores:
+            return scores, switched_raw, [
+                t for terms in layout_parts for term in terms for t in self._expand(term, clause.is_prefix)
+            ]
+
+        # 2. Опечатка: похожие термины индекса, с понижением веса за каждую правку
+        if clause.is_prefix:
+            return {}, None, []
+        suggestions = self._fuzzy.suggest(
+            clause.terms[0],
+            frequency=lambda term: len(self._postings.get(term, ())),
+            deadline=deadline
+        )
+        for term, distance in suggestions:
+            penalty = FUZZY_PENALTY ** distance
+            for doc_id in self._postings.get(term, ()):
+                score = self._bm25(term, doc_id, avg_length) * penalty
+                if score > scores.get(doc_id, 0.0):
+                    scores[doc_id] = score
+        return scores, (suggestions[0][0] if suggestions else None), [term for term, _ in suggestions]
+
+    def search(
+        self, query: str, limit: int = 50, prefix_last: bool = False, corrected_terms: Optional[set[str]] = None
+    ) -> list[KBSearchHit]:
+        """
+        corrected_terms - если передан, сюда добавляются термины индекса, найденные вместо
+        слов запроса исправлением раскладки и опечаток (по ним кэш выдачи узнает об изменениях).
+        """
+        clauses = parse_query(query, prefix_last=prefix_last)
+        if not clauses or not self._docs:
+            return []
+
+        avg_length = self._total_length / len(self._docs)
+        deadline = time.perf_counter() + self.fuzzy_budget_seconds
+        switched: set[str] = set()
+        totals: dict[int, float] = {}
+        matched: Counter = Counter()
+        words = []
+        for clause in clauses:
+            scores = self._score_clause(clause, avg_length)
+            word = clause.raw
+            if not scores and self.fuzzy_enabled and not clause.is_phrase:
+                scores, corrected, terms = self._score_fuzzy(clause, avg_length, deadline, switched)
+                word = corrected or word
+                if corrected_terms is not None:
+                    corrected_terms.update(terms)
+            words.append(word.lstrip("#"))
+            for doc_id, score in scores.items():
+                totals[doc_id] = totals.get(doc_id, 0.0) + score
+                matched[doc_id] += 1
+
+        # Сначала посты, где совпало больше частей запроса, затем по BM25
+        ranked = sorted(totals, key=lambda doc_id: (matched[doc_id], totals[doc_id]), reverse=True)[:limit]
+        return [
+            KBSearchHit(
+                message_id=doc_id,
+                score=totals[doc_id],
+                title=make_title(self._docs[doc_id].text),
+                snippet=make_snippet(self._docs[doc_id].text, words)
+            )
+            for doc_id in ranked
+        ]
+
+
+def make_title(text: str, max_length: int = 80) -> str:
+    """Первая непустая строка поста без хештегов."""
+    for line in text.splitlines():
+        line = _HASHTAG_RE.sub("", line).strip()
+        if line:
+            return line if len(line) <= max_length else line[:max_length - 1].rstrip() + "…"
+    return "Без заголовка"
+
+
+def make_snippet(text: str, words: list[str], width: int = 160) -> str:
+    """Фрагмент текста вокруг первого найденного слова запроса."""
+    flat = " ".join(text.split())
+    lower = flat.lower()
+    position = -1
+    for word in words:
+        # Ищем по началу основы, чтобы находить и другие словоформы
+        needle = stem(word.split()[0]) if word.strip() else ""
+        if needle:
+            position = lower.find(needle)
+            if position != -1:
+                break
+
+    start = max(0, position - width // 3) if position != -1 else 0
+    snippet = flat[start:start + width]
+    if start > 0:
+        snippet = "…" + snippet
+    if start + width < len(flat):
+        snippet += "…"
+    return snippet
+
+
+kb_index = KBIndex()
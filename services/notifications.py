@@ -0,0 +1,37 @@
+"""
+Параллельная рассылка уведомлений по нескольким адресатам.
+
+Все отправки запускаются одновременно: общее время - самая долгая из них,
+а не сумма. Ошибка одного адресата не мешает остальным, итог пишется
+в лог одной строкой.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable
+
+log = logging.getLogger(__name__)
+
+
+async def fan_out(context: str, targets: dict[str, Awaitable]) -> dict[str, BaseException]:
+    """
+    Выполняет отправки {имя адресата: корутина} параллельно.
+
+    :param context: Что рассылается (для строки в логе), например "заявка <ключ>".
+    :return: Ошибки по адресатам, которым отправить не удалось.
+    """
+    started = time.perf_counter()
+    names = list(targets)
+    results = await asyncio.gather(*targets.values(), return_exceptions=True)
+
+    failed = {name: result for name, result in zip(names, results) if isinstance(result, BaseException)}
+    statuses = ", ".join(
+        f"{name}=FAILED({type(failed[name]).__name__}: {failed[name]})" if name in failed else f"{name}=ok"
+        for name in names
+    )
+    message = f"[Notify] {context}: {statuses} in {(time.perf_counter() - started) * 1000:.0f}ms"
+    if failed:
+        log.warning(message)
+    else:
+        log.info(message)
+    return failed
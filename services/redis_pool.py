@@ -0,0 +1,172 @@
+"""
+Общие подключения к Redis для всего бота.
+
+Один RedisManager на процесс: по ограниченному пулу соединений на каждую БД Redis
+(очередь/кэши - redis_db, FSM - redis_fsm_db) с таймаутами и health check.
+- BlockingConnectionPool: при исчерпании пула команда ждет свободное соединение
+  (redis_pool_timeout_seconds), а не открывает новые без ограничения;
+- socket_timeout должен быть больше самого долгого блокирующего чтения
+  (XREADGROUP BLOCK 5000 у потребителя событий сделок);
+- каждая команда и каждый pipeline попадают в гистограмму задержек
+  и в замер текущего апдейта (monitoring.instrumentation).
+"""
+import asyncio
+import bisect
+import logging
+import time
+from dataclasses import dataclass, field
+
+import redis.asyncio as redis
+from redis.asyncio.client import Pipeline
+
+from config import settings, Settings
+from monitoring.instrumentation import instrumentation
+
+log = logging.getLogger(__name__)
+
+# Границы корзин гистограммы, мс (последняя корзина - все, что дольше)
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+# Блокирующие чтения ждут данных, а не Redis: в гистограмму и алерты их не пишем
+BLOCKING_COMMANDS = frozenset({"XREADGROUP", "XREAD", "BLPOP", "BRPOP", "BLMOVE", "BZPOPMIN", "BZPOPMAX"})
+
+
+@dataclass
+class LatencyHistogram:
+    counts: list = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1))
+    total: int = 0
+    total_ms: float = 0.0
+    max_ms: float = 0.0
+    errors: int = 0
+
+    def observe(self, duration_ms: float, failed: bool = False):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, duration_ms)] += 1
+        self.total += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        if failed:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попадает квантиль q (оценка сверху)."""
+        rank = q * self.total
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+
+class RedisLatency:
+    """Гистограммы задержек по командам Redis между отчетами."""
+    def __init__(self):
+        self._histograms: dict[str, LatencyHistogram] = {}
+        self.slow_ms = 100
+
+    def observe(self, command: str, duration: float, failed: bool = False):
+        duration_ms = duration * 1000
+        self._histograms.setdefault(command, LatencyHistogram()).observe(duration_ms, failed)
+        instrumentation.record_redis_call(command, duration, failed)
+        if duration_ms >= self.slow_ms:
+            log.warning(f"[Redis] Slow {command}: {duration_ms:.0f}ms")
+
+    def report(self, top_n: int = 10, reset: bool = True) -> str:
+        histograms = sorted(self._histograms.items(), key=lambda item: item[1].total_ms, reverse=True)
+        if reset:
+            self._histograms = {}
+        if not histograms:
+            return "[Redis] Нет команд за период."
+
+        lines = [f"[Redis] Топ-{top_n} команд по суммарному времени:"]
+        for command, h in histograms[:top_n]:
+            line = (
+                f"  {command}: calls={h.total} avg={h.total_ms / h.total:.1f}ms "
+                f"p50<={h.quantile(0.5):g}ms p95<={h.quantile(0.95):g}ms p99<={h.quantile(0.99):g}ms "
+                f"max={h.max_ms:.0f}ms"
+            )
+            if h.errors:
+                line += f" errors={h.errors}"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+redis_latency = RedisLatency()
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        # Весь pipeline - один round trip, поэтому и замер один
+        name = "MULTI" if self.is_transaction else "PIPELINE"
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().execute(raise_on_error)
+            failed = False
+            return result
+        finally:
+            redis_latency.observe(name, time.perf_counter() - started, failed)
+
+
+class InstrumentedRedis(redis.Redis):
+    async def execute_command(self, *args, **options):
+        command = str(args[0]).upper()
+        if command in BLOCKING_COMMANDS:
+            return await super().execute_command(*args, **options)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = await super().execute_command(*args, **options)
+            failed = False
+            return result
+        finally:
+            redis_latency.observe(command, time.perf_counter() - started, failed)
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class RedisManager:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._clients: dict[int, InstrumentedRedis] = {}
+        redis_latency.slow_ms = settings.redis_slow_command_ms
+
+    def client(self, db: int) -> InstrumentedRedis:
+        """Клиент для БД Redis; пул создается при первом обращении и общий для всех вызовов."""
+        client = self._clients.get(db)
+        if client is None:
+            pool = redis.BlockingConnectionPool(
+                host=self.settings.redis_host,
+                port=self.settings.redis_port,
+                db=db,
+                max_connections=self.settings.redis_max_connections,
+                timeout=self.settings.redis_pool_timeout_seconds,
+                socket_timeout=self.settings.redis_socket_timeout_seconds,
+                socket_connect_timeout=self.settings.redis_connect_timeout_seconds,
+                health_check_interval=self.settings.redis_health_check_seconds,
+                decode_responses=True
+            )
+            client = self._clients[db] = InstrumentedRedis(connection_pool=pool)
+        return client
+
+    async def start(self, dbs: tuple[int, ...] = ()):
+        """Открывает соединения заранее: первые апдейты не платят за подключение."""
+        for db in dbs:
+            self.client(db)
+        warmup = max(1, min(self.settings.redis_warmup_connections, self.settings.redis_max_connections))
+        for db, client in self._clients.items():
+            started = time.perf_counter()
+            # Параллельные PING занимают разные соединения пула
+            await asyncio.gather(*(client.ping() for _ in range(warmup)))
+            log.info(f"[Redis] db={db}: {warmup} connections ready, ping {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    async def close(self):
+        for db, client in self._clients.items():
+            try:
+                await client.aclose(close_connection_pool=True)
+            except Exception as e:
+                log.warning(f"[Redis] Failed to close db={db}: {e}")
+        self._clients = {}
+
+
+redis_manager = RedisManager(settings)
@@ -0,0 +1,86 @@
+"""
+Доставка "хотя бы один раз" через consumer group (services/deal_stream.py):
+запись, прочитанная упавшим потребителем без XACK, забирается другим
+через XAUTOCLAIM после min_idle_ms и применяется ровно один раз.
+"""
+import asyncio
+
+import fakeredis
+
+from services.deal_stream import StreamConsumer, ensure_consumer_group, stream_fields
+
+STREAM = "deals_stream"
+GROUP = "deal_processor"
+MIN_IDLE_MS = 50
+
+
+class DealStore:
+    """Хранилище сделок обработчика: применяет заявку идемпотентно по idempotency_key."""
+    def __init__(self):
+        self.deliveries = 0
+        self.deals: dict[str, dict] = {}
+
+    def apply(self, fields: dict):
+        self.deliveries += 1
+        self.deals.setdefault(fields["idempotency_key"], fields)
+
+
+async def _setup():
+    redis_client = fakeredis.FakeAsyncRedis(decode_responses=True)
+    await ensure_consumer_group(redis_client, STREAM, GROUP)
+    await redis_client.xadd(STREAM, stream_fields('{"amount": 100}', "app-1"))
+    consumer_a = StreamConsumer(redis_client, STREAM, GROUP, "processor-a", min_idle_ms=MIN_IDLE_MS)
+    consumer_b = StreamConsumer(redis_client, STREAM, GROUP, "processor-b", min_idle_ms=MIN_IDLE_MS)
+    return redis_client, consumer_a, consumer_b
+
+
+async def _process(consumer: StreamConsumer, store: DealStore) -> int:
+    entries = await consumer.read(block_ms=1)
+    for _, fields in entries:
+        store.apply(fields)
+    await consumer.ack([entry_id for entry_id, _ in entries])
+    return len(entries)
+
+
+def test_unacked_entry_is_reclaimed_and_applied_once():
+    async def scenario():
+        redis_client, consumer_a, consumer_b = await _setup()
+        store = DealStore()
+
+        # A прочитал запись и упал до фиксации сделки и XACK
+        assert len(await consumer_a.read(block_ms=1)) == 1
+
+        # Пока запись не простояла min_idle_ms, B ее не получает
+        assert await _process(consumer_b, store) == 0
+
+        await asyncio.sleep(MIN_IDLE_MS * 2 / 1000)
+        assert await _process(consumer_b, store) == 1
+        assert store.deliveries == 1
+
+        # После XACK запись больше никому не выдается
+        await asyncio.sleep(MIN_IDLE_MS * 2 / 1000)
+        assert await _process(consumer_a, store) == 0
+        assert await _process(consumer_b, store) == 0
+        assert (await redis_client.xpending(STREAM, GROUP))["pending"] == 0
+        assert store.deliveries == 1
+        assert list(store.deals) == ["app-1"]
+
+    asyncio.run(scenario())
+
+
+def test_redelivery_after_commit_is_deduplicated():
+    async def scenario():
+        redis_client, consumer_a, consumer_b = await _setup()
+        store = DealStore()
+
+        # A зафиксировал сделку, но упал до XACK: запись придет повторно
+        for _, fields in await consumer_a.read(block_ms=1):
+            store.apply(fields)
+
+        await asyncio.sleep(MIN_IDLE_MS * 2 / 1000)
+        assert await _process(consumer_b, store) == 1
+        assert store.deliveries == 2
+        assert list(store.deals) == ["app-1"]
+        assert (await redis_client.xpending(STREAM, GROUP))["pending"] == 0
+
+    asyncio.run(scenario())
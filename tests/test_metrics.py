@@ -0,0 +1,52 @@
+"""
+Эндпоинт /metrics (monitoring/metrics.py): скрейп локальным клиентом
+видит апдейты, ошибки Bot API, диалоги по статусам и очередь SLA.
+"""
+import asyncio
+import socket
+
+import aiohttp
+
+from monitoring.metrics import BotMetrics
+
+HOST = "127.0.0.1"
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def test_scrape_exposes_bot_metrics():
+    async def scenario():
+        metrics = BotMetrics()
+        port = _free_port()
+        await metrics.start_server(HOST, port)
+        try:
+            metrics.observe_update("client_message_handler", "update", 0.12)
+            metrics.observe_update("client_message_handler", "update", 0.03)
+            metrics.observe_api_call("sendMessage", 0.2, error="TelegramRetryAfter")
+            metrics.set_dialog_counts({"active": 3, "resolved": 10})
+            metrics.dialog_status_changed("active", "resolved")
+            metrics.sla_queue_changed(2)
+            metrics.sla_queue_changed(-5)
+            metrics.sla_queue_changed(1)
+
+            async with aiohttp.ClientSession() as client:
+                async with client.get(f"http://{HOST}:{port}/metrics") as response:
+                    assert response.status == 200
+                    assert response.headers["Content-Type"].startswith("text/plain")
+                    body = await response.text()
+        finally:
+            await metrics.stop_server()
+
+        lines = body.splitlines()
+        assert 'bot_updates_total{handler="client_message_handler"} 2.0' in lines
+        assert 'bot_api_errors_total{error="TelegramRetryAfter",method="sendMessage"} 1.0' in lines
+        assert 'bot_dialogs{status="active"} 2.0' in lines
+        assert 'bot_dialogs{status="resolved"} 11.0' in lines
+        # Очередь SLA не уходит ниже нуля: -5 при двух ожидающих дает 0, затем +1
+        assert "bot_sla_queue_size 1.0" in lines
+
+    asyncio.run(scenario())